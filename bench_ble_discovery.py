@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the per-cycle hot path of the BLE Discovery add-on.
+Each case runs at 100, 1k, 10k and 100k devices on a synthetic population
+and reports the time and peak memory of one cycle. A startup case spawns
+the add-on against a fake Supervisor and measures the time to its first
+published cycle. Results can be saved as a baseline and later runs compared
+against it; a regression beyond the tolerances, or a startup slower than
+STARTUP_BUDGET, makes the run exit with status 1.
+
+    python bench_ble_discovery.py                      # run and compare with bench_baseline.json
+    python bench_ble_discovery.py --sizes 100 1000     # quick run
+    python bench_ble_discovery.py --save-baseline      # record a new baseline
+    python bench_ble_discovery.py --skip-startup       # hot path cases only
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import ble_discovery
+from ble_discovery import (
+    process_ble_gateway_data,
+    discover_ble_devices,
+    save_discoveries,
+    load_discoveries,
+    determine_adaptive_scan_interval,
+    DeviceViews,
+    RssiMatrix
+)
+from ble_loadgen import LoadGenerator
+from fake_supervisor import FakeSupervisor
+
+SIZES = [100, 1000, 10000, 100000]
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(HERE, "bench_baseline.json")
+# Timing is noisier than allocation, so it gets the wider tolerance
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.2
+# Each case is repeated until this many seconds are spent, within the round limits
+TIME_BUDGET = 2.0
+MIN_ROUNDS = 3
+MAX_ROUNDS = 50
+# Proxies in the multi-proxy matrix case
+MATRIX_PROXIES = 20
+# Startup: population served by the fake Supervisor, rounds, and the hard limit
+# on seconds from process start to the first published cycle
+STARTUP_SIZE = 1000
+STARTUP_ROUNDS = 3
+STARTUP_BUDGET = 5.0
+STARTUP_TIMEOUT = 60
+
+# Imports the add-on as run.sh does, with its files under the directory given as argument
+STARTUP_SCRIPT = """
+import os, sys
+import ble_discovery
+ble_discovery.DISCOVERIES_FILE = os.path.join(sys.argv[1], "discoveries.json")
+ble_discovery.OPTIONS_FILE = os.path.join(sys.argv[1], "options.json")
+ble_discovery.LOG_DIR = os.path.join(sys.argv[1], "logs")
+ble_discovery.DIAGNOSTICS_DIR = os.path.join(sys.argv[1], "diagnostics")
+ble_discovery.main("WARNING", 60)
+"""
+
+
+def population(size, cache={}):
+    """Gateway rows and processed devices for a synthetic population of size devices."""
+    if size not in cache:
+        generator = LoadGenerator(device_count=size, proxy_count=1, seed=size)
+        generator.step()
+        rows = generator.gateway_rows()
+        cache[size] = (rows, process_ble_gateway_data(rows))
+    return cache[size]
+
+
+def bench_process_ble_gateway_data(size):
+    rows, _ = population(size)
+    return lambda: (rows,), process_ble_gateway_data
+
+
+def bench_discover_merge(size):
+    """One discover_ble_devices cycle where half the devices are already known."""
+    rows, devices = population(size)
+    known = [dict(device, id=str(i), name=f"BLE Device {i}") for i, device in enumerate(devices[:size // 2])]
+
+    def setup():
+        discover_ble_devices.discoveries = [dict(device) for device in known]
+        discover_ble_devices.index = {d["mac_address"]: d for d in discover_ble_devices.discoveries}
+        discover_ble_devices.current_rssi = {}
+        return ()
+
+    def run():
+        with patch.object(ble_discovery, "get_ble_gateway_data", return_value=list(rows)), \
+                patch.object(ble_discovery, "get_local_scanner", return_value=None), \
+                patch.object(ble_discovery, "save_discoveries"), \
+                patch.object(ble_discovery, "update_ha_input_text"), \
+                patch.object(ble_discovery, "create_home_assistant_notification"):
+            discover_ble_devices()
+
+    return setup, run
+
+
+def bench_save_discoveries(size):
+    _, devices = population(size)
+    return lambda: (devices,), save_discoveries
+
+
+def bench_load_discoveries(size):
+    _, devices = population(size)
+    save_discoveries(devices)
+    return lambda: (), load_discoveries
+
+
+def bench_determine_adaptive_scan_interval(size):
+    _, devices = population(size)
+
+    def setup():
+        # Every device has a previous reading, as in steady state
+        determine_adaptive_scan_interval.previous_rssi = {d["mac_address"]: d["rssi"] for d in devices}
+        return (60, devices, 50)
+
+    return setup, determine_adaptive_scan_interval
+
+
+def bench_ha_payload_serialization(size):
+    """The gateway sensor and input_text payloads posted to Home Assistant each cycle."""
+    _, devices = population(size)
+
+    def run():
+        json.dumps({
+            "state": "online",
+            "attributes": {"friendly_name": "BLE Gateway", "devices": devices, "adaptive_scan": True}
+        })
+        json.dumps({
+            "entity_id": "input_text.discovered_ble_devices",
+            "value": json.dumps({d["mac_address"]: d["rssi"] for d in devices})
+        })
+
+    return lambda: (), run
+
+
+def bench_device_views(size):
+    """Re-filing one cycle's readings in the sorted views and rendering the attributes."""
+    _, devices = population(size)
+    index = {d["mac_address"]: d for d in devices}
+    # The next cycle's readings: most devices keep their RSSI, a fifth move
+    readings = [dict(d, rssi=d["rssi"] + (3 if i % 5 == 0 else 0)) for i, d in enumerate(devices)]
+
+    def setup():
+        views = DeviceViews()
+        views.update(devices)
+        return (views,)
+
+    def run(views):
+        views.update(readings)
+        views.attributes(index)
+
+    return setup, run
+
+
+def bench_rssi_matrix_merge(size):
+    """One second of pushed advertisements merged into a matrix already holding every sighting."""
+    generator = LoadGenerator(device_count=size, proxy_count=MATRIX_PROXIES, seed=size)
+    generator.step()
+    sightings = generator.gateway_rows()
+    adverts = generator.advertisements(duration=1.0)
+
+    def setup():
+        matrix = RssiMatrix()
+        matrix.merge(sightings, now=0.0)
+        return (matrix,)
+
+    def run(matrix):
+        matrix.best_rows(matrix.merge(adverts, now=1.0))
+
+    return setup, run
+
+
+CASES = {
+    "process_ble_gateway_data": bench_process_ble_gateway_data,
+    "discover_merge": bench_discover_merge,
+    "save_discoveries": bench_save_discoveries,
+    "load_discoveries": bench_load_discoveries,
+    "determine_adaptive_scan_interval": bench_determine_adaptive_scan_interval,
+    "ha_payload_serialization": bench_ha_payload_serialization,
+    "device_views": bench_device_views,
+    "rssi_matrix_merge": bench_rssi_matrix_merge,
+}
+
+
+def measure(setup, run):
+    """Median time over repeated rounds, and the peak memory of one extra round."""
+    times = []
+    started = time.perf_counter()
+    while len(times) < MAX_ROUNDS and (len(times) < MIN_ROUNDS or time.perf_counter() - started < TIME_BUDGET):
+        args = setup()
+        t0 = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - t0)
+
+    args = setup()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    run(*args)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return {"time_s": statistics.median(times), "peak_kib": round(peak / 1024, 1), "rounds": len(times)}
+
+
+def run_benchmarks(sizes, cases):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp, \
+            patch.object(ble_discovery, "DISCOVERIES_FILE", os.path.join(tmp, "discoveries.json")):
+        for name in cases:
+            for size in sizes:
+                setup, run = CASES[name](size)
+                result = measure(setup, run)
+                results[f"{name}[{size}]"] = result
+                print(f"{name + f'[{size}]':<45} {result['time_s'] * 1000:>10.2f} ms "
+                      f"{result['time_s'] / size * 1e6:>8.2f} us/device {result['peak_kib']:>12.1f} KiB peak")
+    return results
+
+
+def measure_startup(size=STARTUP_SIZE, rounds=STARTUP_ROUNDS, timeout=STARTUP_TIMEOUT):
+    """
+    Median seconds from spawning the add-on to its first published cycle
+    (sensor.ble_scan_interval), against a fake Supervisor serving size
+    devices, and the peak RSS of the add-on process.
+    """
+    times = []
+    for _ in range(rounds):
+        generator = LoadGenerator(device_count=size, proxy_count=1, seed=size)
+        with tempfile.TemporaryDirectory() as tmp, FakeSupervisor(generator=generator) as fake:
+            env = dict(os.environ, SUPERVISOR_API=fake.url, SUPERVISOR_TOKEN="")
+            started = time.perf_counter()
+            child = subprocess.Popen([sys.executable, "-c", STARTUP_SCRIPT, tmp], cwd=HERE, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while "sensor.ble_scan_interval" not in fake.states:
+                    if child.poll() is not None:
+                        raise RuntimeError(f"Add-on exited with status {child.returncode} before publishing")
+                    if time.perf_counter() - started > timeout:
+                        raise TimeoutError(f"No publish within {timeout} s")
+                    time.sleep(0.005)
+                times.append(time.perf_counter() - started)
+            finally:
+                child.terminate()
+                child.wait()
+    # ru_maxrss is the largest child so far, in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"time_s": statistics.median(times), "peak_kib": float(peak), "rounds": len(times)}
+
+
+def run_startup(size=STARTUP_SIZE):
+    key = f"startup_first_publish[{size}]"
+    result = measure_startup(size)
+    print(f"{key:<45} {result['time_s'] * 1000:>10.2f} ms {'':>17} {result['peak_kib']:>12.1f} KiB peak RSS")
+    return {key: result}
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """Return the regressions of results against the baseline as messages."""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if result["time_s"] > reference["time_s"] * (1 + time_tolerance):
+            regressions.append(f"{key}: time {result['time_s'] * 1000:.2f} ms vs baseline {reference['time_s'] * 1000:.2f} ms")
+        if result["peak_kib"] > reference["peak_kib"] * (1 + memory_tolerance) + 64:
+            regressions.append(f"{key}: peak memory {result['peak_kib']:.0f} KiB vs baseline {reference['peak_kib']:.0f} KiB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BLE Discovery hot path benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Device counts")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES), help="Cases to run")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--skip-startup", action="store_true", help="Do not run the startup case")
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE,
+                        help="Allowed relative slowdown before a case counts as a regression")
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE,
+                        help="Allowed relative growth of peak memory before a case counts as a regression")
+
+    args = parser.parse_args()
+    ble_discovery.logging.disable(ble_discovery.logging.CRITICAL)
+
+    results = run_benchmarks(args.sizes, args.cases)
+    if not args.skip_startup:
+        results.update(run_startup())
+
+    regressions = [
+        f"{key}: first publish after {result['time_s']:.2f} s, budget {STARTUP_BUDGET:.1f} s"
+        for key, result in results.items()
+        if key.startswith("startup_") and result["time_s"] > STARTUP_BUDGET
+    ]
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": dict(sorted(baseline.items()))
+            }, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions += compare(results, json.load(f).get("results", {}), args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
@@ -4,48 +4,378 @@ Enhanced BLE Device Discovery Add-on for Home Assistant
 """
 
 import argparse
+import bisect
+import heapq
+import itertools
 import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
+import subprocess
 import sys
+import threading
 import time
-from datetime import datetime, timedelta
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
 import uuid
 import requests
 
 # Configuration
 DISCOVERIES_FILE = "/config/bluetooth_discoveries.json"
+OPTIONS_FILE = "/data/options.json"
+DIAGNOSTICS_DIR = "/config/ble_discovery/diagnostics"
+BLUETOOTH_SYSFS = "/sys/class/bluetooth"
+# Home Assistant Core API through the Supervisor proxy; overridable to run against a local stand-in
+SUPERVISOR_API = os.environ.get("SUPERVISOR_API", "http://supervisor/core/api")
 DEFAULT_SCAN_INTERVAL = 60
 DEFAULT_GATEWAY_TOPIC = "BTLE"
 
-def setup_logging(log_level):
-    """Configure logging based on input level."""
-    numeric_level = getattr(logging, log_level.upper(), None)
+# MQTT ingest: advertisements buffered between loop iterations
+MQTT_BUFFER_SIZE = 10000
+DEFAULT_MQTT_PORT = 1883
+# Push advertisements are coalesced per device and source over this window (seconds)
+DEFAULT_COALESCE_WINDOW = 10
+
+# Capture replay: btsnoop files written by btmon/btsnoop logging
+BTSNOOP_MAGIC = b"btsnoop\0"
+BTSNOOP_EPOCH_OFFSET = 0x00DCDDB30F2F8000  # microseconds from year 0 to 1970
+BTSNOOP_HCI_UNENCAPSULATED = 1001
+BTSNOOP_HCI_UART = 1002
+BTSNOOP_MONITOR = 2001
+HCI_EVENT_PACKET = 0x04
+HCI_LE_META_EVENT = 0x3E
+LE_ADVERTISING_REPORT = 0x02
+LE_EXTENDED_ADVERTISING_REPORT = 0x0D
+RSSI_UNAVAILABLE = 127
+
+# Local scan fallback: persistent bluetoothctl session
+LOCAL_SCAN_MAX_AGE = 120
+LOCAL_SCAN_RESTART_DELAY = 60
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+BLUETOOTHCTL_EVENT = re.compile(r'\[(NEW|CHG|DEL)\]\s+Device\s+([0-9A-Fa-f:]{17})\s*(.*)')
+BLUETOOTHCTL_RSSI = re.compile(r'RSSI:\s*(?:0x[0-9a-fA-F]+\s*\()?(-?\d+)')
+
+# Devices registered from Home Assistant (hassio.addon_stdin commands)
+DEFAULT_RSSI_THRESHOLD = -80
+RSSI_THRESHOLD_RANGE = (-100, -40)
+# Threshold helpers are re-read this often, and unchanged entities re-posted this often (seconds)
+REGISTERED_THRESHOLD_REFRESH = 300
+REGISTERED_KEEPALIVE = 600
+WEBSOCKET_TIMEOUT = 10
+
+# Options file changes are picked up within this many seconds
+OPTIONS_POLL_INTERVAL = 5
+# Options that only take effect on restart
+RESTART_OPTIONS = ("gateway_topic", "metrics")
+
+# Logging: one size-rotated file, written by a background listener thread
+LOG_DIR = "/config/ble_discovery/logs"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# Records waiting for the listener; beyond this they are dropped rather than block the loop
+LOG_QUEUE_SIZE = 10000
+# Repetitive per-device messages: at most this many per call site per window (0 = unlimited)
+LOG_RATE_LIMIT = 5
+LOG_RATE_WINDOW = 60
+# Optional JSON trace log: one record per cycle, in its own rotated file
+TRACE_LOG_FILE = "ble_discovery_trace.jsonl"
+TRACE_MAX_BYTES = 2 * 1024 * 1024
+TRACE_BACKUP_COUNT = 3
+# Error messages kept per cycle record
+TRACE_MAX_ERRORS = 10
+
+# Load shedding: rows processed per cycle, and devices published while under pressure
+MAX_ROWS_PER_CYCLE = 5000
+PRESSURE_PUBLISH_LIMIT = 50
+# The gateway sensor lists at most this many devices, the most recently seen ones
+GATEWAY_PUBLISH_LIMIT = 1000
+# The loop is under pressure when due work is this many seconds overdue,
+# or the raw advertisement buffer is this full
+PRESSURE_MAX_LAG = 30
+PRESSURE_QUEUE_FILL = 0.8
+
+# New-device notifications: debounce window (seconds) and message caps
+NOTIFY_DEBOUNCE_WINDOW = 60
+NOTIFY_MAX_DEVICES = 20
+NOTIFY_MAX_LENGTH = 2000
+
+# Precomputed device views: entity, strongest devices listed overall and per
+# type or room, and the number of most recently discovered devices
+VIEWS_ENTITY = "sensor.ble_device_views"
+VIEWS_TOP_N = 20
+VIEWS_GROUP_N = 5
+VIEWS_RECENT_N = 10
+
+# Signal test mode: on a signal_test command the device is sampled at its full
+# advertisement rate for the test duration (seconds, capped), and the statistics
+# over the last window (seconds) are published at most once per refresh interval
+SIGNAL_TEST_ENTITY = "sensor.ble_signal_test"
+SIGNAL_TEST_WINDOW = 30
+SIGNAL_TEST_REFRESH = 1.0
+SIGNAL_TEST_MAX_SAMPLES = 5000
+SIGNAL_TEST_DURATION = 30
+SIGNAL_TEST_MAX_DURATION = 600
+# Pause before reconnecting an interrupted advertisement stream
+SIGNAL_TEST_RECONNECT_DELAY = 2.0
+# The advertisement stream is only reconnected after this long without any
+# traffic; Home Assistant pings every 55 s, so a quiet device is not a dead stream
+SIGNAL_TEST_STREAM_IDLE = 120
+
+# Per-phase cycle timing: rolling window of cycles and log-spaced histogram buckets (seconds)
+PERF_PHASES = ["activity", "gateway_fetch", "aggregate", "parse", "classify", "merge", "persist", "publish", "notify"]
+PERF_WINDOW = 256
+PERF_BUCKETS = [0.0005 * 2 ** (i / 2) for i in range(48)]  # 0.5 ms .. ~ 3 h
+
+# Memory accounting: checked every few cycles; when the per-device trackers
+# exceed the soft limit, the tracking state of the stalest devices is
+# dropped, but never of ones seen within MEMORY_KEEP_RECENT seconds
+MEMORY_CHECK_CYCLES = 10
+MEMORY_EVICT_FRACTION = 0.1
+MEMORY_KEEP_RECENT = 3600
+MEMORY_SIZE_SAMPLE = 64
+# Per-device trackers that eviction shrinks; only these count towards the soft limit
+MEMORY_EVICTABLE = ("published_rssi", "previous_rssi", "scheduler", "proxy_matrix", "rssi_filter",
+                        "rooms", "device_views")
+
+# On-demand profiling, switched on from Home Assistant
+PROFILE_ENTITY = "input_boolean.ble_discovery_profiling"
+PROFILE_CYCLES = 5
+PROFILE_TOP_FUNCTIONS = 60
+PROFILE_TOP_ALLOCATIONS = 30
+
+# Prometheus metrics, served on this port when enabled
+METRICS_PORT = 8099
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+CYCLE_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+# Fields added by the optional pipeline stages, copied onto known devices on update
+OPTIONAL_DEVICE_FIELDS = (
+    "rssi_smoothed",
+    "rssi_variance",
+    "nearest_proxy",
+    "proxy_rssi",
+    "room",
+    "adv_count",
+    "rssi_mean"
+)
+
+# Sensors whose "devices" attribute holds raw gateway rows
+GATEWAY_SENSORS = [
+    "sensor.ble_gateway_raw_data",
+    "sensor.ble_scanner",
+    "sensor.ble_monitor",
+    "sensor.ble_gateway"
+]
+
+# Activity scoring: entities (glob patterns allowed) whose state changes count
+# towards the activity level, with a weight per matched entity
+DEFAULT_ACTIVITY_ENTITIES = [
+    {"entity": "binary_sensor.*motion*", "weight": 1.0},
+    {"entity": "binary_sensor.*occupancy*", "weight": 1.0},
+    {"entity": "binary_sensor.*presence*", "weight": 1.0},
+    {"entity": "binary_sensor.*door*", "weight": 0.5},
+    {"entity": "light.*", "weight": 0.25}
+]
+ACTIVITY_WINDOW_MINUTES = 15
+# Weighted state changes within the window that count as 100% activity
+ACTIVITY_SATURATION = 20
+
+# Per-device scheduling: bounds for each device's refresh interval (seconds)
+DEVICE_MIN_INTERVAL = 10
+DEVICE_MAX_INTERVAL = 900
+# Devices not seen for this long are refreshed less often
+DEVICE_STALE_AFTER = 300
+# Devices not seen for this long are dropped from the scheduler (rotated private addresses never return)
+DEVICE_RETENTION = 3600
+
+# RSSI smoothing ("ewma", "kalman" or "none")
+DEFAULT_RSSI_FILTER = "ewma"
+RSSI_EWMA_ALPHA = 0.3
+# 1-D Kalman process and measurement noise (dB^2)
+RSSI_KALMAN_PROCESS_NOISE = 1.0
+RSSI_KALMAN_MEASUREMENT_NOISE = 16.0
+# Minimum change in smoothed RSSI (dB) that counts as movement
+SMOOTHED_MOVEMENT_THRESHOLD = 4
+
+# Multi-proxy aggregation: sightings older than this (seconds) no longer count
+PROXY_SIGHTING_TTL = 120
+# Placeholder RSSI for sources that have not heard a device
+NO_SIGNAL = -200.0
+
+# Room presence: RSSI used for proxies that do not hear a device, and the
+# expected RSSI next to a room's own proxy when no fingerprint is configured
+ROOM_RSSI_FLOOR = -100.0
+ROOM_PROXY_RSSI = -45.0
+# A new room must beat the current one by this many dB (RMS) ...
+ROOM_HYSTERESIS_DB = 4.0
+# ... on this many consecutive updates before the device moves
+ROOM_CONFIRM_UPDATES = 2
+ROOM_AWAY = "not_home"
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most limit records per call site in each window, and
+    note how many were suppressed on the first record of the next window.
+    Used for warnings and errors repeated for every device of a cycle;
+    debug and info records always pass.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.sites = {}  # (pathname, lineno) -> [window start, passed, suppressed]
+
+    def filter(self, record):
+        if not self.limit or record.levelno < logging.WARNING:
+            return True
+        site = self.sites.setdefault((record.pathname, record.lineno), [record.created, 0, 0])
+        if record.created - site[0] >= self.window:
+            if site[2]:
+                record.msg = f"{record.msg} ({site[2]} similar messages suppressed)"
+            site[:] = [record.created, 0, 0]
+        if site[1] < self.limit:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that drops records instead of blocking when the listener falls behind."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class CycleTrace(logging.Filter):
+    """
+    Tags every log record with the current cycle id and collects the
+    cycle's errors. When enabled, end_cycle writes one compact JSON record
+    per cycle (id, phase timings, counts, errors) to the trace log.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.enabled = False
+        self.cycle_id = 0
+        self.started = None
+        self.counts = {}
+        self.errors = []
+        self.error_count = 0
+
+    def filter(self, record):
+        record.cycle_id = self.cycle_id
+        if record.levelno >= logging.ERROR:
+            self.error_count += 1
+            if len(self.errors) < TRACE_MAX_ERRORS:
+                self.errors.append(record.getMessage()[:200])
+        return True
+
+    def begin_cycle(self):
+        self.cycle_id += 1
+        self.started = datetime.now(timezone.utc)
+        self.counts = {}
+        self.errors = []
+        self.error_count = 0
+
+    def count(self, **counts):
+        """Record counts for the current cycle."""
+        self.counts.update(counts)
+
+    def end_cycle(self, perf=None):
+        if not self.enabled:
+            return
+        record = {
+            "cycle": self.cycle_id,
+            "ts": self.started.isoformat(timespec="milliseconds") if self.started else None,
+            "counts": self.counts,
+            "errors": self.error_count
+        }
+        if perf is not None and perf.last_cycle is not None:
+            record["ms"] = round(perf.last_cycle * 1000, 2)
+            record["phases_ms"] = {phase: round(elapsed * 1000, 2) for phase, elapsed in perf.current.items()}
+        if self.errors:
+            record["error_messages"] = self.errors
+        trace_log.info(json.dumps(record, separators=(",", ":")))
+
+CYCLE_TRACE = CycleTrace()
+
+# Per-device messages from loops go through this logger so they can be rate limited
+device_log = logging.getLogger("ble_discovery.device")
+device_log_filter = RateLimitFilter()
+device_log.addFilter(device_log_filter)
+
+# Per-cycle JSON records, kept out of the human-readable log
+trace_log = logging.getLogger("ble_discovery.trace")
+trace_log.propagate = False
+
+def log_level_number(log_level):
+    """Logging level for an add-on log_level, including the Supervisor's trace and fatal."""
+    numeric_level = getattr(logging, {"TRACE": "DEBUG", "FATAL": "CRITICAL"}.get(log_level.upper(), log_level.upper()), None)
     if not isinstance(numeric_level, int):
         raise ValueError(f'Invalid log level: {log_level}')
+    return numeric_level
+
+def setup_logging(log_level, rate_limit=LOG_RATE_LIMIT, log_dir=None, trace=False):
+    """
+    Configure logging based on input level. Records are put on a queue by
+    the calling thread and written to the console and a size-rotated file
+    by a listener thread, so the discovery loop never waits on disk I/O.
+    With trace, per-cycle JSON records go to a second rotated file.
+    """
+    numeric_level = log_level_number(log_level)
     
     # Create logs directory if it doesn't exist
-    log_dir = "/config/ble_discovery/logs"
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir, exist_ok=True)
-    
-    # Generate log filename with timestamp
-    log_filename = os.path.join(log_dir, f"ble_discovery_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+    log_dir = log_dir or LOG_DIR
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = os.path.join(log_dir, "ble_discovery.log")
     
     # Configure file handler for detailed logging
-    file_handler = logging.FileHandler(log_filename)
-    file_handler.setLevel(numeric_level)
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
     file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s - BLE Discovery - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+        '%(asctime)s - BLE Discovery - %(levelname)s - [%(filename)s:%(lineno)d] - [cycle %(cycle_id)s] - %(message)s'
     ))
     
     # Configure console handler for basic logging
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(numeric_level)
     console_handler.setFormatter(logging.Formatter(
         '%(asctime)s - BLE Discovery - %(levelname)s - %(message)s'
     ))
     
+    # Replace the listeners from an earlier call
+    stop_logging()
+    listener = logging.handlers.QueueListener(queue.Queue(LOG_QUEUE_SIZE), file_handler, console_handler)
+    setup_logging.listeners = [listener]
+    # Queue handlers by log, whose dropped records are exported as a metric
+    setup_logging.queue_handlers = {}
+    
+    for handler in trace_log.handlers[:]:
+        trace_log.removeHandler(handler)
+    if trace:
+        trace_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(log_dir, TRACE_LOG_FILE), maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT
+        )
+        trace_listener = logging.handlers.QueueListener(queue.Queue(LOG_QUEUE_SIZE), trace_handler)
+        setup_logging.queue_handlers["trace"] = DroppingQueueHandler(trace_listener.queue)
+        trace_log.addHandler(setup_logging.queue_handlers["trace"])
+        trace_log.setLevel(logging.INFO)
+        setup_logging.listeners.append(trace_listener)
+    CYCLE_TRACE.enabled = trace
+    
+    for running in setup_logging.listeners:
+        running.start()
+    
     # Configure root logger
     root_logger = logging.getLogger()
     root_logger.setLevel(numeric_level)
@@ -53,31 +383,179 @@ def setup_logging(log_level):
     # Remove any existing handlers
     for handler in root_logger.handlers[:]:
         root_logger.removeHandler(handler)
+    queue_handler = setup_logging.queue_handlers["main"] = DroppingQueueHandler(listener.queue)
+    queue_handler.addFilter(CYCLE_TRACE)
+    root_logger.addHandler(queue_handler)
     
-    # Add the handlers to the logger
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
-    
-    # Create a symlink to the latest log file
-    latest_log_link = os.path.join(log_dir, "latest.log")
-    try:
-        if os.path.exists(latest_log_link):
-            os.remove(latest_log_link)
-        os.symlink(log_filename, latest_log_link)
-    except Exception as e:
-        print(f"Error creating symlink to latest log: {e}")
-        
-    # Rotate logs (keep only last 10)
-    try:
-        log_files = sorted([f for f in os.listdir(log_dir) if f.startswith("ble_discovery_") and f.endswith(".log")])
-        if len(log_files) > 10:
-            for old_file in log_files[:-10]:
-                os.remove(os.path.join(log_dir, old_file))
-    except Exception as e:
-        print(f"Error rotating logs: {e}")
+    device_log_filter.limit = rate_limit
         
     logging.info("Logging initialized with level %s to %s", log_level, log_filename)
 
+def stop_logging():
+    """Flush queued records and stop the listener threads."""
+    for listener in getattr(setup_logging, "listeners", []):
+        listener.stop()
+    setup_logging.listeners = []
+
+class Metric:
+    """
+    One Prometheus metric family (counter, gauge or histogram).
+    Children are created per label set on first use; updates are plain
+    attribute writes from the discovery loop, and scrapes only read them,
+    so the hot path takes no locks.
+    """
+
+    def __init__(self, name, kind, help_text, labels=(), buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, MetricValue(self.buckets))
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, values))
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{{{labels}}} {child.value}" if labels else f"{self.name} {child.value}")
+                continue
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {child.count}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {child.value}")
+            lines.append(f"{self.name}_count{suffix} {child.count}")
+        return lines
+
+class MetricValue:
+    """Value of one labelled series; histograms also keep bucket counts."""
+
+    def __init__(self, buckets=None):
+        self.value = 0
+        self.count = 0
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) if buckets else None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.value += value
+        self.count += 1
+
+class Metrics:
+    """The add-on's metric families and their text exposition."""
+
+    def __init__(self):
+        self.devices_seen = Metric("ble_devices_seen", "gauge", "Devices processed in the last cycle")
+        self.devices_known = Metric("ble_devices_known", "gauge", "Devices in the discovery store")
+        self.new_devices = Metric("ble_new_devices_total", "counter", "Devices discovered for the first time")
+        self.request_duration = Metric("ble_supervisor_request_duration_seconds", "histogram",
+                                       "Latency of Home Assistant API calls through the Supervisor",
+                                       ("endpoint",), LATENCY_BUCKETS)
+        self.http_errors = Metric("ble_supervisor_http_errors_total", "counter",
+                                  "Failed Home Assistant API calls by status code", ("endpoint", "status"))
+        self.bytes_written = Metric("ble_persistence_bytes_written_total", "counter",
+                                    "Bytes written to the discovery store")
+        self.queue_depth = Metric("ble_queue_depth", "gauge", "Items waiting in each ingest queue", ("queue",))
+        self.log_records_dropped = Metric("ble_log_records_dropped_total", "counter",
+                                          "Log records dropped because the log queue was full", ("log",))
+        self.cache_lookups = Metric("ble_cache_lookups_total", "counter", "Cache lookups by result",
+                                    ("cache", "result"))
+        self.cycle_duration = Metric("ble_cycle_duration_seconds", "histogram", "Duration of a discovery cycle",
+                                     buckets=CYCLE_BUCKETS)
+
+    def render(self):
+        lines = []
+        for metric in vars(self).values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+def record_log_drops(metrics=METRICS):
+    """Export the records dropped by the logging queue handlers."""
+    for log, handler in getattr(setup_logging, "queue_handlers", {}).items():
+        metrics.log_records_dropped.labels(log).set(handler.dropped)
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics from a daemon thread. Returns the server, or None if the port is unavailable."""
+    # Only needed when metrics are enabled, so kept out of startup
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves METRICS in the Prometheus text format on any GET path."""
+
+        def do_GET(self):
+            body = METRICS.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Could not start metrics endpoint on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Prometheus metrics available on port {port}")
+    return server
+
+def supervisor_endpoint(method, path):
+    """Metric label for an API path, e.g. 'POST /services/input_text/set_value' or 'GET /states/{entity_id}'."""
+    parts = path.strip("/").split("/")
+    if parts[0] == "services":
+        endpoint = "/".join(parts[:3])
+    elif parts[0] == "states" and len(parts) > 1:
+        endpoint = "states/{entity_id}"
+    else:
+        endpoint = parts[0]
+    return f"{method.upper()} /{endpoint}"
+
+def supervisor_request(method, path, **kwargs):
+    """
+    Call the Home Assistant API through the Supervisor, recording the
+    latency per endpoint and failed calls by status code.
+    """
+    endpoint = supervisor_endpoint(method, path)
+    started = time.monotonic()
+    try:
+        response = getattr(requests, method)(f"{SUPERVISOR_API}{path}", **kwargs)
+    except Exception:
+        METRICS.http_errors.labels(endpoint, "exception").inc()
+        raise
+    finally:
+        METRICS.request_duration.labels(endpoint).observe(time.monotonic() - started)
+    if response.status_code >= 400:
+        METRICS.http_errors.labels(endpoint, str(response.status_code)).inc()
+    return response
+
+def supervisor_get(path, **kwargs):
+    return supervisor_request("get", path, **kwargs)
+
+def supervisor_post(path, **kwargs):
+    return supervisor_request("post", path, **kwargs)
+
 def load_discoveries():
     """Load previously discovered devices."""
     try:
@@ -88,11 +566,76 @@ def load_discoveries():
         logging.error(f"Error loading discoveries: {e}")
     return []
 
+def load_options():
+    """Load the add-on options written by the Supervisor."""
+    try:
+        if os.path.exists(OPTIONS_FILE):
+            with open(OPTIONS_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        logging.error(f"Error loading options: {e}")
+    return {}
+
+class OptionsWatcher:
+    """
+    Watches the add-on options file so changes apply without a restart.
+    wait() stands in for the loop's sleep: it polls the file's modification
+    time and returns early with the names of the changed options when the
+    Supervisor rewrites it.
+    """
+
+    def __init__(self, options=None, path=None, poll_interval=OPTIONS_POLL_INTERVAL):
+        self.path = path or OPTIONS_FILE
+        self.poll_interval = poll_interval
+        self.options = dict(options or {})
+        self.signature = self.stat()
+
+    def stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def check(self):
+        """Names of the options that changed since the last check."""
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return set()
+        try:
+            with open(self.path, 'r') as f:
+                options = json.load(f)
+        except (OSError, ValueError) as e:
+            # Possibly caught mid-write; retried on the next poll
+            logging.debug("Error reading %s: %s", self.path, e)
+            return set()
+        self.signature = signature
+        changed = {key for key in self.options.keys() | options.keys() if self.options.get(key) != options.get(key)}
+        self.options = options
+        return changed
+
+    def wait(self, seconds, wake=None):
+        """
+        Sleep up to seconds, returning early with the changed options if the
+        file changes, or with none when the wake event is set.
+        """
+        deadline = time.monotonic() + seconds
+        while True:
+            changed = self.check()
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0 or (wake is not None and wake.is_set()):
+                return changed
+            if wake is not None:
+                wake.wait(min(self.poll_interval, remaining))
+            else:
+                time.sleep(min(self.poll_interval, remaining))
+
 def save_discoveries(discoveries):
     """Save discoveries to file."""
     try:
         with open(DISCOVERIES_FILE, 'w') as f:
             json.dump(discoveries, f, indent=2)
+            METRICS.bytes_written.labels().inc(f.tell())
         return True
     except Exception as e:
         logging.error(f"Error saving discoveries: {e}")
@@ -115,8 +658,8 @@ def create_home_assistant_notification(title, message, notification_id=None):
         if notification_id:
             payload["notification_id"] = notification_id
         
-        response = requests.post(
-            "http://supervisor/core/api/services/persistent_notification/create", 
+        response = supervisor_post(
+            "/services/persistent_notification/create", 
             headers=headers, 
             json=payload
         )
@@ -133,7 +676,9 @@ def create_home_assistant_notification(title, message, notification_id=None):
 def get_ble_gateway_data():
     """
     Get BLE gateway data from bluetooth integration.
-    Returns a list of discovered devices.
+    Returns a list of discovered devices from every source (Bluetooth
+    integration and gateway sensors). Each row carries the source that
+    heard the device at index 4.
     """
     try:
         headers = {
@@ -141,9 +686,9 @@ def get_ble_gateway_data():
             "Content-Type": "application/json"
         }
         
-        # First try to get bluetooth devices from the native integration
-        response = requests.get(
-            "http://supervisor/core/api/states",
+        # A single states request covers the native integration and all gateway sensors
+        response = supervisor_get(
+            "/states",
             headers=headers
         )
         
@@ -153,7 +698,7 @@ def get_ble_gateway_data():
             
         states = response.json()
         
-        # Look for bluetooth devices in the states
+        # Look for bluetooth devices and gateway sensors in the states
         devices = []
         for state in states:
             entity_id = state.get('entity_id', '')
@@ -173,55 +718,490 @@ def get_ble_gateway_data():
                         entity_id,  # Device ID (index 0)
                         mac,        # MAC address (index 1)
                         str(rssi),  # RSSI value (index 2)
-                        str(attributes)  # All attributes as string (index 3)
+                        str(attributes),  # All attributes as string (index 3)
+                        attributes.get('source') or 'bluetooth'  # Proxy/adapter that heard it (index 4)
                     ]
                     devices.append(device_info)
                 except Exception as e:
-                    logging.error(f"Error processing bluetooth entity {entity_id}: {e}")
-        
-        # If we found devices, return them
-        if devices:
-            logging.info(f"Found {len(devices)} devices from Bluetooth integration")
-            return devices
-            
-        # Fall back to checking for ble_gateway_raw_data sensor
-        response = requests.get(
-            "http://supervisor/core/api/states/sensor.ble_gateway_raw_data",
-            headers=headers
-        )
-        
-        if response.status_code < 200 or response.status_code >= 300:
-            # Try alternative sensors
-            for sensor_name in ["sensor.ble_scanner", "sensor.ble_monitor", "sensor.ble_gateway"]:
-                alt_response = requests.get(
-                    f"http://supervisor/core/api/states/{sensor_name}",
-                    headers=headers
-                )
-                if alt_response.status_code >= 200 and alt_response.status_code < 300:
-                    state_data = alt_response.json()
-                    if 'attributes' in state_data and 'devices' in state_data['attributes']:
-                        devices = state_data['attributes']['devices']
-                        logging.info(f"Found {len(devices)} devices in {sensor_name}")
-                        return devices
-            
-            # Create our own sensor data with simulated scan results
-            create_ble_gateway_sensor()
-            return []
+                    device_log.error("Error processing bluetooth entity %s: %s", entity_id, e)
             
-        state_data = response.json()
+            elif entity_id in GATEWAY_SENSORS:
+                sensor_devices = state.get('attributes', {}).get('devices') or []
+                # Only raw gateway rows; our own published discoveries are dicts
+                rows = [
+                    list(row[:4]) + [row[4] if len(row) > 4 and row[4] else entity_id]
+                    for row in sensor_devices
+                    if isinstance(row, (list, tuple)) and len(row) >= 3
+                ]
+                if rows:
+                    logging.info("Found %d devices in %s", len(rows), entity_id)
+                    devices.extend(rows)
         
-        # Check if we have attributes with devices
-        if 'attributes' in state_data and 'devices' in state_data['attributes']:
-            devices = state_data['attributes']['devices']
-            logging.info(f"Found {len(devices)} devices in ble_gateway_raw_data")
+        if devices:
+            logging.info("Found %d device sightings in total", len(devices))
             return devices
             
+        # Create our own sensor data with simulated scan results
+        create_ble_gateway_sensor()
         return []
         
     except Exception as e:
         logging.error(f"Error getting BLE gateway data: {e}")
         return []
         
+def decode_mqtt_advertisement(topic, payload):
+    """
+    Decode one MQTT message from a BLE gateway into gateway rows.
+    Handles OpenMQTTGateway/Theengs messages (one advertisement per message,
+    "<topic>/<gateway>/BTtoMQTT/<mac>") and ble_gateway style messages
+    carrying a "devices" list of raw rows.
+    """
+    data = json.loads(payload)
+    if not isinstance(data, dict):
+        return []
+
+    # The gateway that heard the device: the level before BTtoMQTT, else the second level
+    levels = topic.split("/")
+    if "BTtoMQTT" in levels and levels.index("BTtoMQTT") > 0:
+        source = levels[levels.index("BTtoMQTT") - 1]
+    else:
+        source = levels[1] if len(levels) > 1 else topic
+    source = data.get("gateway") or source
+
+    if isinstance(data.get("devices"), list):
+        return [
+            list(row[:4]) + [row[4] if len(row) > 4 and row[4] else source]
+            for row in data["devices"]
+            if isinstance(row, (list, tuple)) and len(row) >= 3
+        ]
+
+    mac = data.get("id") or data.get("mac")
+    if not mac or data.get("rssi") is None:
+        return []
+    mac = str(mac).upper()
+    if ':' not in mac:
+        mac = ':'.join([mac[i:i+2] for i in range(0, len(mac), 2)])
+    return [[topic, mac, str(int(data["rssi"])), payload if isinstance(payload, str) else payload.decode('utf-8'), source]]
+
+def gateway_row_rssi(row):
+    """RSSI of a gateway row as an int, -100 if missing."""
+    try:
+        return int(row[2])
+    except (IndexError, TypeError, ValueError):
+        return -100
+
+def recent_devices(devices, limit=GATEWAY_PUBLISH_LIMIT):
+    """The limit most recently seen devices, so the published history stays bounded."""
+    if len(devices) <= limit:
+        return devices
+    return heapq.nlargest(limit, devices, key=lambda d: d.get("last_seen") or "")
+
+class LoadShedder:
+    """
+    Backpressure policy for the discovery loop.
+    Raw advertisements are dropped oldest-first by the bounded ingest buffer;
+    here the rows processed per cycle are capped, keeping every row for a new
+    device and the strongest rows for known devices, and while the loop is
+    under pressure only the strongest devices are published: on the gateway
+    sensor, as registered device entities and in the pending notification.
+    """
+
+    def __init__(self, max_rows=MAX_ROWS_PER_CYCLE, publish_limit=PRESSURE_PUBLISH_LIMIT,
+                 max_lag=PRESSURE_MAX_LAG):
+        self.max_rows = max_rows
+        self.publish_limit = publish_limit
+        self.max_lag = max_lag
+        self.pressure = False
+        self.lag = 0.0
+        self.max_lag_seen = 0.0
+        self.cycle_duration = 0.0
+        self.pressure_cycles = 0
+        self.rows_shed = 0
+        self.publish_shed = 0
+
+    def start_cycle(self, next_due=None, interval=None, queue_fill=0.0, now=None):
+        """
+        Measure lag at the start of a cycle and decide whether to shed load.
+        Lag is how overdue the earliest scheduled device is; the previous cycle
+        taking longer than the interval also counts as pressure.
+        """
+        now = time.monotonic() if now is None else now
+        self.lag = max(0.0, now - next_due) if next_due is not None else 0.0
+        self.max_lag_seen = max(self.max_lag_seen, self.lag)
+        self.pressure = (
+            self.lag > self.max_lag
+            or queue_fill >= PRESSURE_QUEUE_FILL
+            or (interval is not None and self.cycle_duration > interval)
+        )
+        if self.pressure:
+            self.pressure_cycles += 1
+        return now
+
+    def end_cycle(self, started_at, now=None):
+        """Record how long the cycle took."""
+        now = time.monotonic() if now is None else now
+        self.cycle_duration = now - started_at
+
+    def limit_rows(self, rows, known_devices):
+        """Cap the rows processed this cycle. Rows for new devices are never shed."""
+        if len(rows) <= self.max_rows:
+            return rows
+        new_rows = [row for row in rows if row[1] not in known_devices]
+        known_rows = [row for row in rows if row[1] in known_devices]
+        kept = heapq.nlargest(max(0, self.max_rows - len(new_rows)), known_rows, key=gateway_row_rssi)
+        self.rows_shed += len(known_rows) - len(kept)
+        return new_rows + kept
+
+    def limit_publish(self, devices):
+        """While under pressure, publish only the strongest devices."""
+        if not self.pressure or len(devices) <= self.publish_limit:
+            return devices
+        self.publish_shed += len(devices) - self.publish_limit
+        return heapq.nlargest(self.publish_limit, devices, key=lambda d: d.get("rssi", -100))
+
+    def limit_notifications(self, notifier):
+        """While under pressure, keep only the strongest devices pending in the notifier."""
+        if self.pressure:
+            self.publish_shed += notifier.shed(self.publish_limit)
+
+    def stats(self):
+        """Shed counts and lag for the scan interval sensor."""
+        return {
+            "under_pressure": self.pressure,
+            "pressure_cycles": self.pressure_cycles,
+            "lag_seconds": round(self.lag, 1),
+            "max_lag_seconds": round(self.max_lag_seen, 1),
+            "cycle_seconds": round(self.cycle_duration, 2),
+            "rows_shed": self.rows_shed,
+            "publish_shed": self.publish_shed
+        }
+
+class AdvertisementCoalescer:
+    """
+    Micro-batching stage for push ingest. Advertisements are collapsed per
+    (device, source) over a window, keeping the count, max and mean RSSI
+    and the latest payload, and released as one batch per window.
+    """
+
+    def __init__(self, window=DEFAULT_COALESCE_WINDOW):
+        self.window = window
+        self.pending = {}  # (mac, source) -> [count, rssi_sum, rssi_max, latest row]
+        self.window_start = None
+        self.advertisements_in = 0
+        self.rows_out = 0
+
+    def add(self, rows, now=None):
+        """Fold a batch of gateway rows into the current window."""
+        now = time.monotonic() if now is None else now
+        if self.window_start is None and rows:
+            self.window_start = now
+        pending = self.pending
+        for row in rows:
+            try:
+                rssi = int(row[2])
+            except (IndexError, TypeError, ValueError):
+                continue
+            key = (row[1], row[4] if len(row) > 4 else None)
+            entry = pending.get(key)
+            if entry is None:
+                pending[key] = [1, rssi, rssi, row]
+            else:
+                entry[0] += 1
+                entry[1] += rssi
+                if rssi > entry[2]:
+                    entry[2] = rssi
+                entry[3] = row
+            self.advertisements_in += 1
+
+    def ready(self, now=None):
+        """True once the current window has elapsed."""
+        now = time.monotonic() if now is None else now
+        return self.window_start is not None and now - self.window_start >= self.window
+
+    def flush(self):
+        """
+        Release the window as gateway rows: the max RSSI (robust to fading),
+        the latest payload and source, and {count, rssi_mean, rssi_max} at index 5.
+        """
+        rows = []
+        for count, rssi_sum, rssi_max, row in self.pending.values():
+            stats = {"count": count, "rssi_mean": round(rssi_sum / count, 1), "rssi_max": rssi_max}
+            # Replayed rows keep their recorded time
+            if len(row) > 5 and isinstance(row[5], dict) and "last_seen" in row[5]:
+                stats["last_seen"] = row[5]["last_seen"]
+            rows.append([
+                row[0],
+                row[1],
+                str(rssi_max),
+                row[3] if len(row) > 3 else "",
+                row[4] if len(row) > 4 else None,
+                stats
+            ])
+        self.pending = {}
+        self.window_start = None
+        self.rows_out += len(rows)
+        return rows
+
+    def stats(self):
+        """Coalescing ratio and queue depth for the scan interval sensor."""
+        return {
+            "coalesce_ratio": round(self.advertisements_in / self.rows_out, 2) if self.rows_out else None,
+            "coalesce_pending": len(self.pending),
+            "coalesce_window": self.window
+        }
+
+class MqttIngest:
+    """
+    Native MQTT ingest for <gateway_topic>/#.
+    The MQTT network thread only appends raw messages to a bounded buffer
+    (oldest dropped and counted when full); payloads are decoded in batch
+    when the discovery loop drains the buffer.
+    """
+
+    def __init__(self, gateway_topic, buffer_size=MQTT_BUFFER_SIZE, client=None):
+        self.topic = f"{gateway_topic.rstrip('/')}/#"
+        self.buffer = deque(maxlen=buffer_size)
+        self.client = client
+        self.received = 0
+        self.dropped = 0
+        self.decode_errors = 0
+
+    def start(self, host, port=DEFAULT_MQTT_PORT, username=None, password=None):
+        """Connect to the broker and start the network loop in the background."""
+        if self.client is None:
+            try:
+                import paho.mqtt.client as mqtt
+            except ImportError:
+                logging.warning("paho-mqtt is not installed, MQTT ingest disabled")
+                return False
+            if hasattr(mqtt, "CallbackAPIVersion"):
+                self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            else:
+                self.client = mqtt.Client()
+
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        try:
+            self.client.connect_async(host, port)
+            self.client.loop_start()
+        except Exception as e:
+            logging.error(f"Error connecting to MQTT broker {host}:{port}: {e}")
+            return False
+
+        logging.info(f"MQTT ingest subscribing to {self.topic} on {host}:{port}")
+        return True
+
+    def stop(self):
+        """Stop the network loop and disconnect."""
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        """(Re)subscribe on every connect; QoS 0 as advertisements are fire-and-forget."""
+        client.subscribe(self.topic, qos=0)
+
+    def on_message(self, client, userdata, message):
+        """Buffer a raw message. Runs on the MQTT network thread, so it does no decoding."""
+        SIGNAL_TEST.observe_message(message.topic, message.payload)
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((message.topic, message.payload))
+        self.received += 1
+
+    def drain(self):
+        """Decode everything buffered so far into gateway rows."""
+        rows = []
+        for _ in range(len(self.buffer)):
+            topic, payload = self.buffer.popleft()
+            try:
+                rows.extend(decode_mqtt_advertisement(topic, payload))
+            except (ValueError, TypeError, UnicodeDecodeError):
+                self.decode_errors += 1
+        return rows
+
+    def stats(self):
+        """Counters for the scan interval sensor."""
+        return {
+            "mqtt_received": self.received,
+            "mqtt_dropped": self.dropped,
+            "mqtt_decode_errors": self.decode_errors,
+            "mqtt_buffered": len(self.buffer)
+        }
+
+def signed_byte(value):
+    """A byte read as a signed 8-bit integer (RSSI and TX power)."""
+    return value - 256 if value > 127 else value
+
+def parse_advertising_data(data):
+    """
+    Decode the AD structures of an advertisement into a payload dict
+    (local name, manufacturer data, TX power and 16-bit service UUIDs).
+    """
+    adv = {}
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if length == 0 or offset + 1 + length > len(data):
+            break
+        ad_type = data[offset + 1]
+        value = data[offset + 2:offset + 1 + length]
+        offset += 1 + length
+
+        if ad_type in (0x08, 0x09):
+            adv["name"] = value.decode("utf-8", "replace")
+        elif ad_type == 0xFF and len(value) >= 2:
+            adv["manufacturer_id"] = int.from_bytes(value[:2], "little")
+            adv["manufacturer_data"] = value[2:].hex()
+        elif ad_type == 0x0A and value:
+            adv["tx_power"] = signed_byte(value[0])
+        elif ad_type in (0x02, 0x03):
+            adv["service_uuids"] = [f"{int.from_bytes(value[i:i+2], 'little'):04x}" for i in range(0, len(value) - 1, 2)]
+    return adv
+
+def decode_hci_advertising_reports(packet):
+    """
+    Decode an HCI event into (mac, rssi, advertisement data) tuples.
+    Handles LE Advertising Report and LE Extended Advertising Report; any
+    other event, or a truncated one, yields nothing.
+    """
+    if len(packet) < 4 or packet[0] != HCI_LE_META_EVENT:
+        return []
+    params = packet[2:2 + packet[1]]
+    subevent = params[0]
+    reports = []
+    offset = 2
+    try:
+        for _ in range(params[1]):
+            if subevent == LE_ADVERTISING_REPORT:
+                address = params[offset + 2:offset + 8]
+                data_length = params[offset + 8]
+                data = params[offset + 9:offset + 9 + data_length]
+                rssi = signed_byte(params[offset + 9 + data_length])
+                offset += 10 + data_length
+            elif subevent == LE_EXTENDED_ADVERTISING_REPORT:
+                address = params[offset + 3:offset + 9]
+                rssi = signed_byte(params[offset + 13])
+                data_length = params[offset + 23]
+                data = params[offset + 24:offset + 24 + data_length]
+                offset += 24 + data_length
+            else:
+                return []
+            if len(address) == 6 and rssi != RSSI_UNAVAILABLE:
+                reports.append((":".join(f"{b:02X}" for b in reversed(address)), rssi, data))
+    except IndexError:
+        pass
+    return reports
+
+def read_btsnoop(path):
+    """
+    Yield (unix timestamp, HCI event) for every HCI event in a btsnoop file.
+    Supports the HCI (1001), UART/H4 (1002) and btmon monitor (2001) datalinks.
+    """
+    # Only needed for capture replay, so kept out of startup
+    import struct
+
+    with open(path, "rb") as f:
+        header = f.read(16)
+        if len(header) < 16 or header[:8] != BTSNOOP_MAGIC:
+            raise ValueError(f"{path} is not a btsnoop capture")
+        datalink = struct.unpack(">I", header[12:16])[0]
+
+        while True:
+            record = f.read(24)
+            if len(record) < 24:
+                break
+            _, included_length, flags, _, timestamp = struct.unpack(">IIIIq", record)
+            packet = f.read(included_length)
+            if len(packet) < included_length:
+                break
+
+            if datalink == BTSNOOP_HCI_UART:
+                if not packet or packet[0] != HCI_EVENT_PACKET:
+                    continue
+                packet = packet[1:]
+            elif datalink == BTSNOOP_MONITOR:
+                if flags & 0xFFFF != 3:  # monitor opcode: event packet
+                    continue
+            elif datalink == BTSNOOP_HCI_UNENCAPSULATED:
+                if flags & 0x03 != 0x03:  # received command/event
+                    continue
+            else:
+                raise ValueError(f"Unsupported btsnoop datalink {datalink}")
+
+            yield (timestamp - BTSNOOP_EPOCH_OFFSET) / 1e6, packet
+
+class CaptureReplay:
+    """
+    Ingest source replaying the LE advertising reports of a btsnoop/btmon
+    capture as gateway rows. With speed 0 rows are released as fast as the
+    loop drains them (batch_size per drain); otherwise at the recorded
+    pacing scaled by speed. Rows carry the recorded time at index 5 so a
+    backfill keeps the original last_seen.
+    """
+
+    def __init__(self, path, speed=0.0, batch_size=MAX_ROWS_PER_CYCLE, source="capture"):
+        self.path = path
+        self.speed = speed
+        self.batch_size = batch_size
+        self.source = source
+        self.reader = None
+        self.pending = None
+        self.started_at = None
+        self.first_timestamp = None
+        self.replayed = 0
+        self.exhausted = False
+
+    def rows(self):
+        """Yield (unix timestamp, gateway row) for every advertising report in the capture."""
+        for timestamp, packet in read_btsnoop(self.path):
+            for mac, rssi, data in decode_hci_advertising_reports(packet):
+                adv = parse_advertising_data(data)
+                yield timestamp, [
+                    adv.get("name") or mac,
+                    mac,
+                    str(rssi),
+                    json.dumps(adv),
+                    self.source,
+                    {"last_seen": datetime.fromtimestamp(timestamp).isoformat()}
+                ]
+
+    def drain(self, now=None):
+        """Release the rows that are due: the next batch, or everything up to the paced capture time."""
+        if self.exhausted:
+            return []
+        now = time.monotonic() if now is None else now
+        if self.reader is None:
+            self.reader = self.rows()
+            self.started_at = now
+
+        rows = []
+        while self.speed > 0 or len(rows) < self.batch_size:
+            if self.pending is None:
+                self.pending = next(self.reader, None)
+                if self.pending is None:
+                    self.exhausted = True
+                    logging.info(f"Capture replay of {self.path} finished: {self.replayed} advertisements")
+                    break
+            timestamp, row = self.pending
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+            if self.speed > 0 and timestamp - self.first_timestamp > (now - self.started_at) * self.speed:
+                break
+            rows.append(row)
+            self.pending = None
+        self.replayed += len(rows)
+        return rows
+
+    def stats(self):
+        """Counters for the scan interval sensor."""
+        return {
+            "replay_advertisements": self.replayed,
+            "replay_finished": self.exhausted
+        }
+
 def create_ble_gateway_sensor():
     """
     Create a sensor entity for BLE gateway data if it doesn't exist.
@@ -233,8 +1213,8 @@ def create_ble_gateway_sensor():
         }
         
         # Check if sensor already exists
-        response = requests.get(
-            "http://supervisor/core/api/states/sensor.ble_gateway_raw_data",
+        response = supervisor_get(
+            "/states/sensor.ble_gateway_raw_data",
             headers=headers
         )
         
@@ -251,8 +1231,8 @@ def create_ble_gateway_sensor():
                 }
             }
             
-            create_response = requests.post(
-                "http://supervisor/core/api/states/sensor.ble_gateway_raw_data",
+            create_response = supervisor_post(
+                "/states/sensor.ble_gateway_raw_data",
                 headers=headers,
                 json=sensor_data
             )
@@ -292,8 +1272,8 @@ def register_bluetooth_scan_button():
                 }
             }
             
-            input_response = requests.post(
-                "http://supervisor/core/api/services/input_button/create",
+            input_response = supervisor_post(
+                "/services/input_button/create",
                 headers=headers,
                 json=input_button_data
             )
@@ -311,8 +1291,8 @@ def register_bluetooth_scan_button():
                             "icon": "mdi:bluetooth-search"
                         }
                     }
-                    requests.post(
-                        "http://supervisor/core/api/states/input_button.bluetooth_scan",
+                    supervisor_post(
+                        "/states/input_button.bluetooth_scan",
                         headers=headers,
                         json=state_data
                     )
@@ -323,8 +1303,8 @@ def register_bluetooth_scan_button():
             logging.warning(f"Error creating input_button: {e}")
         
         # Check if button.bluetooth_scan exists and create if not
-        response = requests.get(
-            "http://supervisor/core/api/states/button.bluetooth_scan",
+        response = supervisor_get(
+            "/states/button.bluetooth_scan",
             headers=headers
         )
         
@@ -339,8 +1319,8 @@ def register_bluetooth_scan_button():
                 "icon": "mdi:bluetooth-search"
             }
             
-            service_response = requests.post(
-                "http://supervisor/core/api/services/button/create",
+            service_response = supervisor_post(
+                "/services/button/create",
                 headers=headers,
                 json=create_data
             )
@@ -359,8 +1339,8 @@ def register_bluetooth_scan_button():
                     }
                 }
                 
-                state_response = requests.post(
-                    "http://supervisor/core/api/states/button.bluetooth_scan",
+                state_response = supervisor_post(
+                    "/states/button.bluetooth_scan",
                     headers=headers,
                     json=button_data
                 )
@@ -392,8 +1372,8 @@ def register_bluetooth_scan_button():
                 "name": "Bluetooth Scan"
             }
             
-            script_response = requests.post(
-                "http://supervisor/core/api/services/script/create",
+            script_response = supervisor_post(
+                "/services/script/create",
                 headers=headers,
                 json=script_data
             )
@@ -406,86 +1386,154 @@ def register_bluetooth_scan_button():
     except Exception as e:
         logging.error(f"Error registering Bluetooth scan button: {e}")
         
-def simulate_bluetooth_scan():
+class BluetoothctlScanner:
     """
-    Simulate a Bluetooth scan by searching for Bluetooth devices via shell commands.
-    Returns a list of simulated device entries.
+    Long-lived bluetoothctl session for the local-scan fallback.
+    Scanning is switched on once and stdout is parsed incrementally by a
+    reader thread as a stream of [NEW]/[CHG]/[DEL] Device events, so RSSI
+    values are real and no process is spawned per scan.
     """
-    logging.info("Simulating Bluetooth scan")
-    
-    # This is a fallback when no real Bluetooth data is available
-    # Try to use hcitool or bluetoothctl to scan for devices if available
-    try:
-        import subprocess
-        import re
-        
-        # Try using hcitool
-        try:
-            output = subprocess.check_output(["hcitool", "scan"], timeout=10).decode('utf-8')
-            devices = []
-            
-            # Parse output like: "00:11:22:33:44:55 Device Name"
-            for line in output.splitlines():
-                match = re.search(r'([0-9A-F:]{17})\s+(.+)', line)
-                if match:
-                    mac = match.group(1)
-                    name = match.group(2)
-                    # Simulate RSSI between -50 and -90
-                    import random
-                    rssi = random.randint(-90, -50)
-                    
-                    devices.append([name, mac, str(rssi), "{}"])
-            
-            if devices:
-                logging.info(f"Found {len(devices)} devices using hcitool")
-                return devices
-                
-        except (subprocess.SubprocessError, FileNotFoundError):
-            logging.info("hcitool not available or failed")
-        
-        # Try bluetoothctl as fallback
+
+    def __init__(self, command=None, restart_delay=LOCAL_SCAN_RESTART_DELAY):
+        self.command = command or ["bluetoothctl"]
+        self.restart_delay = restart_delay
+        self.process = None
+        self.reader = None
+        self.started_at = None
+        self.lock = threading.Lock()
+        self.devices = {}  # mac -> {"name", "rssi", "last_seen"}
+        self.events = 0
+
+    def start(self):
+        """Spawn the scanner process and start reading its output."""
         try:
-            # Start bluetoothctl, enable scanning
-            process = subprocess.Popen(
-                ["bluetoothctl"],
+            self.process = subprocess.Popen(
+                self.command,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stderr=subprocess.DEVNULL,
+                text=True,
+                bufsize=1
             )
-            
-            # Send commands to bluetoothctl
-            commands = "scan on\nsleep 5\ndevices\nscan off\nquit\n"
-            output, _ = process.communicate(commands, timeout=15)
-            
-            devices = []
-            # Parse output like: "Device 00:11:22:33:44:55 Name"
-            for line in output.splitlines():
-                match = re.search(r'Device\s+([0-9A-F:]{17})\s+(.+)', line)
-                if match:
-                    mac = match.group(1)
-                    name = match.group(2)
-                    # Simulate RSSI
-                    import random
-                    rssi = random.randint(-90, -50)
-                    
-                    devices.append([name, mac, str(rssi), "{}"])
-            
-            if devices:
-                logging.info(f"Found {len(devices)} devices using bluetoothctl")
-                return devices
-                
-        except (subprocess.SubprocessError, FileNotFoundError):
-            logging.info("bluetoothctl not available or failed")
-            
-    except Exception as e:
-        logging.error(f"Error in Bluetooth simulation: {e}")
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.info(f"Local Bluetooth scanner not available: {e}")
+            self.process = None
+            return False
+
+        self.started_at = time.monotonic()
+        try:
+            self.process.stdin.write("scan on\n")
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            pass
+
+        self.reader = threading.Thread(target=self.read_output, args=(self.process.stdout,), daemon=True)
+        self.reader.start()
+        logging.info(f"Started persistent local Bluetooth scanner: {' '.join(self.command)}")
+        return True
+
+    def read_output(self, stream):
+        """Reader thread: parse lines until the process exits."""
+        for line in stream:
+            self.handle_line(line)
+
+    def handle_line(self, line, now=None):
+        """Apply one line of bluetoothctl output."""
+        match = BLUETOOTHCTL_EVENT.search(ANSI_ESCAPE.sub("", line).replace("\r", ""))
+        if not match:
+            return
+        event, mac, detail = match.group(1), match.group(2).upper(), match.group(3).strip()
+        now = time.monotonic() if now is None else now
+
+        with self.lock:
+            self.events += 1
+            if event == "DEL":
+                self.devices.pop(mac, None)
+                return
+
+            device = self.devices.setdefault(mac, {"name": None, "rssi": None, "last_seen": now})
+            device["last_seen"] = now
+            rssi = BLUETOOTHCTL_RSSI.match(detail)
+            if rssi:
+                device["rssi"] = int(rssi.group(1))
+                if mac == SIGNAL_TEST.target:
+                    SIGNAL_TEST.observe(mac, device["rssi"], "local", now)
+            elif detail.startswith(("Name:", "Alias:")):
+                device["name"] = detail.split(":", 1)[1].strip()
+            elif event == "NEW" and detail and device["name"] is None:
+                device["name"] = detail
+
+    def alive(self):
+        """True while the scanner process is running."""
+        return self.process is not None and self.process.poll() is None
+
+    def ensure_running(self):
+        """Restart the scanner if it exited, at most once per restart delay."""
+        if self.alive():
+            return True
+        if self.started_at is not None and time.monotonic() - self.started_at < self.restart_delay:
+            return False
+        return self.start()
+
+    def rows(self, max_age=LOCAL_SCAN_MAX_AGE, now=None):
+        """Gateway rows for devices with an RSSI seen within max_age seconds."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            snapshot = list(self.devices.items())
+        return [
+            [
+                device["name"] or mac,
+                mac,
+                str(device["rssi"]),
+                json.dumps({"name": device["name"]}) if device["name"] else "{}",
+                "local"
+            ]
+            for mac, device in snapshot
+            if device["rssi"] is not None and now - device["last_seen"] <= max_age
+        ]
+
+    def stop(self):
+        """Stop scanning and terminate the process."""
+        if self.alive():
+            try:
+                self.process.stdin.write("scan off\nquit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+def get_local_scanner(start=True):
+    """
+    Return the shared local scanner session, starting it on first use.
+    Returns None if no scanner is running and start is False or fails.
+    """
+    scanner = getattr(get_local_scanner, "scanner", None)
+    if scanner is None:
+        if not start:
+            return None
+        scanner = BluetoothctlScanner()
+        if not scanner.start():
+            return None
+        get_local_scanner.scanner = scanner
+    elif not scanner.ensure_running():
+        return None
+    return scanner
+
+def simulate_bluetooth_scan():
+    """
+    Fallback scan using the local Bluetooth adapter when no integration is available.
+    Returns gateway rows with real RSSI values from the persistent bluetoothctl session.
+    """
+    logging.info("Using local Bluetooth scanner")
     
-    # Return a few simulated devices if nothing else worked
-    return [
-        ["Simulated Device 1", "AA:BB:CC:11:22:33", "-65", "{}"],
-        ["Simulated Device 2", "DD:EE:FF:44:55:66", "-78", "{}"]
-    ]
+    scanner = get_local_scanner()
+    if scanner is None:
+        return []
+    
+    devices = scanner.rows()
+    if devices:
+        logging.info(f"Found {len(devices)} devices using bluetoothctl")
+    return devices
 
 def process_ble_gateway_data(gateway_devices):
     """
@@ -877,6 +1925,15 @@ def process_ble_gateway_data(gateway_devices):
                     "last_seen": datetime.now().isoformat()
                 }
                 
+                # Coalesced rows carry advertisement statistics at index 5,
+                # replayed rows their recorded time
+                if len(device) > 5 and isinstance(device[5], dict):
+                    if "count" in device[5]:
+                        device_entry["adv_count"] = device[5]["count"]
+                        device_entry["rssi_mean"] = device[5].get("rssi_mean", rssi)
+                    if "last_seen" in device[5]:
+                        device_entry["last_seen"] = device[5]["last_seen"]
+                
                 processed_devices.append(device_entry)
     
     except Exception as e:
@@ -899,8 +1956,8 @@ def trigger_bluetooth_scan():
         
         # Try to use the bluetooth integration's scan service first
         try:
-            scan_response = requests.post(
-                "http://supervisor/core/api/services/bluetooth/start_discovery",
+            scan_response = supervisor_post(
+                "/services/bluetooth/start_discovery",
                 headers=headers,
                 json={}
             )
@@ -915,8 +1972,8 @@ def trigger_bluetooth_scan():
         # Try input_button if available
         if not success:
             try:
-                input_button_response = requests.post(
-                    "http://supervisor/core/api/services/input_button/press",
+                input_button_response = supervisor_post(
+                    "/services/input_button/press",
                     headers=headers,
                     json={"entity_id": "input_button.bluetooth_scan"}
                 )
@@ -930,8 +1987,8 @@ def trigger_bluetooth_scan():
         # Try regular button if available
         if not success:
             try:
-                button_response = requests.post(
-                    "http://supervisor/core/api/services/button/press",
+                button_response = supervisor_post(
+                    "/services/button/press",
                     headers=headers,
                     json={"entity_id": "button.bluetooth_scan"}
                 )
@@ -945,8 +2002,8 @@ def trigger_bluetooth_scan():
         # Try script if available
         if not success:
             try:
-                script_response = requests.post(
-                    "http://supervisor/core/api/services/script/turn_on",
+                script_response = supervisor_post(
+                    "/services/script/turn_on",
                     headers=headers,
                     json={"entity_id": "script.bluetooth_scan"}
                 )
@@ -972,8 +2029,8 @@ def trigger_bluetooth_scan():
                     }
                 }
                 
-                requests.post(
-                    "http://supervisor/core/api/states/sensor.ble_gateway_raw_data",
+                supervisor_post(
+                    "/states/sensor.ble_gateway_raw_data",
                     headers=headers,
                     json=sensor_data
                 )
@@ -1001,8 +2058,8 @@ def update_ha_input_text(entity_id, value):
             "value": value
         }
         
-        response = requests.post(
-            "http://supervisor/core/api/services/input_text/set_value",
+        response = supervisor_post(
+            "/services/input_text/set_value",
             headers=headers,
             json=payload 
         )
@@ -1017,70 +2074,573 @@ def update_ha_input_text(entity_id, value):
         logging.error(f"Error updating input_text: {e}")
         return False
 
-def discover_ble_devices(force_scan=False):
+def gateway_rssi_samples(gateway_devices):
     """
-    Discover BLE devices using the BLE gateway.
-    Optionally trigger a fresh scan.
+    Yield (mac, rssi) pairs from raw gateway rows.
     """
-    # Trigger a new scan if requested
-    if force_scan:
-        logging.info("Triggering Bluetooth scan...")
-        scan_success = trigger_bluetooth_scan()
+    for device in gateway_devices:
+        if len(device) >= 3 and device[1]:
+            try:
+                yield device[1], int(device[2])
+            except (TypeError, ValueError):
+                continue
+
+def update_device_rooms(changes, index, room_engine, tracked_devices=None):
+    """
+    Store room changes on the discovered devices and publish the room sensors.
+    """
+    for mac, room in changes.items():
+        if mac in index:
+            index[mac]["room"] = room
+    publish_room_sensors(changes, index, room_engine, tracked_devices)
+
+def build_new_device_message(devices, max_devices=NOTIFY_MAX_DEVICES, max_length=NOTIFY_MAX_LENGTH, total=None):
+    """
+    Build the new-device notification, capped at max_devices lines and
+    max_length characters with a "+N more" summary. total counts devices
+    that were discovered but not passed in.
+    """
+    total = len(devices) if total is None else total
+    lines = []
+    length = 0
+    for device in devices[:max_devices]:
+        line = f"- {device['mac_address']} (RSSI: {device['rssi']} dBm)"
+        if length + len(line) > max_length:
+            break
+        lines.append(line)
+        length += len(line) + 1
+
+    message = f"Discovered {total} new BLE devices:\n\n" + "\n".join(lines) + "\n"
+    if total > len(lines):
+        message += f"+{total - len(lines)} more\n"
+    message += "\nGo to the BLE Dashboard to manage devices."
+    return message
+
+class NewDeviceNotifier:
+    """
+    Debounced new-device notifications.
+    New devices are collected over a window and announced in a single
+    notification; devices that were already announced are skipped.
+    """
+
+    def __init__(self, window=NOTIFY_DEBOUNCE_WINDOW, announced=None):
+        self.window = window
+        self.announced = set(announced or [])
+        self.pending = {}
+        self.unlisted = 0  # pending devices shed under pressure, only counted
+        self.window_start = None
+        self.last_sent = None
+        self.sent = 0
+
+    def add(self, devices, now=None):
+        """Queue new devices; the first one opens the debounce window."""
+        now = time.monotonic() if now is None else now
+        for device in devices:
+            mac = device["mac_address"]
+            if mac in self.announced or mac in self.pending:
+                continue
+            if self.window_start is None:
+                self.window_start = now
+            self.pending[mac] = device
+
+    def shed(self, limit):
+        """
+        Keep the strongest limit pending devices; the rest are only counted
+        in the notification. Returns the number of devices shed.
+        """
+        excess = len(self.pending) - limit
+        if excess <= 0:
+            return 0
+        kept = heapq.nlargest(limit, self.pending.values(), key=lambda d: d.get("rssi", -100))
+        self.pending = {device["mac_address"]: device for device in kept}
+        self.unlisted += excess
+        return excess
+
+    def flush(self, now=None):
+        """Send one notification for the pending devices once the window has elapsed."""
+        now = time.monotonic() if now is None else now
+        if not self.pending or now - self.window_start < self.window:
+            return False
+        if self.last_sent is not None and now - self.last_sent < self.window:
+            return False
+
+        devices = sorted(self.pending.values(), key=lambda d: d.get("rssi", -100), reverse=True)
+        if not create_home_assistant_notification(
+            "BLE Device Discovery",
+            build_new_device_message(devices, total=len(devices) + self.unlisted),
+            "ble_discovery"
+        ):
+            # Keep the batch and retry on the next flush
+            return False
+        self.announced.update(self.pending)
+        self.pending = {}
+        self.unlisted = 0
+        self.window_start = None
+        self.last_sent = now
+        self.sent += 1
+        return True
+
+class DeviceViews:
+    """
+    Precomputed device views for scripts and the dashboard: the strongest
+    devices currently in range, overall, per device type and per room, and
+    the most recently discovered ones. Sighted devices are kept in lists
+    sorted by RSSI and moved with a bisection when they change, so a cycle
+    costs a few list operations per changed device instead of sorting the
+    whole store; devices not sighted for stale_after seconds drop out.
+    The devices passed in only seed the recent discoveries.
+    """
+
+    def __init__(self, devices=(), top_n=VIEWS_TOP_N, group_n=VIEWS_GROUP_N, recent_n=VIEWS_RECENT_N,
+                 stale_after=DEVICE_STALE_AFTER):
+        self.top_n = top_n
+        self.group_n = group_n
+        self.stale_after = stale_after
+        # MAC -> (sort key, device type, room) as currently filed
+        self.entries = {}
+        # MAC -> monotonic time of the last sighting, oldest first
+        self.seen = {}
+        self.by_rssi = []
+        self.by_type = {}
+        self.by_room = {}
+        self.recent = deque(maxlen=recent_n)
+        self.changed = False
+        self.add_new(sorted(devices, key=lambda d: d.get("discovered_at") or ""))
+
+    @staticmethod
+    def remove(items, key):
+        position = bisect.bisect_left(items, key)
+        if position < len(items) and items[position] == key:
+            del items[position]
+
+    def file(self, mac, entry, add):
+        """Insert (add=True) or remove a device's key in the overall, type and room lists."""
+        key, device_type, room = entry
+        lists = [self.by_rssi, self.by_type.setdefault(device_type, [])]
+        if room and room != ROOM_AWAY:
+            lists.append(self.by_room.setdefault(room, []))
+        for items in lists:
+            if add:
+                bisect.insort(items, key)
+            else:
+                self.remove(items, key)
+        for groups, name in ((self.by_type, device_type), (self.by_room, room)):
+            if name in groups and not groups[name]:
+                del groups[name]
+
+    def update(self, devices, now=None):
+        """Record sightings and re-file devices whose RSSI, type or room changed."""
+        now = time.monotonic() if now is None else now
+        for device in devices:
+            mac = device["mac_address"]
+            self.seen.pop(mac, None)
+            self.seen[mac] = now
+            # Strongest first; the MAC breaks ties so keys are unique
+            entry = ((-device.get("rssi", -100), mac), device.get("device_type") or "Unknown", device.get("room"))
+            previous = self.entries.get(mac)
+            if previous == entry:
+                continue
+            if previous is not None:
+                self.file(mac, previous, False)
+            self.file(mac, entry, True)
+            self.entries[mac] = entry
+            self.changed = True
+
+    def add_new(self, devices):
+        """Record newly discovered devices, newest last."""
+        for device in devices:
+            self.recent.append(device["mac_address"])
+            self.changed = True
+
+    def expire(self, last_seen=None, now=None):
+        """
+        Drop devices not sighted for stale_after seconds. last_seen (upper-case
+        MAC -> monotonic time, as kept by the DeviceScheduler) also counts
+        sightings of devices that were not due this cycle.
+        """
+        now = time.monotonic() if now is None else now
+        while self.seen:
+            mac, seen = next(iter(self.seen.items()))
+            if now - seen <= self.stale_after:
+                break
+            del self.seen[mac]
+            latest = last_seen.get(mac.upper()) if last_seen is not None else None
+            if latest is not None and now - latest <= self.stale_after:
+                self.seen[mac] = latest
+                continue
+            self.forget([mac])
+
+    def forget(self, macs):
+        for mac in macs:
+            self.seen.pop(mac, None)
+            entry = self.entries.pop(mac, None)
+            if entry is not None:
+                self.file(mac, entry, False)
+                self.changed = True
+
+    def attributes(self, index):
+        """The views as sensor attributes; names are read from the index so renames show."""
+        def describe(keys, limit):
+            rows = []
+            for _, mac in itertools.islice(keys, limit):
+                device = index.get(mac, {})
+                rows.append({
+                    "mac": mac,
+                    "name": device.get("name", mac),
+                    "rssi": device.get("rssi", -100),
+                    "type": device.get("device_type"),
+                    "room": device.get("room")
+                })
+            return rows
+
+        return {
+            "top": describe(self.by_rssi, self.top_n),
+            "new": describe(((None, mac) for mac in reversed(self.recent) if mac in index), self.recent.maxlen),
+            "by_type": {name: describe(keys, self.group_n) for name, keys in sorted(self.by_type.items())},
+            "by_room": {name: describe(keys, self.group_n) for name, keys in sorted(self.by_room.items())},
+            "type_counts": {name: len(keys) for name, keys in sorted(self.by_type.items())}
+        }
+
+    def publish(self, index, headers=None):
+        """Post the views sensor when anything changed since the last publish."""
+        if not self.changed:
+            return False
+        headers = headers or {
+            "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+            "Content-Type": "application/json"
+        }
+        try:
+            response = supervisor_post(
+                f"/states/{VIEWS_ENTITY}",
+                headers=headers,
+                json={
+                    "state": len(self.entries),
+                    "attributes": {
+                        "friendly_name": "BLE Device Views",
+                        "icon": "mdi:sort-descending",
+                        "unit_of_measurement": "devices",
+                        **self.attributes(index)
+                    }
+                }
+            )
+            if response.status_code < 200 or response.status_code >= 300:
+                logging.error(f"Error updating {VIEWS_ENTITY}: {response.status_code}")
+                return False
+        except Exception as e:
+            logging.error(f"Error publishing device views: {e}")
+            return False
+        self.changed = False
+        return True
+
+class PhaseHistogram:
+    """
+    Rolling histogram over the last `window` samples of one phase.
+    Bucket counts give p50/p95 without sorting; the samples are kept in a
+    ring so the oldest one can be taken out of its bucket and for the max.
+    """
+
+    def __init__(self, window=PERF_WINDOW, bounds=PERF_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.samples = array('d', [0.0] * window)
+        self.buckets = array('B', [0] * window)
+        self.position = 0
+        self.size = 0
+
+    def add(self, value):
+        """Record a sample, evicting the oldest one once the window is full."""
+        if self.size == len(self.samples):
+            self.counts[self.buckets[self.position]] -= 1
+        else:
+            self.size += 1
+        bucket = bisect.bisect_left(self.bounds, value)
+        self.counts[bucket] += 1
+        self.samples[self.position] = value
+        self.buckets[self.position] = bucket
+        self.position = (self.position + 1) % len(self.samples)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (the max for the last bucket)."""
+        if not self.size:
+            return None
+        rank = max(1, math.ceil(q * self.size))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bounds[bucket], self.max()) if bucket < len(self.bounds) else self.max()
+
+    def max(self):
+        return max(self.samples[:self.size]) if self.size else None
+
+class CyclePerformance:
+    """
+    Per-phase timing of the discovery cycle.
+    mark(phase) charges the time since the previous mark to that phase, so
+    each phase is timed by one monotonic clock read at its end. Phases that
+    run more than once in a cycle accumulate.
+    """
+
+    def __init__(self, phases=PERF_PHASES, window=PERF_WINDOW):
+        self.histograms = {phase: PhaseHistogram(window) for phase in ["cycle"] + list(phases)}
+        self.current = dict.fromkeys(phases, 0.0)
+        self.cycle_start = None
+        self.last_mark = None
+        self.last_cycle = None
+        self.cycles = 0
+
+    def begin_cycle(self):
+        self.cycle_start = self.last_mark = time.monotonic()
+        for phase in self.current:
+            self.current[phase] = 0.0
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.current[phase] += now - self.last_mark
+        self.last_mark = now
+
+    def end_cycle(self):
+        """Record the cycle's phase times into the rolling histograms."""
+        self.last_cycle = time.monotonic() - self.cycle_start
+        self.histograms["cycle"].add(self.last_cycle)
+        for phase, elapsed in self.current.items():
+            self.histograms[phase].add(elapsed)
+        self.cycles += 1
+
+    def stats(self):
+        """p50/p95/max per phase in milliseconds."""
+        attributes = {}
+        for phase, histogram in self.histograms.items():
+            for name, value in (("p50", histogram.percentile(0.5)), ("p95", histogram.percentile(0.95)),
+                                ("max", histogram.max())):
+                attributes[f"{phase}_{name}_ms"] = round(value * 1000, 1) if value is not None else None
+        return attributes
+
+    def publish(self, headers, extra=None):
+        """Publish the rolling timings (and any extra attributes) to sensor.ble_discovery_performance."""
+        try:
+            supervisor_post(
+                "/states/sensor.ble_discovery_performance",
+                headers=headers,
+                json={
+                    "state": round(self.last_cycle * 1000, 1) if self.last_cycle is not None else None,
+                    "attributes": {
+                        "friendly_name": "BLE Discovery Performance",
+                        "icon": "mdi:speedometer",
+                        "unit_of_measurement": "ms",
+                        "cycles": self.cycles,
+                        "window": len(self.histograms["cycle"].samples),
+                        **self.stats(),
+                        **(extra or {})
+                    }
+                }
+            )
+        except Exception as e:
+            logging.debug("Error updating performance sensor: %s", e)
+
+def discovery_store():
+    """The in-memory discovery store, MAC index and published RSSI map, loaded on first use."""
+    if not hasattr(discover_ble_devices, "discoveries"):
+        discover_ble_devices.discoveries = load_discoveries()
+        discover_ble_devices.index = {d["mac_address"]: d for d in discover_ble_devices.discoveries}
+        discover_ble_devices.current_rssi = {}
+    return discover_ble_devices.discoveries, discover_ble_devices.index, discover_ble_devices.current_rssi
+
+def discover_ble_devices(force_scan=False, scheduler=None, rssi_filter=None, rssi_matrix=None,
+                         room_engine=None, room_devices=None, mqtt_ingest=None, coalescer=None,
+                         load_shedder=None, notifier=None, capture_replay=None, perf=None, device_views=None):
+    """
+    Discover BLE devices using the BLE gateway.
+    Optionally trigger a fresh scan. With an RssiMatrix, sightings from all
+    proxies are merged and each device uses its nearest proxy's RSSI. With
+    a DeviceScheduler, only devices that are due are processed, persisted
+    and published. With an RssiFilter, every sighting updates the smoothed
+    RSSI of its device. With a RoomPresenceEngine (requires the matrix),
+    every tracked device is placed in a room and room sensors are published.
+    With an MqttIngest, advertisements received over MQTT since the last
+    call are added to the gateway data, collapsed per device by the
+    AdvertisementCoalescer when one is given. With a LoadShedder, the rows
+    processed per cycle are capped (new devices are never shed), and under
+    pressure registered devices and pending notifications are cut to the
+    strongest. With a
+    NewDeviceNotifier, new devices are announced in debounced batches.
+    With a CaptureReplay, every advertisement from a btsnoop capture is
+    merged, bypassing the coalescer, matrix and scheduler. With a CyclePerformance, the time
+    of each phase is charged to it. With DeviceViews, the changed devices
+    are re-filed and the views sensor is published.
+    """
+    mark = perf.mark if perf is not None else (lambda phase: None)
+
+    # Trigger a new scan if requested
+    if force_scan:
+        logging.info("Triggering Bluetooth scan...")
+        scan_success = trigger_bluetooth_scan()
         if scan_success:
             # Wait for scan to complete
             time.sleep(5)
         else:
             logging.warning("Failed to trigger Bluetooth scan")
     
+    # Load previous discoveries once and keep them in memory, indexed by MAC
+    discoveries, index, _ = discovery_store()
+    
     # Get current devices from gateway
     gateway_devices = get_ble_gateway_data()
+    SIGNAL_TEST.observe_rows(gateway_devices)
+    local_scanner = get_local_scanner(start=False)
+    if local_scanner is not None:
+        # Read the scanner directly; drop stale copies echoed through the raw-data sensor
+        gateway_devices = [row for row in gateway_devices if len(row) < 5 or row[4] != "local"]
+        gateway_devices.extend(local_scanner.rows())
+    replayed = capture_replay.drain() if capture_replay is not None else []
+    if mqtt_ingest is not None:
+        pushed = mqtt_ingest.drain()
+        if coalescer is not None:
+            coalescer.add(pushed)
+            if coalescer.ready():
+                coalesced = coalescer.flush()
+                gateway_devices.extend(coalesced)
+                # Advertisements folded into an existing entry count as hits
+                METRICS.cache_lookups.labels("coalescer", "miss").inc(len(coalesced))
+                METRICS.cache_lookups.labels("coalescer", "hit").inc(sum(row[5]["count"] - 1 for row in coalesced))
+        else:
+            gateway_devices.extend(pushed)
+    mark("gateway_fetch")
+    if load_shedder is not None:
+        gateway_devices = load_shedder.limit_rows(gateway_devices, index)
+    if rssi_matrix is not None:
+        gateway_devices = rssi_matrix.best_rows(rssi_matrix.merge(gateway_devices))
+        room_changes = room_engine.update(rssi_matrix) if room_engine is not None else {}
+    if rssi_filter is not None:
+        rssi_filter.update(gateway_rssi_samples(gateway_devices))
+    if scheduler is not None:
+        gateway_devices = scheduler.select_due(gateway_devices)
+    if replayed:
+        # Every replayed sighting is merged with its recorded time: the coalescer,
+        # matrix and scheduler pace by the wall clock and would drop most of a fast replay
+        if rssi_filter is not None:
+            rssi_filter.update(gateway_rssi_samples(replayed))
+        gateway_devices.extend(replayed)
+    mark("aggregate")
     processed_devices = process_ble_gateway_data(gateway_devices)
+    mark("parse")
+    if rssi_filter is not None:
+        rssi_filter.annotate(processed_devices)
+    if rssi_matrix is not None:
+        rssi_matrix.annotate(processed_devices)
+    if room_engine is not None:
+        room_engine.annotate(processed_devices)
+    mark("classify")
+    METRICS.devices_seen.labels().set(len(processed_devices))
+    CYCLE_TRACE.count(rows=len(gateway_devices), devices=len(processed_devices))
+    
+    # Registered devices are republished every cycle, so presence turns off when they leave
+    registered = [d for d in discoveries if d.get("registered")]
+    stale_after = scheduler.stale_after if scheduler is not None else DEVICE_STALE_AFTER
+    if load_shedder is not None:
+        # Under pressure only the strongest are posted; the others keep their
+        # unposted changes, which go out once the loop catches up
+        registered = load_shedder.limit_publish(registered)
     
-    # Load previous discoveries
-    discoveries = load_discoveries()
+    # Nothing is due this tick, but room changes and registered devices are still published
+    if not processed_devices:
+        if registered:
+            publish_registered_devices(registered, stale_after=stale_after)
+        if room_engine is not None and rssi_matrix is not None:
+            update_device_rooms(room_changes, index, room_engine, room_devices)
+        if device_views is not None:
+            if room_engine is not None and rssi_matrix is not None:
+                device_views.update(index[mac] for mac in room_changes if mac in device_views.entries)
+            device_views.expire(scheduler.last_seen if scheduler is not None else None)
+            device_views.publish(index)
+        mark("publish")
+        return discoveries
     
-    # Flag to track if we found new devices
-    new_devices_found = False
+    # Track the devices found for the first time
+    new_devices = []
+    debug = device_log.isEnabledFor(logging.DEBUG)
     
     # Update existing devices and add new ones
     for device in processed_devices:
         device_mac = device["mac_address"]
         
         # Check if this is a new device
-        existing_device = next((d for d in discoveries if d["mac_address"] == device_mac), None)
+        existing_device = index.get(device_mac)
+        if debug:
+            device_log.debug("%s %s rssi=%s proxy=%s", "Updated" if existing_device else "New",
+                             device_mac, device["rssi"], device.get("nearest_proxy"))
         
         if existing_device:
             # Update existing device
             existing_device["rssi"] = device["rssi"]
             existing_device["last_seen"] = device["last_seen"]
             existing_device["adv_data"] = device["adv_data"]
+            for field in OPTIONAL_DEVICE_FIELDS:
+                if field in device:
+                    existing_device[field] = device[field]
         else:
             # Add new device
             device["id"] = str(uuid.uuid4())
-            device["discovered_at"] = datetime.now().isoformat()
+            device["discovered_at"] = device["last_seen"]
             device["name"] = f"BLE Device {device_mac[-6:]}"
             discoveries.append(device)
-            new_devices_found = True
+            index[device_mac] = device
+            new_devices.append(device)
+    
+    mark("merge")
+    METRICS.new_devices.labels().inc(len(new_devices))
+    METRICS.devices_known.labels().set(len(discoveries))
+    CYCLE_TRACE.count(new=len(new_devices), known=len(discoveries))
+    METRICS.cache_lookups.labels("device_index", "hit").inc(len(processed_devices) - len(new_devices))
+    METRICS.cache_lookups.labels("device_index", "miss").inc(len(new_devices))
+    
+    # Record room changes, including rooms of devices that were just added
+    if room_engine is not None and rssi_matrix is not None:
+        update_device_rooms(room_changes, index, room_engine, room_devices)
+        mark("publish")
     
     # Save updated discoveries
     save_discoveries(discoveries)
+    mark("persist")
     
     # Create a simple map of MAC to RSSI for the input_text
-    mac_to_rssi = {d["mac_address"]: d["rssi"] for d in processed_devices}
+    if scheduler is not None:
+        # Devices that were not due keep their last published RSSI
+        mac_to_rssi = discover_ble_devices.current_rssi
+        mac_to_rssi.update((d["mac_address"], d["rssi"]) for d in processed_devices)
+        now = time.monotonic()
+        last_seen = scheduler.last_seen
+        for mac in [m for m in mac_to_rssi
+                    if m.upper() not in last_seen or now - last_seen[m.upper()] > scheduler.stale_after]:
+            del mac_to_rssi[mac]
+    else:
+        mac_to_rssi = {d["mac_address"]: d["rssi"] for d in processed_devices}
     update_ha_input_text("input_text.discovered_ble_devices", json.dumps(mac_to_rssi))
+    if registered:
+        publish_registered_devices(registered, stale_after=stale_after)
+    if device_views is not None:
+        device_views.update(index[d["mac_address"]] for d in processed_devices)
+        if room_engine is not None and rssi_matrix is not None:
+            device_views.update(index[mac] for mac in room_changes if mac in device_views.entries)
+        device_views.expire(scheduler.last_seen if scheduler is not None else None)
+        device_views.add_new(new_devices)
+        device_views.publish(index)
+    mark("publish")
     
     # Create notification for new devices
-    if new_devices_found:
-        notification_message = f"Discovered {len(processed_devices)} BLE devices:\n\n"
-        for device in processed_devices:
-            notification_message += f"- {device['mac_address']} (RSSI: {device['rssi']} dBm)\n"
-        notification_message += "\nGo to the BLE Dashboard to manage devices."
-        
-        create_home_assistant_notification(
-            "BLE Device Discovery",
-            notification_message,
-            "ble_discovery"
-        )
+    if new_devices:
+        if notifier is not None:
+            # Debounced: collected and sent at most once per window
+            notifier.add(new_devices)
+            if load_shedder is not None:
+                load_shedder.limit_notifications(notifier)
+        else:
+            create_home_assistant_notification(
+                "BLE Device Discovery",
+                build_new_device_message(new_devices),
+                "ble_discovery"
+            )
+        mark("notify")
     
     return discoveries
 
@@ -1130,8 +2690,8 @@ def check_input_text_exists(entity_id):
         }
         
         # Check if entity exists
-        response = requests.get(
-            f"http://supervisor/core/api/states/{entity_id}",
+        response = supervisor_get(
+            f"/states/{entity_id}",
             headers=headers
         )
         
@@ -1154,8 +2714,8 @@ def check_input_text_exists(entity_id):
                 }
             
             # Create entity
-            create_response = requests.post(
-                "http://supervisor/core/api/services/input_text/create",
+            create_response = supervisor_post(
+                "/services/input_text/create",
                 headers=headers,
                 json={"entity_id": entity_id, **config}
             )
@@ -1184,6 +2744,286 @@ def setup_required_entities():
     for entity_id in required_entities:
         check_input_text_exists(entity_id)
 
+def process_rss():
+    """Resident set size of the add-on process in bytes, or None if unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def deep_size(obj, depth=3):
+    """Approximate size in bytes of an object and what it holds, a few levels deep."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, depth - 1) + deep_size(v, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(item, depth - 1) for item in obj)
+    return size
+
+def estimate_size(container, sample=MEMORY_SIZE_SAMPLE):
+    """Estimated bytes of a large container, extrapolated from a sample of its entries."""
+    count = len(container)
+    if not count:
+        return sys.getsizeof(container)
+    if isinstance(container, dict):
+        sizes = [deep_size(k) + deep_size(container[k]) for k in itertools.islice(container, sample)]
+    else:
+        sizes = [deep_size(entry) for entry in itertools.islice(container, sample)]
+    return int(sys.getsizeof(container) + sum(sizes) / len(sizes) * count)
+
+class MemoryAccountant:
+    """
+    Periodic memory accounting for the long-lived structures of the loop.
+    Reports entry counts, estimated bytes and the process RSS. The soft
+    limit applies to the measured bytes of the evictable structures, not
+    the RSS, which CPython rarely lowers after freeing memory; above it,
+    picks the least valuable devices to evict: the ones not seen for
+    longest, never protected or recently seen ones.
+    """
+
+    def __init__(self, soft_limit_mb=0, check_cycles=MEMORY_CHECK_CYCLES,
+                 evict_fraction=MEMORY_EVICT_FRACTION, keep_recent=MEMORY_KEEP_RECENT):
+        self.soft_limit = soft_limit_mb * 1024 * 1024
+        self.check_cycles = check_cycles
+        self.evict_fraction = evict_fraction
+        self.keep_recent = keep_recent
+        self.cycles = 0
+        self.report = {}
+        self.rss = None
+        self.tracked = 0
+        self.evicted = 0
+        self.exhausted = False
+
+    def due(self):
+        """True every check_cycles cycles."""
+        self.cycles += 1
+        return self.cycles % self.check_cycles == 1 or self.check_cycles == 1
+
+    def account(self, structures, rss=None, evictable=None):
+        """
+        Measure the given {name: container} structures and the process RSS.
+        Only the structures named in evictable (all by default) count
+        towards the soft limit.
+        """
+        rss = process_rss() if rss is None else rss
+        report = {}
+        total = 0
+        tracked = 0
+        for name, container in structures.items():
+            size = estimate_size(container)
+            report[f"memory_{name}_entries"] = len(container)
+            report[f"memory_{name}_kib"] = round(size / 1024, 1)
+            total += size
+            if evictable is None or name in evictable:
+                tracked += size
+        report["memory_total_mib"] = round(total / 1024 / 1024, 2)
+        report["memory_tracked_mib"] = round(tracked / 1024 / 1024, 2)
+        report["memory_rss_mib"] = round(rss / 1024 / 1024, 2) if rss is not None else None
+        report["memory_soft_limit_mib"] = self.soft_limit // 1024 // 1024 or None
+        report["memory_evicted_devices"] = self.evicted
+        self.report = report
+        self.rss = rss
+        self.tracked = tracked
+        return report
+
+    def over_limit(self):
+        return bool(self.soft_limit) and self.tracked > self.soft_limit
+
+    def select_evictions(self, discoveries, protected=(), now=None, tracked=None):
+        """
+        MACs of the stalest evictable devices, evict_fraction of the store at
+        most. With tracked (upper-case MACs), only devices that still hold
+        in-memory state are candidates.
+        """
+        now = datetime.now() if now is None else now
+        cutoff = (now - timedelta(seconds=self.keep_recent)).isoformat()
+        candidates = sorted(
+            (d.get("last_seen") or "", d["mac_address"])
+            for d in discoveries
+            if d["mac_address"] not in protected and (d.get("last_seen") or "") < cutoff
+            and (tracked is None or d["mac_address"].upper() in tracked)
+        )
+        count = min(len(candidates), math.ceil(len(discoveries) * self.evict_fraction))
+        macs = [mac for _, mac in candidates[:count]]
+        self.evicted += len(macs)
+        return macs
+
+def forget_devices(macs, scheduler=None, rssi_filter=None, rssi_matrix=None, room_engine=None, device_views=None):
+    """
+    Drop devices from every in-memory per-device tracker. The discovery
+    store and its file keep them, so their history survives and they are
+    not announced again if they come back.
+    """
+    macs = set(macs)
+    if not macs:
+        return
+    if hasattr(discover_ble_devices, "current_rssi"):
+        for mac in macs:
+            discover_ble_devices.current_rssi.pop(mac, None)
+    previous_rssi = getattr(determine_adaptive_scan_interval, "previous_rssi", {})
+    upper = {mac.upper() for mac in macs}
+    for mac in macs:
+        previous_rssi.pop(mac, None)
+    for tracker in (scheduler, rssi_matrix):
+        if tracker is not None:
+            tracker.forget(upper)
+    for tracker in (rssi_filter, room_engine, device_views):
+        if tracker is not None:
+            tracker.forget(macs)
+    logging.warning("Memory soft limit exceeded: dropped tracking state of %d stale devices", len(macs))
+
+def account_memory(accountant, protected, scheduler, rssi_filter, rssi_matrix, room_engine,
+                   notifier, coalescer, mqtt_ingest, device_views=None):
+    """Measure the loop's structures and evict stale devices when over the soft limit."""
+    discoveries = getattr(discover_ble_devices, "discoveries", [])
+    index = getattr(discover_ble_devices, "index", {})
+    previous_rssi = getattr(determine_adaptive_scan_interval, "previous_rssi", {})
+    # Movement history is only useful for devices that are still in the store
+    for mac in [mac for mac in previous_rssi if mac not in index]:
+        del previous_rssi[mac]
+
+    structures = {
+        "discoveries": discoveries,
+        "published_rssi": getattr(discover_ble_devices, "current_rssi", {}),
+        "previous_rssi": previous_rssi,
+        "scheduler": scheduler.samples,
+        "proxy_matrix": rssi_matrix.rows,
+        "announced": notifier.announced,
+        "coalescer": coalescer.pending
+    }
+    if rssi_filter is not None:
+        structures["rssi_filter"] = rssi_filter.slots
+    if room_engine is not None:
+        structures["rooms"] = room_engine.current
+    if mqtt_ingest is not None:
+        structures["mqtt_buffer"] = mqtt_ingest.buffer
+    if device_views is not None:
+        structures["device_views"] = device_views.entries
+    # The store, announced set and ingest queues are not shrunk by eviction, so only
+    # the per-device trackers count towards the soft limit
+    report = accountant.account(structures, evictable=MEMORY_EVICTABLE)
+    report["memory_history_samples"] = sum(len(samples) for samples in scheduler.samples.values())
+    report["memory_expired_devices"] = scheduler.forgotten
+
+    if accountant.over_limit():
+        tracked = set(scheduler.samples) | set(rssi_matrix.rows)
+        macs = accountant.select_evictions(discoveries, protected, tracked=tracked)
+        if macs:
+            forget_devices(macs, scheduler, rssi_filter, rssi_matrix, room_engine, device_views)
+        elif not accountant.exhausted:
+            logging.warning("Memory soft limit exceeded, but every tracked device is protected or recently seen")
+        accountant.exhausted = not macs
+        report["memory_evicted_devices"] = accountant.evicted
+
+class CycleProfiler:
+    """
+    On-demand profiling of the discovery loop. Turning on the profiling
+    input_boolean (or calling input_boolean.turn_on on it) captures cProfile
+    stats over the next few cycles and a tracemalloc snapshot diff across
+    them, writes both reports to the diagnostics directory and turns the
+    input_boolean off again.
+    """
+
+    def __init__(self, entity_id=PROFILE_ENTITY, cycles=PROFILE_CYCLES, directory=DIAGNOSTICS_DIR):
+        self.entity_id = entity_id
+        self.cycles = cycles
+        self.directory = directory
+        self.profile = None
+        self.remaining = 0
+        self.snapshot = None
+        self.started_tracemalloc = False
+        self.reports = []
+
+    def ensure_entity(self, headers=None):
+        """Create the profiling input_boolean through the WebSocket API if it does not exist."""
+        headers = headers or {
+            "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+            "Content-Type": "application/json"
+        }
+        try:
+            if supervisor_get(f"/states/{self.entity_id}", headers=headers).status_code != 404:
+                return False
+            with HomeAssistantWebSocket() as ws:
+                helper = ws.command("input_boolean/create", name="BLE Discovery Profiling",
+                                    icon="mdi:chart-timeline-variant")
+            self.entity_id = f"input_boolean.{helper['id']}"
+            logging.info(f"Created {self.entity_id}")
+            return True
+        except Exception as e:
+            logging.warning(f"Could not create {self.entity_id}: {e}")
+            return False
+
+    def requested(self, headers):
+        """True when the profiling entity is on."""
+        try:
+            response = supervisor_get(f"/states/{self.entity_id}", headers=headers)
+            return response.status_code == 200 and response.json().get("state") == "on"
+        except Exception as e:
+            logging.debug("Error checking %s: %s", self.entity_id, e)
+            return False
+
+    def begin_cycle(self, headers):
+        """Start profiling when requested, and profile the cycle that follows."""
+        if self.profile is None:
+            if not self.requested(headers):
+                return
+            import cProfile
+            import tracemalloc
+            logging.info(f"Profiling the next {self.cycles} discovery cycles")
+            self.profile = cProfile.Profile()
+            self.remaining = self.cycles
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start(10)
+            self.snapshot = tracemalloc.take_snapshot()
+        self.profile.enable()
+
+    def end_cycle(self, headers):
+        """Stop profiling the cycle; after the last one write the reports and switch off."""
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.finish(headers)
+
+    def finish(self, headers):
+        import pstats
+        import tracemalloc
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile_path = os.path.join(self.directory, f"profile_{stamp}.txt")
+            with open(profile_path, 'w') as f:
+                f.write(f"cProfile over {self.cycles} discovery cycles\n\n")
+                stats = pstats.Stats(self.profile, stream=f)
+                stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            self.profile.dump_stats(os.path.join(self.directory, f"profile_{stamp}.prof"))
+
+            memory_path = os.path.join(self.directory, f"memory_{stamp}.txt")
+            differences = tracemalloc.take_snapshot().compare_to(self.snapshot, "lineno")
+            with open(memory_path, 'w') as f:
+                f.write(f"tracemalloc difference over {self.cycles} discovery cycles\n\n")
+                for difference in differences[:PROFILE_TOP_ALLOCATIONS]:
+                    f.write(f"{difference}\n")
+            self.reports = [profile_path, memory_path]
+            logging.info(f"Profiling reports saved to {profile_path} and {memory_path}")
+        except Exception as e:
+            logging.error(f"Error saving profiling reports: {e}")
+        finally:
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            self.profile = None
+            self.snapshot = None
+
+        try:
+            supervisor_post("/services/input_boolean/turn_off", headers=headers, json={"entity_id": self.entity_id})
+        except Exception as e:
+            logging.debug(f"Error switching off {self.entity_id}: {e}")
+
 def collect_system_diagnostics():
     """
     Collect system diagnostic information to help with troubleshooting.
@@ -1198,23 +3038,20 @@ def collect_system_diagnostics():
     
     # Check Bluetooth availability
     try:
-        import subprocess
-        bt_output = subprocess.run(["command", "-v", "bluetoothctl"], 
-                             shell=True, capture_output=True, text=True)
-        diagnostics["bluetoothctl_available"] = bt_output.returncode == 0
+        import shutil
+        bluetoothctl = shutil.which("bluetoothctl")
+        diagnostics["bluetoothctl_available"] = bluetoothctl is not None
         
         if diagnostics["bluetoothctl_available"]:
-            version_output = subprocess.run(["bluetoothctl", "--version"], 
-                                   capture_output=True, text=True)
+            version_output = subprocess.run([bluetoothctl, "--version"], 
+                                   capture_output=True, text=True, timeout=5)
             diagnostics["bluetoothctl_version"] = version_output.stdout.strip() if version_output.returncode == 0 else "Error getting version"
     except Exception as e:
         diagnostics["bluetoothctl_error"] = str(e)
     
     # Check for Bluetooth adapters
     try:
-        hci_output = subprocess.run(["ls", "/sys/class/bluetooth"], 
-                              shell=True, capture_output=True, text=True)
-        diagnostics["bluetooth_adapters"] = hci_output.stdout.strip().split() if hci_output.returncode == 0 else []
+        diagnostics["bluetooth_adapters"] = sorted(os.listdir(BLUETOOTH_SYSFS)) if os.path.isdir(BLUETOOTH_SYSFS) else []
     except Exception as e:
         diagnostics["bluetooth_adapters_error"] = str(e)
     
@@ -1225,7 +3062,7 @@ def collect_system_diagnostics():
     
     # Save diagnostics to file
     try:
-        diag_dir = "/config/ble_discovery/diagnostics"
+        diag_dir = DIAGNOSTICS_DIR
         if not os.path.exists(diag_dir):
             os.makedirs(diag_dir, exist_ok=True)
             
@@ -1233,7 +3070,8 @@ def collect_system_diagnostics():
         with open(diag_filename, 'w') as f:
             json.dump(diagnostics, f, indent=2)
             
-        logging.info(f"Diagnostics saved to {diag_filename}")
+        logging.info(f"Diagnostics saved to {diag_filename}: Python {diagnostics['python_version']}, "
+                     f"Bluetooth adapters: {len(diagnostics.get('bluetooth_adapters', []))}")
         return diagnostics
     except Exception as e:
         logging.error(f"Error saving diagnostics: {e}")
@@ -1258,22 +3096,29 @@ def determine_adaptive_scan_interval(base_interval, devices, activity_level):
     night_mode = 0 <= current_hour < 6 or 22 <= current_hour < 24
     
     # Number of devices above RSSI threshold (stronger signal)
-    strong_signal_devices = len([d for d in devices if d.get("rssi", -100) > -75])
+    strong_signal_devices = len([d for d in devices if d.get("rssi_smoothed", d.get("rssi", -100)) > -75])
     
     # Device movement detected (large change in RSSI)
     device_movement = False
     for device in devices:
         # Check if we have a previous reading to compare with
         mac = device.get("mac_address")
-        rssi = device.get("rssi", -100)
+        
+        if "rssi_smoothed" in device:
+            # Smoothed RSSI moves less, but the change must also exceed the device's own noise
+            rssi = device["rssi_smoothed"]
+            threshold = max(SMOOTHED_MOVEMENT_THRESHOLD, math.sqrt(device.get("rssi_variance", 0)))
+        else:
+            rssi = device.get("rssi", -100)
+            threshold = 10
         
         if not hasattr(determine_adaptive_scan_interval, "previous_rssi"):
             determine_adaptive_scan_interval.previous_rssi = {}
         
         if mac in determine_adaptive_scan_interval.previous_rssi:
             prev_rssi = determine_adaptive_scan_interval.previous_rssi[mac]
-            # If RSSI changed by more than 10 dBm, consider it movement
-            if abs(prev_rssi - rssi) > 10:
+            # If RSSI changed by more than the threshold, consider it movement
+            if abs(prev_rssi - rssi) > threshold:
                 device_movement = True
         
         # Update previous RSSI
@@ -1297,69 +3142,1381 @@ def determine_adaptive_scan_interval(base_interval, devices, activity_level):
     # Minimum 10 seconds, maximum 3x the base interval
     adjusted_interval = max(10, min(base_interval * multiplier, base_interval * 3))
     
-    logging.debug(f"Adaptive scanning: Adjusted interval={adjusted_interval:.0f}s " +
-                 f"(base={base_interval}s, multiplier={multiplier:.2f}, " +
-                 f"night_mode={night_mode}, activity={activity_level})")
+    logging.debug("Adaptive scanning: Adjusted interval=%.0fs (base=%ss, multiplier=%.2f, night_mode=%s, activity=%s)",
+                  adjusted_interval, base_interval, multiplier, night_mode, activity_level)
     
     return int(adjusted_interval)
 
-def get_home_assistant_activity_level():
+class DeviceScheduler:
     """
-    Determine Home Assistant activity level by checking recent state changes.
-    Returns activity level from 0-100 (where 100 is high activity).
+    Per-device refresh scheduler backed by a heap keyed on next-due time.
+    Each device gets its own interval based on RSSI volatility, user priority
+    and staleness, so only devices that are due get processed and published.
+    A due device that is missing from a batch keeps its turn until a row for
+    it arrives, and devices not seen for retention seconds are forgotten.
+    """
+
+    def __init__(self, base_interval, priority_devices=None, min_interval=DEVICE_MIN_INTERVAL,
+                 max_interval=DEVICE_MAX_INTERVAL, stale_after=DEVICE_STALE_AFTER, history_size=8,
+                 retention=DEVICE_RETENTION):
+        self.base_interval = base_interval
+        self.priority_devices = {mac.upper() for mac in priority_devices or []}
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stale_after = stale_after
+        self.history_size = history_size
+        self.retention = retention
+        self.heap = []  # (due_at, mac); superseded entries are skipped lazily
+        self.due_at = {}
+        self.pending = set()  # due, waiting for a row
+        self.samples = {}
+        self.last_seen = {}  # oldest sighting first
+        self.last_due = 0
+        self.forgotten = 0
+
+    def observe(self, mac, rssi, now):
+        """Record a sighting. New devices are due immediately."""
+        if mac not in self.samples:
+            self.samples[mac] = deque(maxlen=self.history_size)
+            self.schedule(mac, now)
+        self.samples[mac].append(rssi)
+        self.last_seen.pop(mac, None)
+        self.last_seen[mac] = now
+
+    def schedule(self, mac, due_at):
+        """Set the next due time for a device."""
+        self.due_at[mac] = due_at
+        heapq.heappush(self.heap, (due_at, mac))
+
+    def volatility(self, mac):
+        """Standard deviation of the recent RSSI samples for a device."""
+        samples = self.samples.get(mac)
+        if not samples or len(samples) < 2:
+            return 0.0
+        mean = sum(samples) / len(samples)
+        return math.sqrt(sum((rssi - mean) ** 2 for rssi in samples) / len(samples))
+
+    def compute_interval(self, mac, now):
+        """Refresh interval for a device in seconds."""
+        interval = self.base_interval
+        samples = self.samples.get(mac, ())
+        volatility = self.volatility(mac)
+
+        if volatility >= 6:
+            # Moving device
+            interval *= 0.25
+        elif volatility >= 3:
+            interval *= 0.5
+        elif len(samples) >= self.history_size and volatility < 1:
+            # Static device with a full, stable history
+            interval *= 2
+
+        if mac in self.priority_devices:
+            interval *= 0.5
+
+        if now - self.last_seen.get(mac, now) > self.stale_after:
+            interval *= 4
+
+        return max(self.min_interval, min(interval, self.max_interval))
+
+    def pop_due(self, now, present=None):
+        """
+        Return the devices due at now and reschedule them. With present (the
+        MACs in the current batch), due devices without a row stay pending.
+        """
+        while self.heap and self.heap[0][0] <= now:
+            due_at, mac = heapq.heappop(self.heap)
+            if self.due_at.get(mac) == due_at:
+                self.pending.add(mac)
+
+        if present is None:
+            due = list(self.pending)
+        else:
+            due = [mac for mac in present if mac in self.pending]
+        for mac in due:
+            self.pending.discard(mac)
+            self.schedule(mac, now + self.compute_interval(mac, now))
+        return due
+
+    def next_due(self):
+        """Earliest pending due time, or None if nothing is scheduled."""
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def select_due(self, gateway_devices, now=None):
+        """
+        Observe every gateway row and return only the rows for devices that are due.
+        When a device appears more than once, its last row is used.
+        """
+        now = time.monotonic() if now is None else now
+        rows = {}
+        for device in gateway_devices:
+            if len(device) < 3 or not device[1]:
+                continue
+            mac = str(device[1]).upper()
+            try:
+                rssi = int(device[2])
+            except (TypeError, ValueError):
+                rssi = -100
+            self.observe(mac, rssi, now)
+            rows[mac] = device
+
+        self.expire(now)
+        due_rows = [rows[mac] for mac in self.pop_due(now, rows)]
+        self.last_due = len(due_rows)
+        return due_rows
+
+    def expire(self, now):
+        """Forget devices not seen for retention seconds and return their MACs."""
+        cutoff = now - self.retention
+        expired = list(itertools.takewhile(lambda mac: self.last_seen[mac] < cutoff, self.last_seen))
+        self.forget(expired)
+        self.forgotten += len(expired)
+        return expired
+
+    def forget(self, macs):
+        """Drop devices; their heap entries are skipped lazily."""
+        for mac in macs:
+            self.due_at.pop(mac, None)
+            self.pending.discard(mac)
+            self.samples.pop(mac, None)
+            self.last_seen.pop(mac, None)
+
+class RssiFilter:
+    """
+    Per-device RSSI smoothing with an EWMA or a 1-D Kalman filter.
+    State is kept in flat arrays indexed by a per-device slot, and all
+    sightings of a cycle are applied in one batch pass.
+    """
+
+    def __init__(self, mode=DEFAULT_RSSI_FILTER, alpha=RSSI_EWMA_ALPHA,
+                 process_noise=RSSI_KALMAN_PROCESS_NOISE, measurement_noise=RSSI_KALMAN_MEASUREMENT_NOISE):
+        if mode not in ("ewma", "kalman"):
+            raise ValueError(f'Invalid RSSI filter: {mode}')
+        self.mode = mode
+        self.alpha = alpha
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.slots = {}
+        self.smoothed = array('d')
+        self.variance = array('d')  # EW variance of the innovations (signal noise)
+        self.error = array('d')  # Kalman estimate covariance
+
+    def update(self, samples):
+        """
+        Apply a batch of (mac, rssi) samples. When a device appears more than
+        once, its last sample is used.
+        """
+        latest = dict(samples)
+        slots = []
+        values = []
+        for mac, rssi in latest.items():
+            slot = self.slots.get(mac)
+            if slot is None:
+                # First sighting initialises the filter at the measurement
+                self.slots[mac] = len(self.smoothed)
+                self.smoothed.append(rssi)
+                self.variance.append(0.0)
+                self.error.append(self.measurement_noise)
+            else:
+                slots.append(slot)
+                values.append(rssi)
+
+        if not slots:
+            return
+
+        smoothed = self.smoothed
+        residuals = [z - smoothed[i] for i, z in zip(slots, values)]
+
+        if self.mode == "kalman":
+            errors = [self.error[i] + self.process_noise for i in slots]
+            gains = [p / (p + self.measurement_noise) for p in errors]
+            for i, k, p, r in zip(slots, gains, errors, residuals):
+                smoothed[i] += k * r
+                self.error[i] = (1 - k) * p
+        else:
+            a = self.alpha
+            for i, r in zip(slots, residuals):
+                smoothed[i] += a * r
+
+        a = self.alpha
+        variance = self.variance
+        for i, r in zip(slots, residuals):
+            variance[i] = (1 - a) * (variance[i] + a * r * r)
+
+    def forget(self, macs):
+        """Drop devices and compact the state arrays."""
+        for mac in macs:
+            self.slots.pop(mac, None)
+        order = sorted(self.slots.items(), key=lambda item: item[1])
+        self.smoothed = array('d', (self.smoothed[slot] for _, slot in order))
+        self.variance = array('d', (self.variance[slot] for _, slot in order))
+        self.error = array('d', (self.error[slot] for _, slot in order))
+        self.slots = {mac: slot for slot, (mac, _) in enumerate(order)}
+
+    def get(self, mac):
+        """Return (smoothed_rssi, variance) for a device, or None if unknown."""
+        slot = self.slots.get(mac)
+        if slot is None:
+            return None
+        return self.smoothed[slot], self.variance[slot]
+
+    def set_mode(self, mode):
+        """
+        Switch between EWMA and Kalman smoothing. The smoothed values carry
+        over; the Kalman covariance is kept for every slot in both modes.
+        """
+        if mode not in ("ewma", "kalman"):
+            raise ValueError(f'Invalid RSSI filter: {mode}')
+        self.mode = mode
+
+    def annotate(self, devices):
+        """Add rssi_smoothed and rssi_variance to processed device entries."""
+        for device in devices:
+            state = self.get(device["mac_address"])
+            if state is not None:
+                device["rssi_smoothed"] = round(state[0], 1)
+                device["rssi_variance"] = round(state[1], 2)
+
+class RssiMatrix:
+    """
+    Latest RSSI per (device, source) pair, merged from all proxies.
+    Each device has a flat row with one column per source, so a batch of
+    sightings only touches the cells it reports. The nearest proxy is kept
+    up to date from those cells; a device's row is only rescanned when its
+    nearest sighting expired or was overwritten by a weaker one.
+    """
+
+    def __init__(self, ttl=PROXY_SIGHTING_TTL):
+        self.ttl = ttl
+        self.sources = {}  # source -> column
+        self.source_names = []
+        self.rows = {}  # mac -> array of RSSI per column
+        self.seen = {}  # mac -> array of sighting times per column
+        self.latest = {}  # mac -> (entity_id, adv_data, extra columns) of the last sighting
+        self.best = {}  # mac -> (rssi, column)
+
+    def column(self, source):
+        """Column index for a source, adding it if needed."""
+        col = self.sources.get(source)
+        if col is None:
+            col = self.sources[source] = len(self.source_names)
+            self.source_names.append(source)
+        return col
+
+    def merge(self, gateway_devices, now=None):
+        """
+        Merge a batch of gateway rows from any number of sources.
+        Duplicate sightings of the same (device, source) pair keep the strongest.
+        Returns the MACs seen in the batch, in first-seen order.
+        """
+        now = time.monotonic() if now is None else now
+        # Collapse the batch to the strongest sighting per cell first, so each row is written once
+        touched = {}  # mac -> {column: rssi}
+        for device in gateway_devices:
+            if not isinstance(device, (list, tuple)) or len(device) < 3 or not device[1]:
+                continue
+            try:
+                rssi = float(device[2])
+            except (TypeError, ValueError):
+                continue
+
+            mac = str(device[1]).upper()
+            col = self.column(device[4] if len(device) > 4 and device[4] else "default")
+            cells = touched.get(mac)
+            if cells is None:
+                cells = touched[mac] = {}
+            elif cells.get(col, rssi) > rssi:
+                rssi = cells[col]
+            cells[col] = rssi
+            self.latest[mac] = (device[0], device[3] if len(device) > 3 else "", list(device[5:6]))
+
+        width = len(self.source_names)
+        cutoff = now - self.ttl
+        rescan = []
+        for mac, cells in touched.items():
+            row = self.rows.get(mac)
+            if row is None:
+                row = self.rows[mac] = array('d', [NO_SIGNAL]) * width
+                seen = self.seen[mac] = array('d', [0.0]) * width
+            else:
+                seen = self.seen[mac]
+                if len(row) < width:
+                    # A new source appeared since this device was last seen
+                    padding = width - len(row)
+                    row.extend([NO_SIGNAL] * padding)
+                    seen.extend([0.0] * padding)
+
+            # The nearest sighting stands unless it expired or is overwritten by a weaker one
+            best = self.best.get(mac)
+            stale = best is not None and (seen[best[1]] < cutoff or cells.get(best[1], best[0]) < best[0])
+            for col, rssi in cells.items():
+                row[col] = rssi
+                seen[col] = now
+                if not stale and rssi > NO_SIGNAL and (best is None or (rssi, col) > best):
+                    best = (rssi, col)
+            if stale:
+                rescan.append(mac)
+            elif best is not None:
+                self.best[mac] = best
+
+        self.refresh(rescan, now)
+        return list(touched)
+
+    def refresh(self, macs, now):
+        """Recompute the nearest proxy for the given devices, ignoring expired sightings."""
+        cutoff = now - self.ttl
+        for mac in macs:
+            fresh = [
+                (rssi, col)
+                for col, (rssi, seen) in enumerate(zip(self.rows[mac], self.seen[mac]))
+                if seen >= cutoff and rssi > NO_SIGNAL
+            ]
+            if fresh:
+                self.best[mac] = max(fresh)
+            else:
+                self.best.pop(mac, None)
+
+    def forget(self, macs):
+        """Drop devices from the matrix."""
+        for mac in macs:
+            for table in (self.rows, self.seen, self.latest, self.best):
+                table.pop(mac, None)
+
+    def nearest_proxy(self, mac):
+        """Return (source, rssi) of the strongest fresh sighting, or None."""
+        best = self.best.get(mac.upper())
+        if best is None:
+            return None
+        return self.source_names[best[1]], best[0]
+
+    def proxy_rssi(self, mac, now=None):
+        """Return {source: rssi} for all fresh sightings of a device."""
+        now = time.monotonic() if now is None else now
+        row = self.rows.get(mac.upper())
+        if row is None:
+            return {}
+        cutoff = now - self.ttl
+        return {
+            self.source_names[col]: rssi
+            for col, (rssi, seen) in enumerate(zip(row, self.seen[mac.upper()]))
+            if seen >= cutoff and rssi > NO_SIGNAL
+        }
+
+    def best_rows(self, macs):
+        """Collapse devices to one gateway row each, using the nearest proxy's RSSI."""
+        rows = []
+        for mac in macs:
+            best = self.best.get(mac)
+            if best is None:
+                continue
+            entity_id, adv_data, extra = self.latest[mac]
+            rows.append([entity_id, mac, str(int(best[0])), adv_data, self.source_names[best[1]]] + extra)
+        return rows
+
+    def annotate(self, devices, now=None):
+        """Add nearest_proxy and proxy_rssi to processed device entries."""
+        now = time.monotonic() if now is None else now
+        for device in devices:
+            nearest = self.nearest_proxy(device["mac_address"])
+            if nearest is not None:
+                device["nearest_proxy"] = nearest[0]
+                device["proxy_rssi"] = self.proxy_rssi(device["mac_address"], now)
+
+def parse_rooms(raw_rooms):
+    """
+    Normalise the rooms option.
+    Each entry has a name, the proxy placed in the room, an optional RSSI
+    calibration offset for that proxy and an optional fingerprint of
+    expected RSSI per proxy ("proxy_a=-55,proxy_b=-75").
+    Returns a list of (name, {proxy: expected_rssi}) and a dict of proxy offsets.
+    """
+    rooms = []
+    offsets = {}
+    for item in raw_rooms or []:
+        name = str(item.get("name", "")).strip()
+        proxy = str(item.get("proxy", "")).strip()
+        if not name:
+            continue
+        try:
+            if proxy and item.get("offset") is not None:
+                offsets[proxy] = float(item["offset"])
+
+            fingerprint = {}
+            for pair in str(item.get("fingerprint") or "").split(","):
+                if "=" in pair:
+                    source, _, rssi = pair.partition("=")
+                    fingerprint[source.strip()] = float(rssi)
+        except (TypeError, ValueError):
+            logging.warning(f"Ignoring invalid room configuration: {item}")
+            continue
+
+        if not fingerprint and proxy:
+            fingerprint = {proxy: ROOM_PROXY_RSSI}
+        if fingerprint:
+            rooms.append((name, fingerprint))
+    return rooms, offsets
+
+class RoomPresenceEngine:
+    """
+    Room-level presence on top of an RssiMatrix.
+    Each room is a fingerprint of expected RSSI per proxy; a device is placed
+    in the room whose fingerprint is nearest (RMS distance in dB) to its
+    calibrated per-proxy RSSI, with hysteresis against flapping.
+    """
+
+    def __init__(self, rooms, offsets=None, margin=ROOM_HYSTERESIS_DB, confirm=ROOM_CONFIRM_UPDATES):
+        self.names = [name for name, fingerprint in rooms]
+        self.fingerprints = [fingerprint for name, fingerprint in rooms]
+        self.offsets = offsets or {}
+        self.margin = margin
+        self.confirm = confirm
+        self.current = {}  # mac -> room
+        self.distance = {}  # mac -> distance to the current room
+        self.pending = {}  # mac -> (candidate room, consecutive updates)
+
+    def set_rooms(self, rooms, offsets=None):
+        """
+        Replace the room table, keeping each device's current room. Devices
+        in a removed room move on the next confirmed update as usual.
+        """
+        self.names = [name for name, fingerprint in rooms]
+        self.fingerprints = [fingerprint for name, fingerprint in rooms]
+        self.offsets = offsets or {}
+        self.pending = {mac: state for mac, state in self.pending.items()
+                        if state[0] in self.names or state[0] == ROOM_AWAY}
+
+    def distances(self, matrix, now):
+        """
+        RMS distance from every device in the matrix to every room.
+        Returns {mac: [distance per room]}, or None for devices with no fresh sightings.
+        """
+        # Resolve room fingerprints and calibration offsets to matrix columns once per update
+        rooms = [
+            [(matrix.column(source), expected) for source, expected in fingerprint.items()]
+            for fingerprint in self.fingerprints
+        ]
+        offset_columns = [(matrix.column(source), offset) for source, offset in self.offsets.items()]
+        offsets = [0.0] * len(matrix.source_names)
+        for col, offset in offset_columns:
+            offsets[col] = offset
+
+        cutoff = now - matrix.ttl
+        floor = ROOM_RSSI_FLOOR
+        results = {}
+        for mac, row in matrix.rows.items():
+            seen = matrix.seen[mac]
+            observed = [
+                max(floor, rssi + offset) if seen_at >= cutoff and rssi > NO_SIGNAL else floor
+                for rssi, seen_at, offset in zip(row, seen, offsets)
+            ]
+            if all(value == floor for value in observed):
+                results[mac] = None
+                continue
+            observed.extend([floor] * (len(offsets) - len(observed)))
+            results[mac] = [
+                math.sqrt(sum((observed[col] - expected) ** 2 for col, expected in room) / len(room))
+                for room in rooms
+            ]
+        return results
+
+    def update(self, matrix, now=None):
+        """Re-evaluate all devices and return {mac: room} for devices that changed room."""
+        now = time.monotonic() if now is None else now
+        changes = {}
+        if not self.names:
+            return changes
+
+        for mac, distances in self.distances(matrix, now).items():
+            current = self.current.get(mac)
+            if distances is None:
+                candidate = ROOM_AWAY
+            else:
+                best = min(range(len(distances)), key=distances.__getitem__)
+                candidate = self.names[best]
+                if current in self.names:
+                    # Stay put unless the new room is clearly better
+                    if distances[self.names.index(current)] - distances[best] < self.margin:
+                        candidate = current
+                self.distance[mac] = distances[self.names.index(candidate)]
+
+            if candidate == current:
+                self.pending.pop(mac, None)
+                continue
+
+            room, count = self.pending.get(mac, (candidate, 0))
+            count = count + 1 if room == candidate else 1
+            if current is None or count >= self.confirm:
+                self.current[mac] = candidate
+                self.pending.pop(mac, None)
+                changes[mac] = candidate
+            else:
+                self.pending[mac] = (candidate, count)
+        return changes
+
+    def annotate(self, devices):
+        """Add the current room to processed device entries."""
+        for device in devices:
+            room = self.current.get(device["mac_address"].upper())
+            if room is not None:
+                device["room"] = room
+
+    def forget(self, macs):
+        """Drop devices from the presence state."""
+        for mac in macs:
+            for table in (self.current, self.distance, self.pending):
+                table.pop(mac.upper(), None)
+
+def entity_slug(name):
+    """Entity id part for a name: lowercase alphanumerics joined by single underscores."""
+    slug = "".join(c if c.isalnum() else "_" for c in name.lower())
+    return "_".join(part for part in slug.split("_") if part)
+
+def room_sensor_entity_id(device):
+    """
+    Entity id of the room sensor for a device. It is based on the name when
+    first published and then stored on the device, so renames keep it.
+    """
+    entity_id = device.get("room_entity")
+    if entity_id is None:
+        entity_id = device["room_entity"] = f"sensor.{entity_slug(device.get('name') or device['mac_address'])}_room"
+    return entity_id
+
+def publish_room_sensors(changes, index, room_engine, tracked_devices=None):
+    """
+    Publish sensor.<device>_room for devices that changed room, and the
+    sensor.ble_room_presence summary of devices per room.
     """
+    if not changes:
+        return
     try:
-        # Use Supervisor token for authentication
         headers = {
             "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
             "Content-Type": "application/json"
         }
-        
-        # Get history for the last 15 minutes for common activity entities
-        fifteen_minutes_ago = (datetime.now() - datetime.timedelta(minutes=15)).isoformat()
-        
-        # Try to get state changes history
-        response = requests.get(
-            "http://supervisor/core/api/history/period/" + fifteen_minutes_ago,
+
+        for mac, room in changes.items():
+            if tracked_devices and mac not in tracked_devices:
+                continue
+            device = index.get(mac)
+            if device is None:
+                continue
+            entity_id = room_sensor_entity_id(device)
+            response = supervisor_post(
+                f"/states/{entity_id}",
+                headers=headers,
+                json={
+                    "state": room,
+                    "attributes": {
+                        "friendly_name": f"{device.get('name', mac)} Room",
+                        "icon": "mdi:home-map-marker",
+                        "mac_address": mac,
+                        "nearest_proxy": device.get("nearest_proxy"),
+                        "distance_db": round(room_engine.distance.get(mac, 0), 1)
+                    }
+                }
+            )
+            if response.status_code < 200 or response.status_code >= 300:
+                device_log.error("Error updating %s: %s", entity_id, response.status_code)
+
+        rooms = {}
+        for mac, room in room_engine.current.items():
+            if room != ROOM_AWAY and (not tracked_devices or mac in tracked_devices) and mac in index:
+                rooms.setdefault(room, []).append(index[mac].get("name", mac))
+
+        supervisor_post(
+            "/states/sensor.ble_room_presence",
+            headers=headers,
+            json={
+                "state": sum(len(names) for names in rooms.values()),
+                "attributes": {
+                    "friendly_name": "BLE Room Presence",
+                    "icon": "mdi:home-map-marker",
+                    "unit_of_measurement": "devices",
+                    "rooms": {room: sorted(names) for room, names in sorted(rooms.items())}
+                }
+            }
+        )
+    except Exception as e:
+        logging.error(f"Error publishing room sensors: {e}")
+
+def websocket_url():
+    """WebSocket API URL of the Home Assistant instance behind SUPERVISOR_API."""
+    base = SUPERVISOR_API.rsplit("/api", 1)[0]
+    return base.replace("http", "ws", 1) + "/websocket"
+
+class HomeAssistantWebSocket:
+    """
+    Minimal Home Assistant WebSocket API client, for the commands the REST
+    API lacks (creating helpers). Use as a context manager; command()
+    returns the result or raises RuntimeError with the error message.
+    """
+
+    def __init__(self, url=None, token=None, timeout=WEBSOCKET_TIMEOUT):
+        self.url = url or websocket_url()
+        self.token = token if token is not None else os.environ.get("SUPERVISOR_TOKEN", "")
+        self.timeout = timeout
+        self.socket = None
+        self.buffer = b""
+        self.fragments = b""
+        self.message_id = 0
+        self.last_received = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        # Only needed for helper creation and the signal test stream, so kept out of startup
+        import base64
+        import socket
+
+        url = urlparse(self.url)
+        port = url.port or (443 if url.scheme == "wss" else 80)
+        self.socket = socket.create_connection((url.hostname, port), timeout=self.timeout)
+        if url.scheme == "wss":
+            import ssl
+            self.socket = ssl.create_default_context().wrap_socket(self.socket, server_hostname=url.hostname)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.socket.sendall(
+            f"GET {url.path or '/'} HTTP/1.1\r\nHost: {url.netloc}\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode()
+        )
+        while b"\r\n\r\n" not in self.buffer:
+            self.buffer += self.receive_chunk()
+        status, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+        if b" 101 " not in status.split(b"\r\n", 1)[0]:
+            raise ConnectionError(f"WebSocket upgrade refused: {status.splitlines()[0].decode(errors='replace')}")
+
+        self.receive()  # auth_required
+        self.send({"type": "auth", "access_token": self.token})
+        reply = self.receive()
+        if reply.get("type") != "auth_ok":
+            raise ConnectionError(f"WebSocket authentication failed: {reply.get('message')}")
+
+    def command(self, command_type, **payload):
+        self.message_id += 1
+        self.send({"id": self.message_id, "type": command_type, **payload})
+        while True:
+            reply = self.receive()
+            if reply.get("id") == self.message_id and reply.get("type") == "result":
+                if not reply.get("success"):
+                    raise RuntimeError((reply.get("error") or {}).get("message", "Command failed"))
+                return reply.get("result")
+
+    def send(self, message):
+        """Send one masked text frame."""
+        self.send_frame(0x1, json.dumps(message).encode())
+
+    def send_frame(self, opcode, payload):
+        if len(payload) < 126:
+            header = bytes((0x80 | opcode, 0x80 | len(payload)))
+        elif len(payload) < 65536:
+            header = bytes((0x80 | opcode, 0x80 | 126)) + len(payload).to_bytes(2, "big")
+        else:
+            header = bytes((0x80 | opcode, 0x80 | 127)) + len(payload).to_bytes(8, "big")
+        mask = os.urandom(4)
+        self.socket.sendall(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload)))
+
+    def receive_chunk(self):
+        chunk = self.socket.recv(65536)
+        if not chunk:
+            raise ConnectionError("WebSocket closed")
+        self.last_received = time.monotonic()
+        return chunk
+
+    def next_frame(self):
+        """Take one complete frame off the buffer as (first byte, payload), or None."""
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        length = buffer[1] & 0x7F
+        offset = 2
+        if length == 126:
+            offset = 4
+            length = int.from_bytes(buffer[2:4], "big") if len(buffer) >= offset else None
+        elif length == 127:
+            offset = 10
+            length = int.from_bytes(buffer[2:10], "big") if len(buffer) >= offset else None
+        if length is None or len(buffer) < offset + length:
+            return None
+        self.buffer = buffer[offset + length:]
+        return buffer[0], buffer[offset:offset + length]
+
+    def receive(self):
+        return json.loads(self.receive_raw())
+
+    def receive_raw(self):
+        """
+        Read frames until a complete text message arrives, and return it undecoded.
+        Incomplete frames stay buffered, so a socket timeout can be retried.
+        """
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                self.buffer += self.receive_chunk()
+                continue
+            first, payload = frame
+            opcode = first & 0x0F
+            if opcode == 0x8:
+                raise ConnectionError("WebSocket closed")
+            if opcode == 0x9:
+                # Home Assistant closes connections that miss its heartbeat pings
+                self.send_frame(0xA, payload)
+                continue
+            if opcode in (0x0, 0x1):
+                self.fragments += payload
+                if first & 0x80:
+                    message, self.fragments = self.fragments, b""
+                    return message
+
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
+class DeviceCommands:
+    """
+    Device commands sent from Home Assistant with the hassio.addon_stdin
+    service, one JSON object per line on stdin. A reader thread queues
+    them and sets wake, so the loop applies them between cycles.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdin
+        self.queue = deque()
+        self.wake = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.read, name="device-commands", daemon=True).start()
+        return self
+
+    def read(self):
+        for line in self.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                command = json.loads(line)
+            except ValueError:
+                command = None
+            if not isinstance(command, dict):
+                logging.warning("Ignoring invalid command on stdin: %s", line[:200])
+                continue
+            self.queue.append(command)
+            self.wake.set()
+
+    def drain(self):
+        """Commands received since the last call."""
+        self.wake.clear()
+        commands = []
+        while self.queue:
+            commands.append(self.queue.popleft())
+        return commands
+
+def normalize_mac(value):
+    """AA:BB:CC:DD:EE:FF form of a MAC address given with any separators, or None."""
+    digits = re.sub(r"[^0-9A-Fa-f]", "", str(value or "")).upper()
+    if len(digits) != 12:
+        return None
+    return ":".join(digits[i:i + 2] for i in range(0, 12, 2))
+
+class SignalTest:
+    """
+    High-rate signal test of one device, started by a signal_test command
+    (script.test_ble_signal) for the test's duration. Every advertisement of
+    that device from the live streams is sampled: the MQTT gateway topic of
+    its MAC, the local bluetoothctl session and Home Assistant's
+    bluetooth/subscribe_advertisements WebSocket feed. That feed cannot be
+    filtered by address, so it is only open during a test and messages that
+    do not mention the MAC are skipped before JSON decoding. Without a
+    stream, the polled gateway rows are sampled each cycle. Min/max/average/
+    jitter over the last window are published to sensor.ble_signal_test at
+    most once per refresh interval.
+    """
+
+    def __init__(self, window=SIGNAL_TEST_WINDOW, refresh=SIGNAL_TEST_REFRESH,
+                 max_duration=SIGNAL_TEST_MAX_DURATION):
+        self.window = window
+        self.refresh = refresh
+        self.max_duration = max_duration
+        # Read without the lock on the ingest threads; replaced, never mutated
+        self.target = None
+        self.topic_suffix = None
+        self.generation = 0
+        self.started = None
+        self.ends = None
+        self.samples = deque(maxlen=SIGNAL_TEST_MAX_SAMPLES)
+        self.received = 0
+        self.published = 0
+        # Generation whose WebSocket stream is delivering advertisements
+        self.streaming_generation = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    @property
+    def streaming(self):
+        return self.target is not None and self.streaming_generation == self.generation
+
+    def select(self, mac, duration=SIGNAL_TEST_DURATION, now=None, stream=True):
+        """
+        Track mac (any separators) for duration seconds, or stop with None.
+        Selecting the tracked device again extends the test.
+        """
+        mac = normalize_mac(mac)
+        now = time.monotonic() if now is None else now
+        self.started = now if mac != self.target else self.started
+        self.ends = now + min(max(float(duration or SIGNAL_TEST_DURATION), 1.0), self.max_duration)
+        if mac == self.target:
+            return False
+        with self.lock:
+            self.generation += 1
+            self.samples.clear()
+            self.received = 0
+            self.target = mac
+            self.topic_suffix = mac.replace(":", "") if mac else None
+        logging.info(f"Signal test {'tracking ' + mac if mac else 'stopped'}")
+        if mac and stream:
+            generation = self.generation
+            threading.Thread(target=self.run, args=(generation,), name="signal-test", daemon=True).start()
+            threading.Thread(target=self.stream_home_assistant, args=(generation,),
+                             name="signal-test-ws", daemon=True).start()
+        return True
+
+    def observe(self, mac, rssi, source=None, now=None):
+        """One advertisement; ignored unless it is from the tracked device."""
+        if mac != self.target:
+            return
+        self.samples.append((time.monotonic() if now is None else now, int(rssi), source))
+        self.received += 1
+
+    def observe_message(self, topic, payload):
+        """Sample an MQTT gateway message if its topic ends with the tracked MAC."""
+        suffix = self.topic_suffix
+        if suffix is None or not topic.upper().endswith(suffix):
+            return
+        try:
+            rows = decode_mqtt_advertisement(topic, payload)
+        except (ValueError, TypeError, UnicodeDecodeError):
+            return
+        for row in rows:
+            self.observe(row[1], row[2], row[4])
+
+    def observe_rows(self, rows):
+        """Sample polled gateway rows, when no live stream is delivering advertisements."""
+        if self.target is None or self.streaming:
+            return
+        for row in rows:
+            # The local scanner is sampled directly
+            if len(row) > 4 and row[4] == "local":
+                continue
+            if len(row) > 2 and str(row[1]).upper() == self.target:
+                self.observe(self.target, gateway_row_rssi(row), row[4] if len(row) > 4 else None)
+
+    def stream_home_assistant(self, generation):
+        """WebSocket thread: sample advertisements relayed by Home Assistant until the test ends."""
+        while generation == self.generation and not self.stop_event.is_set():
+            try:
+                with HomeAssistantWebSocket() as ws:
+                    ws.command("bluetooth/subscribe_advertisements")
+                    self.streaming_generation = generation
+                    # Wake up every refresh to notice the end of the test; quiet periods are normal
+                    ws.socket.settimeout(self.refresh)
+                    while generation == self.generation and not self.stop_event.is_set():
+                        target = self.target
+                        try:
+                            message = ws.receive_raw()
+                        except TimeoutError:
+                            if time.monotonic() - ws.last_received > SIGNAL_TEST_STREAM_IDLE:
+                                raise
+                            continue
+                        # Addresses are upper case in the feed; most batches do not mention the device
+                        if target is None or target.encode() not in message:
+                            continue
+                        event = json.loads(message).get("event") or {}
+                        for advertisement in event.get("add") or []:
+                            if isinstance(advertisement, dict) and advertisement.get("rssi") is not None:
+                                self.observe(str(advertisement.get("address", "")).upper(),
+                                             advertisement["rssi"], advertisement.get("source"))
+            except RuntimeError as e:
+                # Older Home Assistant: no advertisement feed, fall back to the other sources
+                logging.info(f"Home Assistant advertisement stream not available: {e}")
+                return
+            except (OSError, ValueError) as e:
+                logging.debug("Signal test stream interrupted: %s", e)
+                self.stop_event.wait(SIGNAL_TEST_RECONNECT_DELAY)
+            finally:
+                if self.streaming_generation == generation:
+                    self.streaming_generation = None
+
+    def stats(self, now=None):
+        """Statistics over the samples within the window."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.samples and now - self.samples[0][0] > self.window:
+                self.samples.popleft()
+            samples = list(self.samples)
+        if not samples:
+            return {"samples": 0}
+        values = [rssi for _, rssi, _ in samples]
+        span = min(self.window, now - self.started) if self.started is not None else self.window
+        return {
+            "samples": len(values),
+            "rate": round(len(values) / span, 2) if span > 0 else None,
+            "last": values[-1],
+            "min": min(values),
+            "max": max(values),
+            "avg": round(sum(values) / len(values), 1),
+            # Mean change between consecutive advertisements
+            "jitter": round(sum(abs(b - a) for a, b in zip(values, values[1:])) / (len(values) - 1), 2)
+            if len(values) > 1 else 0.0,
+            "source": samples[-1][2]
+        }
+
+    def publish(self, now=None, headers=None, finished=False):
+        """Post sensor.ble_signal_test; a finished test keeps its final statistics."""
+        stats = self.stats(now)
+        headers = headers or {
+            "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+            "Content-Type": "application/json"
+        }
+        state = stats["avg"] if stats["samples"] else "waiting"
+        try:
+            supervisor_post(
+                f"/states/{SIGNAL_TEST_ENTITY}",
+                headers=headers,
+                json={
+                    "state": state,
+                    "attributes": {
+                        "friendly_name": "BLE Signal Test",
+                        "icon": "mdi:signal",
+                        "unit_of_measurement": "dBm" if isinstance(state, float) else None,
+                        "mac_address": self.target,
+                        "window_s": self.window,
+                        "streaming": self.streaming,
+                        "running": not finished,
+                        **stats
+                    }
+                }
+            )
+            self.published += 1
+        except Exception as e:
+            logging.debug("Error updating signal test sensor: %s", e)
+
+    def run(self, generation):
+        """Publisher thread of one test: publish while it runs, then a final result and stop."""
+        last_published = None
+        while generation == self.generation and not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= self.ends:
+                self.publish(now, finished=True)
+                self.select(None, now=now)
+                return
+            # Publish on new samples and while old ones age out of the window
+            if self.received != last_published or self.samples:
+                self.publish(now)
+                last_published = self.received
+            self.stop_event.wait(self.refresh)
+
+    def stop(self):
+        self.stop_event.set()
+
+SIGNAL_TEST = SignalTest()
+
+def registered_macs():
+    """MACs of the devices registered through add_device commands."""
+    return {mac for mac, device in discovery_store()[1].items() if device.get("registered")}
+
+def refresh_registered_thresholds():
+    """Re-read every threshold helper on the next publish."""
+    publish_registered_devices.thresholds_read.clear()
+
+def publish_registered_devices(devices, headers=None, stale_after=DEVICE_STALE_AFTER, now=None, force=False):
+    """
+    Publish the RSSI sensor and presence binary sensor of registered devices.
+    Presence compares the (smoothed) RSSI with the device's threshold helper,
+    and is off once the device has not been seen for stale_after seconds.
+    The helper is re-read every REGISTERED_THRESHOLD_REFRESH seconds, and an
+    entity is only posted when its state or attributes that matter changed,
+    or as a keep-alive every REGISTERED_KEEPALIVE seconds; force posts both.
+    """
+    headers = headers or {
+        "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+        "Content-Type": "application/json"
+    }
+    now = datetime.now() if now is None else now
+    clock = time.monotonic()
+    thresholds_read = publish_registered_devices.thresholds_read
+    posted = publish_registered_devices.posted
+
+    def post(entity_id, key, payload):
+        last = posted.get(entity_id)
+        if not force and last is not None and last[0] == key and clock - last[1] < REGISTERED_KEEPALIVE:
+            return
+        if supervisor_post(f"/states/{entity_id}", headers=headers, json=payload).status_code < 300:
+            posted[entity_id] = (key, clock)
+
+    for device in devices:
+        entities = device.get("entities") or {}
+        mac = device["mac_address"]
+        try:
+            # The threshold helper can be changed from the dashboard at any time
+            read_at = thresholds_read.get(mac)
+            if entities.get("threshold") and (force or read_at is None or clock - read_at >= REGISTERED_THRESHOLD_REFRESH):
+                response = supervisor_get(f"/states/{entities['threshold']}", headers=headers)
+                if response.status_code == 200:
+                    device["rssi_threshold"] = int(float(response.json()["state"]))
+                    thresholds_read[mac] = clock
+
+            rssi = device.get("rssi", -100)
+            threshold = device.get("rssi_threshold", DEFAULT_RSSI_THRESHOLD)
+            name = device.get("name") or device["mac_address"]
+            try:
+                stale = (now - datetime.fromisoformat(device["last_seen"])).total_seconds() > stale_after
+            except (KeyError, TypeError, ValueError):
+                stale = True
+            icon = device.get("icon") or "mdi:bluetooth"
+            present = not stale and device.get("rssi_smoothed", rssi) >= threshold
+            post(
+                entities["rssi"],
+                (rssi, name, icon),
+                {
+                    "state": rssi,
+                    "attributes": {
+                        "friendly_name": f"{name} RSSI",
+                        "icon": icon,
+                        "unit_of_measurement": "dBm",
+                        "device_class": "signal_strength",
+                        "state_class": "measurement",
+                        "mac_address": device["mac_address"],
+                        "last_seen": device.get("last_seen")
+                    }
+                }
+            )
+            post(
+                entities["presence"],
+                (present, name, icon, device.get("device_type"), threshold),
+                {
+                    "state": "on" if present else "off",
+                    "attributes": {
+                        "friendly_name": name,
+                        "icon": icon,
+                        "device_class": "presence",
+                        "device_type": device.get("device_type"),
+                        "mac_address": device["mac_address"],
+                        "rssi": rssi,
+                        "rssi_threshold": threshold,
+                        "last_seen": device.get("last_seen")
+                    }
+                }
+            )
+        except Exception as e:
+            device_log.error("Error publishing registered device %s: %s", device.get("mac_address"), e)
+
+publish_registered_devices.thresholds_read = {}  # MAC -> monotonic time the helper was last read
+publish_registered_devices.posted = {}  # entity id -> (published key, monotonic time)
+
+def register_device(device_name, mac_address, device_type="presence", rssi_threshold=DEFAULT_RSSI_THRESHOLD,
+                    icon="mdi:bluetooth", headers=None):
+    """
+    Register a device from Home Assistant without a restart: mark it in the
+    discovery store (adding it if it was never seen), create its RSSI
+    threshold helper over the WebSocket API and publish its sensors.
+    """
+    mac = normalize_mac(mac_address)
+    name = str(device_name or "").strip()
+    threshold = int(float(rssi_threshold))
+    if mac is None or not name or not RSSI_THRESHOLD_RANGE[0] <= threshold <= RSSI_THRESHOLD_RANGE[1]:
+        raise ValueError(f"Invalid device: name={device_name!r}, mac={mac_address!r}, threshold={rssi_threshold!r}")
+
+    discoveries, index, _ = discovery_store()
+    device = index.get(mac)
+    if device is None:
+        now = datetime.now().isoformat()
+        device = {"mac_address": mac, "rssi": -100, "id": str(uuid.uuid4()), "discovered_at": now, "last_seen": now}
+        discoveries.append(device)
+        index[mac] = device
+    device.update(name=name, device_type=device_type, icon=icon, rssi_threshold=threshold, registered=True)
+
+    # Entity ids are fixed at registration so a rename keeps them
+    slug = entity_slug(name)
+    entities = device.setdefault("entities", {"rssi": f"sensor.{slug}_rssi", "presence": f"binary_sensor.{slug}_presence"})
+    if not entities.get("threshold"):
+        try:
+            with HomeAssistantWebSocket() as ws:
+                helper = ws.command(
+                    "input_number/create",
+                    name=f"{name} RSSI Threshold",
+                    min=RSSI_THRESHOLD_RANGE[0],
+                    max=RSSI_THRESHOLD_RANGE[1],
+                    step=1,
+                    initial=threshold,
+                    unit_of_measurement="dBm",
+                    icon="mdi:signal-variant",
+                    mode="slider"
+                )
+            entities["threshold"] = f"input_number.{helper['id']}"
+        except Exception as e:
+            logging.warning(f"Could not create the RSSI threshold helper for {name}: {e}")
+
+    save_discoveries(discoveries)
+    publish_registered_devices([device], headers, force=True)
+    logging.info(f"Registered {name} ({mac}) as a {device_type} device")
+    return device
+
+def rename_device(mac_address, device_name, headers=None):
+    """Rename a registered device; its entity ids stay, their names follow."""
+    mac = normalize_mac(mac_address)
+    name = str(device_name or "").strip()
+    discoveries, index, _ = discovery_store()
+    device = index.get(mac)
+    if device is None or not device.get("registered") or not name:
+        raise ValueError(f"Cannot rename {mac_address!r} to {device_name!r}: not a registered device")
+    device["name"] = name
+    save_discoveries(discoveries)
+    publish_registered_devices([device], headers, force=True)
+    logging.info(f"Renamed {mac} to {name}")
+    return device
+
+def process_device_command(command, headers=None):
+    """Apply one add_device, rename_device or signal_test command from Home Assistant."""
+    action = command.get("action")
+    try:
+        if action == "add_device":
+            device = register_device(
+                command.get("device_name"),
+                command.get("mac_address"),
+                command.get("device_type") or "presence",
+                command.get("rssi_threshold", DEFAULT_RSSI_THRESHOLD),
+                command.get("icon") or "mdi:bluetooth",
+                headers
+            )
+            create_home_assistant_notification(
+                "BLE Device Added",
+                f"Added {device['name']} ({device['mac_address']}) as a {device['device_type']} device.",
+                "ble_device_added"
+            )
+        elif action == "rename_device":
+            rename_device(command.get("mac_address"), command.get("device_name"), headers)
+        elif action == "signal_test":
+            if normalize_mac(command.get("mac_address")) is None:
+                raise ValueError(f"Invalid MAC address: {command.get('mac_address')}")
+            SIGNAL_TEST.select(command.get("mac_address"), command.get("duration") or SIGNAL_TEST_DURATION)
+        else:
+            logging.warning(f"Unknown device command: {action}")
+    except Exception as e:
+        logging.error(f"Error applying {action} command: {e}")
+
+def parse_activity_entities(raw_entities):
+    """
+    Normalise the activity_entities option into a list of (pattern, weight) tuples.
+    Accepts dicts ({"entity": ..., "weight": ...}) or "pattern:weight" strings.
+    """
+    specs = []
+    for item in raw_entities or []:
+        try:
+            if isinstance(item, dict):
+                pattern = str(item.get("entity", "")).strip()
+                weight = float(item.get("weight", 1.0))
+            else:
+                pattern, _, weight = str(item).partition(":")
+                pattern = pattern.strip()
+                weight = float(weight) if weight.strip() else 1.0
+        except (TypeError, ValueError):
+            logging.warning(f"Ignoring invalid activity entity: {item}")
+            continue
+        if pattern and weight > 0:
+            specs.append((pattern, weight))
+    return specs
+
+def resolve_activity_entities(specs, entity_ids):
+    """
+    Resolve activity patterns against the known entity ids.
+    Returns a dict of entity_id -> weight; the first matching pattern wins.
+    """
+    import fnmatch
+
+    weights = {}
+    for entity_id in entity_ids:
+        for pattern, weight in specs:
+            if fnmatch.fnmatchcase(entity_id, pattern):
+                weights[entity_id] = weight
+                break
+    return weights
+
+class ActivityTracker:
+    """
+    Sliding-window activity score over a weighted set of Home Assistant entities.
+    The entity patterns are resolved once into a fixed filter set, and only the
+    history since the previous fetch is requested on each cycle.
+    """
+
+    def __init__(self, specs, window_minutes=ACTIVITY_WINDOW_MINUTES, saturation=ACTIVITY_SATURATION):
+        self.specs = specs
+        self.window = timedelta(minutes=window_minutes)
+        self.saturation = saturation
+        self.weights = None
+        self.filter_entity_id = ""
+        self.events = deque()  # (changed_at, weight), oldest first
+        self.last_fetch = None
+
+    def resolve(self, headers):
+        """Resolve the configured patterns against the current entity list."""
+        response = supervisor_get("/states", headers=headers)
+        if response.status_code < 200 or response.status_code >= 300:
+            logging.error(f"Error resolving activity entities: {response.status_code}")
+            return False
+
+        entity_ids = [state.get('entity_id', '') for state in response.json()]
+        self.weights = resolve_activity_entities(self.specs, entity_ids)
+        self.filter_entity_id = ",".join(sorted(self.weights))
+        logging.info(f"Activity tracking {len(self.weights)} entities")
+        return True
+
+    def record_history(self, history):
+        """
+        Add weighted state changes from a history/period response.
+        The first state of each entity is its state at the start of the period,
+        so only the states after it count as changes.
+        """
+        new_events = []
+        for entity_history in history:
+            if not entity_history:
+                continue
+            weight = self.weights.get(entity_history[0].get('entity_id'), 0)
+            if not weight:
+                continue
+            for state in entity_history[1:]:
+                try:
+                    changed_at = datetime.fromisoformat(state['last_changed'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if changed_at.tzinfo is None:
+                    changed_at = changed_at.replace(tzinfo=timezone.utc)
+                new_events.append((changed_at, weight))
+
+        # Keep the window ordered so expired events can be popped from the left
+        new_events.sort(key=lambda event: event[0])
+        self.events.extend(new_events)
+
+    def score(self, now):
+        """Return the activity level (0-100) for the window ending at now."""
+        cutoff = now - self.window
+        while self.events and self.events[0][0] < cutoff:
+            self.events.popleft()
+        total = sum(weight for changed_at, weight in self.events)
+        return min(100, (total / self.saturation) * 100)
+
+    def update(self, headers):
+        """Fetch history since the previous update and return the current score."""
+        if self.weights is None and not self.resolve(headers):
+            return None
+        if not self.weights:
+            return None
+
+        now = datetime.now(timezone.utc)
+        start = self.last_fetch or (now - self.window)
+
+        response = supervisor_get(
+            "/history/period/" + start.isoformat(),
             headers=headers,
             params={
-                "filter_entity_id": "binary_sensor.motion,binary_sensor.presence,light.living_room,binary_sensor.door_front"
+                "filter_entity_id": self.filter_entity_id,
+                "end_time": now.isoformat(),
+                "minimal_response": "",
+                "no_attributes": ""
             }
         )
-        
-        if response.status_code >= 200 and response.status_code < 300:
-            history = response.json()
-            
-            # Count state changes as a measure of activity
-            total_changes = 0
-            for entity_history in history:
-                if entity_history:
-                    # Each item in entity_history is a state
-                    total_changes += len(entity_history) - 1  # -1 because we're counting changes, not states
-            
-            # Scale to 0-100
-            # 0 changes = 0 activity
-            # 20+ changes in 15 minutes = 100 activity
-            activity_level = min(100, (total_changes / 20) * 100)
+
+        if response.status_code < 200 or response.status_code >= 300:
+            logging.debug("Error getting activity history: %s", response.status_code)
+            return None
+
+        self.record_history(response.json())
+        self.last_fetch = now
+        return self.score(now)
+
+def get_home_assistant_activity_level():
+    """
+    Determine Home Assistant activity level by checking recent state changes.
+    Returns activity level from 0-100 (where 100 is high activity).
+    """
+    try:
+        # Use Supervisor token for authentication
+        headers = {
+            "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+            "Content-Type": "application/json"
+        }
+
+        if not hasattr(get_home_assistant_activity_level, "tracker"):
+            specs = parse_activity_entities(
+                load_options().get("activity_entities") or DEFAULT_ACTIVITY_ENTITIES
+            )
+            get_home_assistant_activity_level.tracker = ActivityTracker(specs)
+
+        activity_level = get_home_assistant_activity_level.tracker.update(headers)
+        if activity_level is not None:
             return activity_level
-    
+
     except Exception as e:
-        logging.debug(f"Error getting activity level: {e}")
-    
+        logging.debug("Error getting activity level: %s", e)
+
     # Default to medium activity if we can't determine
     return 50
 
-def main(log_level, scan_interval, gateway_topic=DEFAULT_GATEWAY_TOPIC):
+def reload_rssi_filter(rssi_filter, mode):
+    """Apply a changed rssi_filter option, keeping the smoothed state unless filtering is turned off."""
+    if mode == "none":
+        return None
+    if rssi_filter is None:
+        return RssiFilter(mode)
+    rssi_filter.set_mode(mode)
+    return rssi_filter
+
+def reload_room_engine(room_engine, raw_rooms):
+    """Apply a changed rooms option, keeping the current room of every device."""
+    rooms, offsets = parse_rooms(raw_rooms)
+    if not rooms:
+        return None
+    if room_engine is None:
+        return RoomPresenceEngine(rooms, offsets)
+    room_engine.set_rooms(rooms, offsets)
+    return room_engine
+
+def apply_option_changes(changed, options, scheduler, coalescer, load_shedder, notifier, accountant):
+    """Apply changed options to the running loop's components, keeping their state."""
+    if "activity_entities" in changed:
+        get_home_assistant_activity_level.tracker = ActivityTracker(
+            parse_activity_entities(options.get("activity_entities") or DEFAULT_ACTIVITY_ENTITIES)
+        )
+    if "priority_devices" in changed:
+        scheduler.priority_devices = {mac.upper() for mac in options.get("priority_devices") or []}
+    if "coalesce_window" in changed:
+        coalescer.window = options.get("coalesce_window", DEFAULT_COALESCE_WINDOW)
+    if "max_rows_per_cycle" in changed:
+        load_shedder.max_rows = options.get("max_rows_per_cycle", MAX_ROWS_PER_CYCLE)
+    if "pressure_publish_limit" in changed:
+        load_shedder.publish_limit = options.get("pressure_publish_limit", PRESSURE_PUBLISH_LIMIT)
+    if "notification_window" in changed:
+        notifier.window = options.get("notification_window", NOTIFY_DEBOUNCE_WINDOW)
+    if "memory_soft_limit" in changed:
+        accountant.soft_limit = options.get("memory_soft_limit", 0) * 1024 * 1024
+    for key in changed.intersection(RESTART_OPTIONS):
+        logging.warning(f"Option {key} changed; restart the add-on to apply it")
+
+def main(log_level, scan_interval, gateway_topic=DEFAULT_GATEWAY_TOPIC, replay_path=None, replay_speed=0.0):
     """Main discovery loop."""
-    setup_logging(log_level)
+    options = load_options()
+    setup_logging(log_level, options.get("log_rate_limit", LOG_RATE_LIMIT), trace=options.get("trace_log", False))
     
     logging.info(f"Enhanced BLE Discovery Add-on started. Base scanning interval: {scan_interval} seconds.")
     
-    # Collect diagnostic information
-    diagnostics = collect_system_diagnostics()
-    logging.info(f"System diagnostics: Python {diagnostics.get('python_version')}, " 
-                f"Bluetooth adapters: {len(diagnostics.get('bluetooth_adapters', []))}")
-    
     # Register our button entity
     register_bluetooth_scan_button()
     
@@ -1381,39 +4538,135 @@ def main(log_level, scan_interval, gateway_topic=DEFAULT_GATEWAY_TOPIC):
     # Track discovered devices for adaptive scanning
     last_devices = []
     
+    # Per-device refresh scheduling
+    scheduler = DeviceScheduler(scan_interval, options.get("priority_devices"))
+    
+    # Per-device RSSI smoothing for movement and presence decisions
+    rssi_filter = reload_rssi_filter(None, options.get("rssi_filter", DEFAULT_RSSI_FILTER))
+    
+    # Per-proxy RSSI tracking across all gateways
+    rssi_matrix = RssiMatrix()
+    
+    # Room presence, enabled when rooms are configured
+    room_engine = reload_room_engine(None, options.get("rooms"))
+    room_devices = {mac.upper() for mac in options.get("room_devices") or []}
+    
+    # Push ingest from MQTT gateways when a broker is available
+    mqtt_ingest = None
+    coalescer = AdvertisementCoalescer(options.get("coalesce_window", DEFAULT_COALESCE_WINDOW))
+    
+    # Backpressure: cap per-cycle work and degrade publishing when the loop falls behind
+    load_shedder = LoadShedder(
+        options.get("max_rows_per_cycle", MAX_ROWS_PER_CYCLE),
+        options.get("pressure_publish_limit", PRESSURE_PUBLISH_LIMIT)
+    )
+    sleep_interval = scan_interval
+    
+    # Per-phase cycle timing, published to sensor.ble_discovery_performance
+    perf = CyclePerformance()
+    
+    # Profiling on demand, switched on from Home Assistant
+    profiler = CycleProfiler()
+    
+    # Options edited in the add-on configuration are applied between cycles
+    watcher = OptionsWatcher(options)
+    
+    # Device add/rename/signal test commands from Home Assistant (hassio.addon_stdin)
+    device_commands = DeviceCommands().start() if sys.stdin is not None else None
+    
+    # Memory accounting, with eviction of stale devices above the soft limit
+    accountant = MemoryAccountant(options.get("memory_soft_limit", 0))
+    protected_devices = scheduler.priority_devices | room_devices
+    
+    # Optional Prometheus endpoint
+    if options.get("metrics"):
+        start_metrics_server()
+    
+    # New devices are announced in debounced batches; known devices count as announced
+    notifier = NewDeviceNotifier(
+        options.get("notification_window", NOTIFY_DEBOUNCE_WINDOW),
+        (d["mac_address"] for d in load_discoveries())
+    )
+    # Sorted views published for scripts and the dashboard
+    device_views = DeviceViews(discovery_store()[0], stale_after=scheduler.stale_after)
+    if gateway_topic and os.environ.get("MQTT_HOST"):
+        mqtt_ingest = MqttIngest(gateway_topic)
+        if not mqtt_ingest.start(
+            os.environ["MQTT_HOST"],
+            int(os.environ.get("MQTT_PORT", DEFAULT_MQTT_PORT)),
+            os.environ.get("MQTT_USERNAME"),
+            os.environ.get("MQTT_PASSWORD")
+        ):
+            mqtt_ingest = None
+    
+    # Offline ingest from a btsnoop/btmon capture (backfill or benchmarking)
+    capture_replay = None
+    if replay_path:
+        capture_replay = CaptureReplay(replay_path, replay_speed, load_shedder.max_rows)
+        logging.info(f"Replaying capture {replay_path} "
+                     f"{'at maximum speed' if not replay_speed else f'at {replay_speed}x recorded pacing'}")
+    
     while True:
+        queue_fill = len(mqtt_ingest.buffer) / mqtt_ingest.buffer.maxlen if mqtt_ingest is not None else 0.0
+        cycle_started = load_shedder.start_cycle(scheduler.next_due(), sleep_interval, queue_fill)
+        perf.begin_cycle()
+        CYCLE_TRACE.begin_cycle()
         try:
+            headers = {
+                "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
+                "Content-Type": "application/json"
+            }
+            
+            profiler.begin_cycle(headers)
+            
+            if device_commands is not None:
+                for command in device_commands.drain():
+                    process_device_command(command, headers)
+            
             # Get current system activity level
             activity_level = get_home_assistant_activity_level()
+            perf.mark("activity")
             
-            # Regular discovery
-            discovered_devices = discover_ble_devices()
-            logging.info(f"Regular scan complete. Total discovered devices: {len(discovered_devices)}")
+            # Regular discovery, limited to the devices that are due
+            discovered_devices = discover_ble_devices(
+                scheduler=scheduler,
+                rssi_filter=rssi_filter,
+                rssi_matrix=rssi_matrix,
+                room_engine=room_engine,
+                room_devices=room_devices,
+                mqtt_ingest=mqtt_ingest,
+                coalescer=coalescer,
+                load_shedder=load_shedder,
+                notifier=notifier,
+                capture_replay=capture_replay,
+                perf=perf,
+                device_views=device_views
+            )
+            notifier.flush()
+            perf.mark("notify")
+            logging.info("Regular scan complete. Due devices: %d, total discovered devices: %d",
+                         scheduler.last_due, len(discovered_devices))
             
-            # Update the BLE gateway sensor with discovered devices if we have any
-            if discovered_devices:
-                headers = {
-                    "Authorization": f"Bearer {os.environ.get('SUPERVISOR_TOKEN', '')}",
-                    "Content-Type": "application/json"
-                }
-                
+            # Update the BLE gateway sensor when any device was refreshed
+            if discovered_devices and scheduler.last_due:
                 sensor_data = {
                     "state": "online",
                     "attributes": {
                         "friendly_name": "BLE Gateway",
                         "icon": "mdi:bluetooth-connect",
-                        "devices": discovered_devices,
+                        "devices": load_shedder.limit_publish(recent_devices(discovered_devices)),
                         "last_scan": datetime.now().isoformat(),
                         "adaptive_scan": True,
                         "activity_level": activity_level
                     }
                 }
                 
-                requests.post(
-                    "http://supervisor/core/api/states/sensor.ble_gateway_raw_data",
+                supervisor_post(
+                    "/states/sensor.ble_gateway_raw_data",
                     headers=headers,
                     json=sensor_data
                 )
+                perf.mark("publish")
             
             # Update last_devices for next adaptive interval calculation
             last_devices = discovered_devices
@@ -1424,6 +4677,7 @@ def main(log_level, scan_interval, gateway_topic=DEFAULT_GATEWAY_TOPIC):
                 last_devices,
                 activity_level
             )
+            scheduler.base_interval = adaptive_interval
             
             # Create a sensor to show current scan settings
             try:
@@ -1436,36 +4690,106 @@ def main(log_level, scan_interval, gateway_topic=DEFAULT_GATEWAY_TOPIC):
                         "base_interval": scan_interval,
                         "activity_level": activity_level,
                         "device_count": len(discovered_devices),
-                        "adaptive_enabled": True
+                        "due_devices": scheduler.last_due,
+                        "scheduled_devices": len(scheduler.due_at),
+                        "adaptive_enabled": True,
+                        **(mqtt_ingest.stats() if mqtt_ingest is not None else {}),
+                        **(coalescer.stats() if mqtt_ingest is not None or capture_replay is not None else {}),
+                        **(capture_replay.stats() if capture_replay is not None else {}),
+                        **load_shedder.stats()
                     }
                 }
                 
-                requests.post(
-                    "http://supervisor/core/api/states/sensor.ble_scan_interval",
+                supervisor_post(
+                    "/states/sensor.ble_scan_interval",
                     headers=headers,
                     json=sensor_data
                 )
             except Exception as e:
-                logging.debug(f"Error updating scan interval sensor: {e}")
+                logging.debug("Error updating scan interval sensor: %s", e)
+            perf.mark("publish")
             
         except Exception as e:
             logging.error(f"Discovery error: {e}")
             # Use base interval on errors
             adaptive_interval = scan_interval
         
-        # Sleep between scans using adaptive interval
-        logging.debug(f"Sleeping for {adaptive_interval} seconds before next scan")
-        time.sleep(adaptive_interval)
+        load_shedder.end_cycle(cycle_started)
+        profiler.end_cycle(headers)
+        perf.end_cycle()
+        CYCLE_TRACE.count(due=scheduler.last_due, rows_shed=load_shedder.rows_shed,
+                          publish_shed=load_shedder.publish_shed)
+        CYCLE_TRACE.end_cycle(perf)
+        if accountant.due():
+            # Registered devices keep their entities, including ones added since startup
+            account_memory(accountant, protected_devices | registered_macs(), scheduler, rssi_filter,
+                           rssi_matrix, room_engine, notifier, coalescer, mqtt_ingest, device_views)
+        perf.publish(headers, accountant.report)
+        
+        # Diagnostics are collected off the loop once the first cycle has published
+        if perf.cycles == 1:
+            threading.Thread(target=collect_system_diagnostics, name="diagnostics", daemon=True).start()
+            threading.Thread(target=profiler.ensure_entity, name="profiling-helper", daemon=True).start()
+        METRICS.cycle_duration.labels().observe(perf.last_cycle)
+        METRICS.queue_depth.labels("mqtt").set(len(mqtt_ingest.buffer) if mqtt_ingest is not None else 0)
+        METRICS.queue_depth.labels("coalescer").set(len(coalescer.pending))
+        METRICS.queue_depth.labels("notifications").set(len(notifier.pending))
+        record_log_drops()
+        
+        # Sleep until the next device is due, capped by the adaptive interval
+        sleep_interval = adaptive_interval
+        next_due = scheduler.next_due()
+        if next_due is not None:
+            sleep_interval = max(DEVICE_MIN_INTERVAL, min(adaptive_interval, next_due - time.monotonic()))
+        if capture_replay is not None and not capture_replay.exhausted:
+            # Keep draining the capture: back to back at maximum speed, one second apart when paced
+            sleep_interval = 1 if capture_replay.speed else 0
+        logging.debug("Sleeping for %.0f seconds before next scan", sleep_interval)
+        changed = watcher.wait(sleep_interval, device_commands.wake if device_commands is not None else None)
+        if not changed:
+            continue
+        
+        # Apply the new options in place; discoveries, indexes and trackers stay loaded
+        options = watcher.options
+        logging.info("Options changed: %s", ", ".join(sorted(changed)))
+        # Threshold helpers may have been edited too; re-read them on the next publish
+        refresh_registered_thresholds()
+        if changed & {"log_level", "log_rate_limit", "trace_log"}:
+            log_level = options.get("log_level", log_level)
+            setup_logging(log_level, options.get("log_rate_limit", LOG_RATE_LIMIT), trace=options.get("trace_log", False))
+        if "scan_interval" in changed:
+            scan_interval = options.get("scan_interval", scan_interval)
+            scheduler.base_interval = scan_interval
+        if "rssi_filter" in changed:
+            rssi_filter = reload_rssi_filter(rssi_filter, options.get("rssi_filter", DEFAULT_RSSI_FILTER))
+        if "rooms" in changed:
+            room_engine = reload_room_engine(room_engine, options.get("rooms"))
+        if "room_devices" in changed:
+            room_devices = {mac.upper() for mac in options.get("room_devices") or []}
+        apply_option_changes(changed, options, scheduler, coalescer, load_shedder, notifier, accountant)
+        protected_devices = scheduler.priority_devices | room_devices
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Enhanced BLE Device Discovery")
+def cli():
+    """Command line entry point; run.sh imports the module and calls this so the compiled bytecode is used."""
+    parser = argparse.ArgumentParser(prog="ble_discovery.py", description="Enhanced BLE Device Discovery")
     parser.add_argument("--log-level", default="INFO", 
                         help="Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)")
     parser.add_argument("--scan-interval", type=int, default=DEFAULT_SCAN_INTERVAL,
                         help="Interval between BLE scans in seconds")
     parser.add_argument("--gateway-topic", default=DEFAULT_GATEWAY_TOPIC,
                         help="MQTT topic for BLE gateway")
+    parser.add_argument("--replay",
+                        help="btsnoop/btmon capture file to ingest")
+    parser.add_argument("--replay-speed", type=float, default=0.0,
+                        help="Replay pacing relative to the recorded timestamps (0 = maximum speed)")
     
     args = parser.parse_args()
     
-    main(args.log_level, args.scan_interval, args.gateway_topic)
+    try:
+        main(args.log_level, args.scan_interval, args.gateway_topic, args.replay, args.replay_speed)
+    finally:
+        stop_logging()
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Synthetic BLE load generator for the discovery pipeline.
+Produces device populations with realistic OUI mixes, rotating random
+addresses, RSSI random walks per proxy and advertisement payloads, in the
+shapes the add-on ingests: ble_gateway rows, Home Assistant states and
+MQTT gateway messages.
+"""
+
+import argparse
+import json
+import random
+
+DEFAULT_DEVICE_COUNT = 1000
+DEFAULT_PROXY_COUNT = 1
+# Share of the population replaced per second (devices leaving and arriving)
+DEFAULT_CHURN_RATE = 0.001
+# Advertisements per device per second
+DEFAULT_ADVERT_RATE = 1.0
+# Share of devices using resolvable private addresses, and how often they rotate (seconds)
+RANDOM_MAC_SHARE = 0.4
+MAC_ROTATION_INTERVAL = 900
+# RSSI random walk
+RSSI_STEP_DB = 1.5
+RSSI_MIN = -100
+RSSI_MAX = -30
+# A proxy farther than this from a device does not hear it
+PROXY_HEARING_FLOOR = -98
+
+# Public OUIs weighted roughly by how often they show up in a home scan
+OUI_DISTRIBUTION = [
+    ("58:D5:6E", "Apple", 18),
+    ("A4:C1:38", "Apple", 12),
+    ("28:6A:BA", "Apple", 6),
+    ("AC:23:3F", "Google", 5),
+    ("F4:F5:D8", "Google", 3),
+    ("00:26:37", "Samsung", 6),
+    ("00:1D:25", "Samsung", 3),
+    ("28:6C:07", "Xiaomi", 8),
+    ("38:A4:ED", "Xiaomi", 6),
+    ("00:17:88", "Philips", 5),
+    ("EC:B5:FA", "Philips", 3),
+    (None, "Unknown", 25),
+]
+
+# Advertised names, chosen so the device type classification paths are exercised
+DEVICE_NAMES = [
+    "Temperature Sensor", "Humidity Meter", "Motion PIR", "Door Contact",
+    "Button Remote", "Light Bulb", "Smart Lock", "Body Scale", "Watch",
+    "Fitness Band", "Speaker", "Tag", "Beacon", "",
+]
+
+MANUFACTURER_IDS = {"Apple": 0x004C, "Google": 0x00E0, "Samsung": 0x0075, "Xiaomi": 0x038F, "Philips": 0x0010}
+
+
+class SyntheticDevice:
+    """One simulated BLE device and its signal towards every proxy."""
+
+    def __init__(self, rng, proxy_count, random_mac_share=RANDOM_MAC_SHARE, now=0.0):
+        prefix, self.manufacturer, _ = rng.choices(OUI_DISTRIBUTION, weights=[w for _, _, w in OUI_DISTRIBUTION])[0]
+        self.prefix = prefix
+        # Phones and wearables of any vendor advertise from private addresses
+        self.random_mac = rng.random() < random_mac_share
+        self.name = rng.choice(DEVICE_NAMES)
+        self.mac = self.new_mac(rng)
+        self.rotates_at = now + rng.uniform(0, MAC_ROTATION_INTERVAL) if self.random_mac else None
+        # Distance to each proxy as an RSSI offset from the strongest one
+        self.base_rssi = rng.uniform(-90, -45)
+        self.offsets = [0.0] + [rng.uniform(-35, 0) for _ in range(proxy_count - 1)]
+        rng.shuffle(self.offsets)
+        self.drift = 0.0
+
+    def new_mac(self, rng):
+        """A public address under the device's OUI, or a resolvable private address."""
+        if self.random_mac:
+            first = rng.randint(0x40, 0x7F)
+        elif self.prefix is None:
+            first = rng.randrange(0, 256) & 0xFC  # public, unicast
+        else:
+            return self.prefix + "".join(f":{rng.randrange(256):02X}" for _ in range(3))
+        return f"{first:02X}" + "".join(f":{rng.randrange(256):02X}" for _ in range(5))
+
+    def step(self, rng, dt, now):
+        """Advance the RSSI random walk and rotate the address when due."""
+        self.drift += rng.gauss(0, RSSI_STEP_DB * dt ** 0.5)
+        # Pull back towards the device's position so the walk stays bounded
+        self.drift *= 0.95
+        if self.rotates_at is not None and now >= self.rotates_at:
+            self.mac = self.new_mac(rng)
+            self.rotates_at = now + MAC_ROTATION_INTERVAL
+
+    def rssi(self, proxy, rng):
+        """Current RSSI at a proxy, with per-advertisement fading."""
+        value = self.base_rssi + self.offsets[proxy] + self.drift + rng.gauss(0, 2)
+        return int(max(RSSI_MIN, min(RSSI_MAX, value)))
+
+    def advertisement(self):
+        """Advertisement payload in the Home Assistant attribute shape."""
+        adv = {"address": self.mac, "name": self.name or self.mac}
+        if self.manufacturer in MANUFACTURER_IDS:
+            adv["manufacturer_data"] = {str(MANUFACTURER_IDS[self.manufacturer]): "0215"}
+        return adv
+
+
+class LoadGenerator:
+    """
+    Synthetic device population seen by proxy_count proxies.
+    Call step() to advance simulated time; the output methods return the
+    population (or the advertisements sent since the last step) in the
+    shapes of the add-on's ingest paths.
+    """
+
+    def __init__(self, device_count=DEFAULT_DEVICE_COUNT, proxy_count=DEFAULT_PROXY_COUNT,
+                 churn_rate=DEFAULT_CHURN_RATE, advert_rate=DEFAULT_ADVERT_RATE,
+                 random_mac_share=RANDOM_MAC_SHARE, seed=None):
+        self.rng = random.Random(seed)
+        self.proxy_count = max(1, proxy_count)
+        self.proxies = ["bluetooth"] + [f"proxy_{i}" for i in range(1, self.proxy_count)]
+        self.churn_rate = churn_rate
+        self.advert_rate = advert_rate
+        self.random_mac_share = random_mac_share
+        self.now = 0.0
+        self.churn_carry = 0.0
+        self.elapsed = 0.0
+        self.devices = [self.new_device() for _ in range(device_count)]
+
+    def new_device(self):
+        return SyntheticDevice(self.rng, self.proxy_count, self.random_mac_share, self.now)
+
+    def step(self, dt=1.0):
+        """Advance simulated time by dt seconds: walk RSSI, rotate addresses, churn devices."""
+        self.now += dt
+        self.elapsed += dt
+        for device in self.devices:
+            device.step(self.rng, dt, self.now)
+
+        self.churn_carry += self.churn_rate * len(self.devices) * dt
+        replaced = int(self.churn_carry)
+        self.churn_carry -= replaced
+        for _ in range(min(replaced, len(self.devices))):
+            self.devices[self.rng.randrange(len(self.devices))] = self.new_device()
+
+    def sightings(self):
+        """(device, proxy index) pairs for every proxy that currently hears a device."""
+        for device in self.devices:
+            for proxy in range(self.proxy_count):
+                if device.base_rssi + device.offsets[proxy] + device.drift >= PROXY_HEARING_FLOOR:
+                    yield device, proxy
+
+    def gateway_rows(self):
+        """Snapshot of every sighting as ble_gateway rows [id, mac, rssi, adv, source]."""
+        return [
+            [device.name or device.mac, device.mac, str(device.rssi(proxy, self.rng)),
+             json.dumps(device.advertisement()), self.proxies[proxy]]
+            for device, proxy in self.sightings()
+        ]
+
+    def states(self, gateway_sensor="sensor.ble_gateway_raw_data"):
+        """
+        /api/states payload: one bluetooth.* entity per device at its nearest
+        proxy, plus the other proxies' sightings as rows of a gateway sensor.
+        """
+        states = []
+        rows = []
+        for device, proxy in self.sightings():
+            rssi = device.rssi(proxy, self.rng)
+            if device.offsets[proxy] == 0.0:
+                attributes = device.advertisement()
+                attributes.update({"rssi": rssi, "source": self.proxies[proxy], "friendly_name": device.name or device.mac})
+                states.append({
+                    "entity_id": f"bluetooth.{device.mac.replace(':', '').lower()}",
+                    "state": "home",
+                    "attributes": attributes
+                })
+            else:
+                rows.append([device.mac, device.mac, str(rssi), json.dumps(device.advertisement()), self.proxies[proxy]])
+        if gateway_sensor and rows:
+            states.append({
+                "entity_id": gateway_sensor,
+                "state": "online",
+                "attributes": {"friendly_name": "BLE Gateway", "devices": rows}
+            })
+        return states
+
+    def advertisements(self, duration=None):
+        """
+        Push stream: the advertisements sent over duration seconds (default:
+        the time stepped since the last call) as gateway rows in random order.
+        """
+        if duration is None:
+            duration, self.elapsed = self.elapsed, 0.0
+        sightings = list(self.sightings())
+        if not sightings:
+            return []
+        count = int(self.advert_rate * len(self.devices) * duration)
+        rows = []
+        for device, proxy in self.rng.choices(sightings, k=count):
+            rows.append([device.name or device.mac, device.mac, str(device.rssi(proxy, self.rng)),
+                         json.dumps(device.advertisement()), self.proxies[proxy]])
+        return rows
+
+    def mqtt_messages(self, gateway_topic="BTLE", duration=None):
+        """The push stream as OpenMQTTGateway (topic, payload) messages."""
+        return [
+            (f"{gateway_topic}/{source}/BTtoMQTT/{mac.replace(':', '')}",
+             json.dumps({"id": mac, "rssi": int(rssi), "name": name}))
+            for name, mac, rssi, _, source in self.advertisements(duration)
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic BLE load generator")
+    parser.add_argument("--devices", type=int, default=DEFAULT_DEVICE_COUNT, help="Number of devices")
+    parser.add_argument("--proxies", type=int, default=DEFAULT_PROXY_COUNT, help="Number of proxies")
+    parser.add_argument("--churn-rate", type=float, default=DEFAULT_CHURN_RATE,
+                        help="Share of devices replaced per second")
+    parser.add_argument("--advert-rate", type=float, default=DEFAULT_ADVERT_RATE,
+                        help="Advertisements per device per second")
+    parser.add_argument("--shape", choices=["rows", "states", "mqtt"], default="rows", help="Output shape")
+    parser.add_argument("--seed", type=int, help="Random seed")
+
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.devices, args.proxies, args.churn_rate, args.advert_rate, seed=args.seed)
+    generator.step()
+    if args.shape == "states":
+        print(json.dumps(generator.states()))
+    elif args.shape == "mqtt":
+        print(json.dumps(generator.mqtt_messages()))
+    else:
+        print(json.dumps(generator.gateway_rows()))
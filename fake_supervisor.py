@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Supervisor's Home Assistant Core API.
+Serves the endpoints the add-on uses (/states, /states/<entity_id>,
+/services/<domain>/<service>, /history/period and the WebSocket API) from
+an in-memory state machine, with configurable latency, error injection and
+payload sizes, so the real main loop can be run end to end under load:
+
+    python fake_supervisor.py --port 8124 --devices 10000 --proxies 50
+    SUPERVISOR_API=http://127.0.0.1:8124/core/api python ble_discovery.py
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_PREFIX = "/core/api"
+WEBSOCKET_PATH = "/core/websocket"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+HA_VERSION = "2024.1.0"
+
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def parse_time(value):
+    """Parse an ISO timestamp, treating naive ones as UTC."""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class FakeSupervisor:
+    """
+    In-process fake of the Core API. States set through the API or
+    set_state() are kept with their history; service calls are recorded in
+    service_calls. With a LoadGenerator, its population is stepped in real
+    time and served as part of /states.
+    """
+
+    def __init__(self, states=None, generator=None, token=None, latency=0.0, error_rate=0.0,
+                 error_status=500, padding=0, host="127.0.0.1", port=0, seed=None, heartbeat=None):
+        self.states = {}
+        self.history = {}  # entity_id -> [state, ...]
+        self.service_calls = []
+        self.requests = 0
+        self.errors = 0
+        self.generator = generator
+        self.generator_time = None
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.padding = padding
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.subscribers = []  # WebSocket connections subscribed to state_changed
+        self.advertisement_subscribers = []  # ... and to bluetooth/subscribe_advertisements
+        # Like aiohttp's heartbeat: WebSocket connections are pinged this often (seconds)
+        # and closed when a ping is still unanswered at the next one
+        self.heartbeat = heartbeat
+        self.pongs = 0
+        self.server = ThreadingHTTPServer((host, port), FakeSupervisorHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+        for state in states or []:
+            self.set_state(state["entity_id"], state.get("state", ""), state.get("attributes"))
+
+    @property
+    def url(self):
+        """Base URL to use as SUPERVISOR_API."""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{API_PREFIX}"
+
+    @property
+    def websocket_url(self):
+        host, port = self.server.server_address[:2]
+        return f"ws://{host}:{port}{WEBSOCKET_PATH}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def set_state(self, entity_id, state, attributes=None):
+        """Set an entity state, record it in the history and notify subscribers."""
+        now = utc_now()
+        with self.lock:
+            old = self.states.get(entity_id)
+            new = {
+                "entity_id": entity_id,
+                "state": str(state),
+                "attributes": attributes or {},
+                "last_changed": now if old is None or old["state"] != str(state) else old["last_changed"],
+                "last_updated": now
+            }
+            self.states[entity_id] = new
+            self.history.setdefault(entity_id, []).append(new)
+            subscribers = list(self.subscribers)
+        for connection, subscription_id in subscribers:
+            try:
+                connection.send_json({
+                    "id": subscription_id,
+                    "type": "event",
+                    "event": {
+                        "event_type": "state_changed",
+                        "data": {"entity_id": entity_id, "old_state": old, "new_state": new},
+                        "time_fired": now
+                    }
+                })
+            except OSError:
+                pass
+        return new, old is None
+
+    def advertise(self, advertisements):
+        """Relay advertisements ({"address", "rssi", "source", ...}) to the advertisement subscribers."""
+        with self.lock:
+            subscribers = list(self.advertisement_subscribers)
+        for connection, subscription_id in subscribers:
+            try:
+                connection.send_json({"id": subscription_id, "type": "event", "event": {"add": advertisements}})
+            except OSError:
+                pass
+
+    def all_states(self):
+        """Stored states plus the generator's current population."""
+        with self.lock:
+            states = list(self.states.values())
+        if self.generator is not None:
+            now = time.monotonic()
+            if self.generator_time is not None:
+                self.generator.step(now - self.generator_time)
+            self.generator_time = now
+            states.extend(self.generator.states())
+        if self.padding:
+            filler = "x" * self.padding
+            states = [dict(state, attributes=dict(state.get("attributes") or {}, padding=filler)) for state in states]
+        return states
+
+    def call_service(self, domain, service, data):
+        """Record a service call and apply the ones that change state."""
+        data = data or {}
+        with self.lock:
+            self.service_calls.append((domain, service, data))
+        entity_ids = data.get("entity_id") or []
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        changed = []
+        for entity_id in entity_ids:
+            current = self.states.get(entity_id)
+            if domain == "input_text" and service == "set_value":
+                changed.append(self.set_state(entity_id, data.get("value", ""), current["attributes"] if current else None)[0])
+            elif service in ("turn_on", "turn_off") and current is not None:
+                changed.append(self.set_state(entity_id, service[5:], current["attributes"])[0])
+            elif service == "press":
+                changed.append(self.set_state(entity_id, utc_now(), current["attributes"] if current else None)[0])
+        if domain == "input_text" and service == "create" and data.get("name"):
+            entity_id = f"input_text.{data['name']}"
+            changed.append(self.set_state(entity_id, data.get("initial", ""), {"max": data.get("max", 255)})[0])
+        return changed
+
+    def create_helper(self, domain, data):
+        """Create an input_number or input_boolean helper as the <domain>/create command does."""
+        slug = "".join(c if c.isalnum() else "_" for c in data["name"].lower())
+        helper_id = "_".join(part for part in slug.split("_") if part)
+        attributes = {key: value for key, value in data.items() if key not in ("id", "type", "initial")}
+        attributes["friendly_name"] = data["name"]
+        if domain == "input_boolean":
+            state = "on" if data.get("initial") else "off"
+        else:
+            state = float(data.get("initial", data.get("min", 0)))
+        self.set_state(f"{domain}.{helper_id}", state, attributes)
+        return dict(attributes, id=helper_id)
+
+    def history_period(self, start, entity_ids, end=None):
+        """History since start for the given entities, in the /history/period shape."""
+        start = parse_time(start)
+        end = parse_time(end) if end else None
+        result = []
+        with self.lock:
+            for entity_id in entity_ids:
+                states = self.history.get(entity_id) or []
+                # The first state is the one in effect at the start of the period
+                before = [s for s in states if datetime.fromisoformat(s["last_updated"]) < start]
+                during = [
+                    s for s in states
+                    if datetime.fromisoformat(s["last_updated"]) >= start
+                    and (end is None or datetime.fromisoformat(s["last_updated"]) <= end)
+                ]
+                entity_history = before[-1:] + during
+                if entity_history:
+                    result.append(entity_history)
+        return result
+
+    def inject(self):
+        """Apply the configured latency; return an error status to inject, or None."""
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return self.error_status
+        return None
+
+
+class FakeSupervisorHandler(BaseHTTPRequestHandler):
+    """HTTP and WebSocket request handler for FakeSupervisor."""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        pass
+
+    def authorized(self):
+        if self.fake.token is None:
+            return True
+        return self.headers.get("Authorization") == f"Bearer {self.fake.token}"
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        if url.path == WEBSOCKET_PATH and self.headers.get("Upgrade", "").lower() == "websocket":
+            WebSocketConnection(self).serve()
+            return
+        if not url.path.startswith(API_PREFIX):
+            self.send_json(404, {"message": "Not found"})
+            return
+        if not self.authorized():
+            self.send_json(401, {"message": "Unauthorized"})
+            return
+        error = self.fake.inject()
+        if error:
+            self.send_json(error, {"message": "Injected error"})
+            return
+
+        parts = [unquote(part) for part in url.path[len(API_PREFIX):].split("/") if part]
+        query = parse_qs(url.query, keep_blank_values=True)
+
+        if method == "GET" and parts == []:
+            self.send_json(200, {"message": "API running."})
+        elif method == "GET" and parts == ["states"]:
+            self.send_json(200, self.fake.all_states())
+        elif method == "GET" and len(parts) == 2 and parts[0] == "states":
+            state = next((s for s in self.fake.all_states() if s["entity_id"] == parts[1]), None)
+            if state is None:
+                self.send_json(404, {"message": "Entity not found."})
+            else:
+                self.send_json(200, state)
+        elif method == "POST" and len(parts) == 2 and parts[0] == "states":
+            body = self.read_json()
+            state, created = self.fake.set_state(parts[1], body.get("state", ""), body.get("attributes"))
+            self.send_json(201 if created else 200, state)
+        elif method == "POST" and len(parts) == 3 and parts[0] == "services":
+            self.send_json(200, self.fake.call_service(parts[1], parts[2], self.read_json()))
+        elif method == "GET" and len(parts) >= 2 and parts[:2] == ["history", "period"]:
+            start = parts[2] if len(parts) > 2 else datetime.now(timezone.utc).replace(hour=0, minute=0).isoformat()
+            entity_ids = [e for e in (query.get("filter_entity_id") or [""])[0].split(",") if e]
+            end = (query.get("end_time") or [None])[0]
+            try:
+                self.send_json(200, self.fake.history_period(start, entity_ids, end))
+            except ValueError:
+                self.send_json(400, {"message": "Invalid datetime"})
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+
+class WebSocketConnection:
+    """
+    Minimal server side of the Home Assistant WebSocket API: the auth
+    handshake, get_states, call_service, subscribe_events/unsubscribe_events
+    for state_changed, bluetooth/subscribe_advertisements, input_number/create,
+    input_boolean/create and ping,
+    plus the protocol-level heartbeat when the FakeSupervisor has one.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.fake = handler.fake
+        self.socket = handler.connection
+        self.send_lock = threading.Lock()
+        self.subscriptions = set()
+        self.awaiting_pong = False
+        self.closed = threading.Event()
+
+    def serve(self):
+        key = self.handler.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.handler.send_response(101, "Switching Protocols")
+        self.handler.send_header("Upgrade", "websocket")
+        self.handler.send_header("Connection", "Upgrade")
+        self.handler.send_header("Sec-WebSocket-Accept", accept)
+        self.handler.end_headers()
+        self.handler.wfile.flush()
+        self.handler.close_connection = True
+
+        try:
+            self.send_json({"type": "auth_required", "ha_version": HA_VERSION})
+            auth = self.receive_json()
+            if auth is None or auth.get("type") != "auth" or (
+                    self.fake.token is not None and auth.get("access_token") != self.fake.token):
+                self.send_json({"type": "auth_invalid", "message": "Invalid access token"})
+                return
+            self.send_json({"type": "auth_ok", "ha_version": HA_VERSION})
+            if self.fake.heartbeat:
+                threading.Thread(target=self.ping_loop, daemon=True).start()
+
+            while True:
+                message = self.receive_json()
+                if message is None:
+                    break
+                self.handle_message(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.closed.set()
+            with self.fake.lock:
+                self.fake.subscribers = [s for s in self.fake.subscribers if s[0] is not self]
+                self.fake.advertisement_subscribers = [
+                    s for s in self.fake.advertisement_subscribers if s[0] is not self
+                ]
+
+    def ping_loop(self):
+        """Ping every heartbeat seconds; drop the connection when the last ping went unanswered."""
+        while not self.closed.wait(self.fake.heartbeat):
+            if self.awaiting_pong:
+                self.socket.shutdown(socket.SHUT_RDWR)
+                return
+            self.awaiting_pong = True
+            with self.send_lock:
+                self.socket.sendall(struct.pack("!BB", 0x89, 4) + b"beat")
+
+    def handle_message(self, message):
+        message_id = message.get("id")
+        command = message.get("type")
+        error = self.fake.inject()
+        if error:
+            self.send_result(message_id, None, {"code": "unknown_error", "message": "Injected error"})
+        elif command == "ping":
+            self.send_json({"id": message_id, "type": "pong"})
+        elif command == "get_states":
+            self.send_result(message_id, self.fake.all_states())
+        elif command == "call_service":
+            changed = self.fake.call_service(message.get("domain"), message.get("service"),
+                                             dict(message.get("service_data") or {}, **(message.get("target") or {})))
+            self.send_result(message_id, {"context": {"id": str(message_id)}, "changed": len(changed)})
+        elif command == "subscribe_events" and message.get("event_type", "state_changed") == "state_changed":
+            self.send_result(message_id, None)
+            self.subscriptions.add(message_id)
+            with self.fake.lock:
+                self.fake.subscribers.append((self, message_id))
+        elif command == "bluetooth/subscribe_advertisements":
+            self.send_result(message_id, None)
+            with self.fake.lock:
+                self.fake.advertisement_subscribers.append((self, message_id))
+        elif command in ("input_number/create", "input_boolean/create") and message.get("name"):
+            self.send_result(message_id, self.fake.create_helper(command.split("/")[0], message))
+        elif command == "unsubscribe_events":
+            subscription = message.get("subscription")
+            self.subscriptions.discard(subscription)
+            with self.fake.lock:
+                self.fake.subscribers = [s for s in self.fake.subscribers if s != (self, subscription)]
+            self.send_result(message_id, None)
+        else:
+            self.send_result(message_id, None, {"code": "unknown_command", "message": "Unknown command."})
+
+    def send_result(self, message_id, result, error=None):
+        message = {"id": message_id, "type": "result", "success": error is None, "result": result}
+        if error is not None:
+            message["error"] = error
+        self.send_json(message)
+
+    def send_json(self, message):
+        """Send one unmasked text frame."""
+        payload = json.dumps(message).encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(payload))
+        with self.send_lock:
+            self.socket.sendall(header + payload)
+
+    def receive_exactly(self, count):
+        data = b""
+        while len(data) < count:
+            chunk = self.socket.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("WebSocket closed")
+            data += chunk
+        return data
+
+    def receive_json(self):
+        """Read frames until a complete text message arrives; None on close."""
+        message = b""
+        while True:
+            first, second = self.receive_exactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self.receive_exactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.receive_exactly(8))[0]
+            mask = self.receive_exactly(4) if second & 0x80 else b"\0\0\0\0"
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self.receive_exactly(length)))
+
+            if opcode == 0x8:  # close
+                return None
+            if opcode == 0x9:  # ping
+                with self.send_lock:
+                    self.socket.sendall(struct.pack("!BB", 0x8A, len(payload)) + payload)
+                continue
+            if opcode == 0xA:  # pong
+                self.awaiting_pong = False
+                self.fake.pongs += 1
+                continue
+            if opcode in (0x0, 0x1, 0x2):
+                message += payload
+                if first & 0x80:
+                    return json.loads(message)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake Supervisor/Home Assistant API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8124, help="Port to listen on")
+    parser.add_argument("--token", help="Require this bearer token")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected errors")
+    parser.add_argument("--padding", type=int, default=0, help="Bytes of padding added to every state's attributes")
+    parser.add_argument("--devices", type=int, default=0, help="Serve a synthetic population of this many devices")
+    parser.add_argument("--proxies", type=int, default=1, help="Proxies in the synthetic population")
+    parser.add_argument("--churn-rate", type=float, default=0.001, help="Share of devices replaced per second")
+    parser.add_argument("--heartbeat", type=float, help="Ping WebSocket connections this often (seconds), as aiohttp does")
+
+    args = parser.parse_args()
+
+    generator = None
+    if args.devices:
+        from ble_loadgen import LoadGenerator
+        generator = LoadGenerator(args.devices, args.proxies, args.churn_rate)
+
+    fake = FakeSupervisor(generator=generator, token=args.token, latency=args.latency, error_rate=args.error_rate,
+                          error_status=args.error_status, padding=args.padding, host=args.host, port=args.port,
+                          heartbeat=args.heartbeat)
+    print(f"Serving {fake.url} and {fake.websocket_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
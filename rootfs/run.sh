@@ -12,7 +12,7 @@ mkdir -p /config/ble_discovery
 # Install any additional dependencies if needed
 if [ ! -f "/.dependencies_installed" ]; then
     bashio::log.info "Installing additional dependencies..."
-    pip3 install --no-cache-dir requests
+    pip3 install --no-cache-dir requests paho-mqtt
     
     # Try to install Bluetooth packages if needed and available
     if command -v apk >/dev/null 2>&1; then
@@ -133,18 +133,31 @@ if [ ! -f "/config/input_text.yaml" ] || ! grep -q "discovered_ble_devices" "/co
     fi
 fi
 
-# Install scripts if they don't exist
-if [ ! -f "/config/scripts/ble_scripts.yaml" ]; then
+# Install scripts if they don't exist, or replace the old ones that restarted Home Assistant
+if [ ! -f "/config/scripts/ble_scripts.yaml" ] || grep -q "shell_command.add_ble_device" /config/scripts/ble_scripts.yaml; then
     bashio::log.info "Installing BLE scripts..."
     mkdir -p /config/scripts
-    cp /ble_scripts.yaml /config/scripts/
+    if [ -f "/config/scripts/ble_scripts.yaml" ]; then
+        cp /config/scripts/ble_scripts.yaml /config/scripts/ble_scripts.yaml.bak
+        bashio::log.warning "Replaced outdated BLE scripts; the previous version was saved to /config/scripts/ble_scripts.yaml.bak"
+    fi
+    sed "s/__ADDON_SLUG__/$(bashio::addon.slug)/" /ble_scripts.yaml > /config/scripts/ble_scripts.yaml
+fi
+
+# MQTT broker for gateway ingest (provided by the Mosquitto add-on, if installed)
+if bashio::services.available "mqtt"; then
+    export MQTT_HOST=$(bashio::services mqtt "host")
+    export MQTT_PORT=$(bashio::services mqtt "port")
+    export MQTT_USERNAME=$(bashio::services mqtt "username")
+    export MQTT_PASSWORD=$(bashio::services mqtt "password")
+    bashio::log.info "MQTT ingest enabled on topic ${GATEWAY_TOPIC}/#"
 fi
 
 # Announce startup
 bashio::log.info "Starting Enhanced BLE Device Discovery..."
 
-# Run the Python script
-python3 /ble_discovery.py \
+# Run the Python script through an import so the precompiled bytecode is used
+PYTHONPATH=/ python3 -c 'import ble_discovery; ble_discovery.cli()' \
     --log-level "${LOG_LEVEL}" \
     --scan-interval "${SCAN_INTERVAL}" \
     --gateway-topic "${GATEWAY_TOPIC}"
\ No newline at end of file
@@ -3,23 +3,152 @@
 Unit tests for the BLE Discovery add-on
 """
 
+import io
 import os
+import subprocess
 import sys
+import threading
+import time
+import logging
+import logging.handlers
 import unittest
 from unittest.mock import patch, MagicMock
 import json
-from datetime import datetime, timedelta
+import struct
+from datetime import datetime, timedelta, timezone
 
 # Import code to test
 from ble_discovery import (
     setup_logging,
+    record_log_drops,
+    get_ble_gateway_data,
+    update_ha_input_text,
     load_discoveries,
     save_discoveries,
     process_ble_gateway_data,
     determine_adaptive_scan_interval,
-    get_home_assistant_activity_level
+    get_home_assistant_activity_level,
+    parse_activity_entities,
+    resolve_activity_entities,
+    ActivityTracker,
+    DeviceScheduler,
+    RssiFilter,
+    RssiMatrix,
+    parse_rooms,
+    reload_room_engine,
+    reload_rssi_filter,
+    RoomPresenceEngine,
+    room_sensor_entity_id,
+    decode_mqtt_advertisement,
+    MqttIngest,
+    AdvertisementCoalescer,
+    LoadShedder,
+    build_new_device_message,
+    NewDeviceNotifier,
+    BluetoothctlScanner,
+    CaptureReplay,
+    BTSNOOP_EPOCH_OFFSET,
+    PhaseHistogram,
+    CyclePerformance,
+    Metrics,
+    METRICS,
+    supervisor_get,
+    supervisor_endpoint,
+    CycleProfiler,
+    HomeAssistantWebSocket,
+    MemoryAccountant,
+    forget_devices,
+    recent_devices,
+    discover_ble_devices,
+    RateLimitFilter,
+    stop_logging,
+    CYCLE_TRACE,
+    trace_log,
+    collect_system_diagnostics,
+    OptionsWatcher,
+    apply_option_changes,
+    log_level_number,
+    register_device,
+    rename_device,
+    publish_registered_devices,
+    refresh_registered_thresholds,
+    DeviceCommands,
+    DeviceViews,
+    SignalTest,
+    process_device_command
 )
+from ble_loadgen import LoadGenerator
+from fake_supervisor import FakeSupervisor
+from bench_ble_discovery import run_benchmarks, compare
 
+# Recorded bluetoothctl session (colour codes and carriage returns as emitted)
+BLUETOOTHCTL_TRANSCRIPT = [
+    "Discovery started\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Controller 00:1A:7D:DA:71:13 Discovering: yes\n",
+    "\r[\x1b[0;92mNEW\x1b[0m] Device AA:BB:CC:DD:EE:FF Test Device\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Device AA:BB:CC:DD:EE:FF RSSI: -71\n",
+    "\r[\x1b[0;92mNEW\x1b[0m] Device 11:22:33:44:55:66 11-22-33-44-55-66\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Device 11:22:33:44:55:66 RSSI: 0xffffffb5 (-75)\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Device 11:22:33:44:55:66 Name: Tracker Tag\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Device AA:BB:CC:DD:EE:FF RSSI: -64\n",
+    "\r[\x1b[0;92mNEW\x1b[0m] Device 77:88:99:AA:BB:CC Gone Soon\n",
+    "\r[\x1b[0;93mCHG\x1b[0m] Device 77:88:99:AA:BB:CC RSSI: -90\n",
+    "\r[\x1b[0;91mDEL\x1b[0m] Device 77:88:99:AA:BB:CC Gone Soon\n",
+]
+
+class FakeMqttBroker:
+    """Local stand-in for an MQTT broker: routes published messages to subscribers"""
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def publish(self, topic, payload):
+        for topic_filter, client in self.subscriptions:
+            prefix = topic_filter[:-1] if topic_filter.endswith("#") else topic_filter
+            if topic.startswith(prefix) or topic == topic_filter:
+                client.on_message(client, None, MagicMock(topic=topic, payload=payload))
+
+
+class FakeMqttClient:
+    """Minimal paho-mqtt client API backed by FakeMqttBroker"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect_async(self, host, port):
+        self.host = host
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+
+    def subscribe(self, topic, qos=0):
+        self.broker.subscriptions.append((topic, self))
+
+
+def le_advertising_report(mac, rssi, name):
+    """HCI LE Meta event carrying one legacy advertising report"""
+    encoded = name.encode()
+    data = bytes([len(encoded) + 1, 0x09]) + encoded + bytes([3, 0xFF, 0x4C, 0x00])
+    report = bytes([0x00, 0x00]) + bytes.fromhex(mac.replace(":", ""))[::-1] + bytes([len(data)]) + data + struct.pack("b", rssi)
+    params = bytes([0x02, 0x01]) + report
+    return bytes([0x3E, len(params)]) + params
+
+
+def write_btsnoop(path, packets):
+    """Write (unix timestamp, HCI event) pairs as an H4 btsnoop capture"""
+    with open(path, "wb") as f:
+        f.write(b"btsnoop\0" + struct.pack(">II", 1, 1002))
+        for timestamp, packet in packets:
+            packet = bytes([0x04]) + packet
+            f.write(struct.pack(">IIIIq", len(packet), len(packet), 3, 0, int(timestamp * 1e6) + BTSNOOP_EPOCH_OFFSET))
+            f.write(packet)
+
+
 class TestBleDiscovery(unittest.TestCase):
     """Test cases for BLE Discovery addon"""
     
@@ -134,5 +263,1061 @@ class TestBleDiscovery(unittest.TestCase):
             # Expecting interval to be decreased (multiplier < 1)
             self.assertLess(interval, base_interval)
 
+    def test_resolve_activity_entities(self):
+        """Test activity patterns resolve to weighted entity ids"""
+        specs = parse_activity_entities([
+            {"entity": "binary_sensor.hall_motion", "weight": 2},
+            {"entity": "binary_sensor.*motion*"},
+            "light.*:0.5",
+            {"entity": "switch.*", "weight": 0}
+        ])
+        weights = resolve_activity_entities(specs, [
+            "binary_sensor.hall_motion",
+            "binary_sensor.kitchen_motion",
+            "light.porch",
+            "switch.fan",
+            "sensor.temperature"
+        ])
+
+        self.assertEqual(weights, {
+            "binary_sensor.hall_motion": 2.0,
+            "binary_sensor.kitchen_motion": 1.0,
+            "light.porch": 0.5
+        })
+
+    def test_activity_tracker_sliding_window(self):
+        """Test weighted state changes expire from the activity window"""
+        tracker = ActivityTracker([], window_minutes=15, saturation=10)
+        tracker.weights = {"binary_sensor.hall_motion": 2.0, "light.porch": 0.5}
+        now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+        tracker.record_history([
+            [
+                {"entity_id": "binary_sensor.hall_motion", "last_changed": "2024-01-01T11:30:00+00:00"},
+                {"last_changed": "2024-01-01T11:40:00+00:00"},
+                {"last_changed": "2024-01-01T11:50:00+00:00"}
+            ],
+            [
+                {"entity_id": "light.porch", "last_changed": "2024-01-01T11:00:00+00:00"},
+                {"last_changed": "2024-01-01T11:55:00+00:00"}
+            ]
+        ])
+
+        # Only the 11:50 motion change and the 11:55 light change are in the window
+        self.assertAlmostEqual(tracker.score(now), 25.0)
+        self.assertEqual(len(tracker.events), 2)
+
+    def test_device_scheduler_only_returns_due_devices(self):
+        """Test new devices are due at once and then wait for their interval"""
+        scheduler = DeviceScheduler(60, min_interval=10)
+
+        due = scheduler.select_due(self.sample_gateway_data, now=0)
+        self.assertEqual(len(due), 2)
+
+        # Nothing is due again until the base interval has passed
+        self.assertEqual(scheduler.select_due(self.sample_gateway_data, now=30), [])
+        self.assertEqual(len(scheduler.select_due(self.sample_gateway_data, now=60)), 2)
+
+    def test_device_scheduler_keeps_turn_of_absent_devices(self):
+        """Test a due device missing from a batch is processed when its next row arrives"""
+        scheduler = DeviceScheduler(60, min_interval=10)
+        sparse, chatty = self.sample_gateway_data[0], self.sample_gateway_data[1]
+        self.assertEqual(len(scheduler.select_due([sparse, chatty], now=0)), 2)
+
+        # Both are due at 60, but only the chatty device advertises then
+        self.assertEqual(scheduler.select_due([chatty], now=60), [chatty])
+        self.assertEqual(scheduler.pending, {sparse[1].upper()})
+        self.assertEqual(scheduler.select_due([chatty], now=70), [])
+        self.assertEqual(scheduler.select_due([sparse, chatty], now=80), [sparse])
+        self.assertEqual(scheduler.pending, set())
+
+    def test_device_scheduler_forgets_unseen_devices(self):
+        """Test devices not seen within the retention horizon are dropped"""
+        scheduler = DeviceScheduler(60, retention=600)
+        sparse, chatty = self.sample_gateway_data[0], self.sample_gateway_data[1]
+        scheduler.select_due([sparse, chatty], now=0)
+        scheduler.select_due([chatty], now=500)
+        scheduler.select_due([chatty], now=700)
+
+        self.assertEqual(list(scheduler.last_seen), [chatty[1].upper()])
+        self.assertNotIn(sparse[1].upper(), scheduler.samples)
+        self.assertEqual(scheduler.forgotten, 1)
+        # A forgotten device that comes back is due at once
+        self.assertEqual(scheduler.select_due([sparse], now=710), [sparse])
+
+    def test_device_scheduler_per_device_intervals(self):
+        """Test volatile and priority devices are refreshed more often than static ones"""
+        scheduler = DeviceScheduler(60, priority_devices=["11:22:33:44:55:66"], history_size=4)
+        for now, rssi in enumerate([-60, -80, -55, -85]):
+            scheduler.observe("AA:BB:CC:DD:EE:FF", rssi, now)
+            scheduler.observe("11:22:33:44:55:66", -70, now)
+            scheduler.observe("22:33:44:55:66:77", -70, now)
+
+        self.assertEqual(scheduler.compute_interval("AA:BB:CC:DD:EE:FF", 4), 15)
+        self.assertEqual(scheduler.compute_interval("11:22:33:44:55:66", 4), 60)
+        self.assertEqual(scheduler.compute_interval("22:33:44:55:66:77", 4), 120)
+
+        # Devices that have not been seen for a while are backed off
+        self.assertEqual(scheduler.compute_interval("22:33:44:55:66:77", 1000), 480)
+
+    def test_rssi_filter_smooths_noise(self):
+        """Test EWMA and Kalman filters damp a single-sample RSSI spike"""
+        for mode in ("ewma", "kalman"):
+            rssi_filter = RssiFilter(mode)
+            for rssi in [-70, -70, -70, -70]:
+                rssi_filter.update([("AA:BB:CC:DD:EE:FF", rssi), ("11:22:33:44:55:66", -80)])
+            rssi_filter.update([("AA:BB:CC:DD:EE:FF", -50), ("11:22:33:44:55:66", -80)])
+
+            smoothed, variance = rssi_filter.get("AA:BB:CC:DD:EE:FF")
+            self.assertLess(smoothed, -60, mode)
+            self.assertGreater(variance, 0, mode)
+            self.assertEqual(rssi_filter.get("11:22:33:44:55:66"), (-80, 0), mode)
+
+    def test_determine_adaptive_scan_interval_uses_smoothed_rssi(self):
+        """Test noise on raw RSSI does not count as movement once smoothed"""
+        noon = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+
+        with patch('ble_discovery.datetime') as mock_datetime, \
+             patch('ble_discovery.determine_adaptive_scan_interval.previous_rssi', {}, create=True):
+            mock_datetime.now.return_value = noon
+
+            device = {"mac_address": "AA:BB:CC:DD:EE:FF", "rssi": -80,
+                      "rssi_smoothed": -71.0, "rssi_variance": 20.0}
+            determine_adaptive_scan_interval(60, [device], 50)
+
+            # A 15 dB raw jump that moves the smoothed value by 3 dB is noise
+            device.update({"rssi": -65, "rssi_smoothed": -68.0})
+            self.assertEqual(determine_adaptive_scan_interval(60, [device], 50), 60)
+
+            # A sustained shift that moves the smoothed value past the threshold is movement
+            device.update({"rssi": -50, "rssi_smoothed": -60.0})
+            self.assertEqual(determine_adaptive_scan_interval(60, [device], 50), 30)
+
+    def test_rssi_matrix_tracks_nearest_proxy(self):
+        """Test sightings from several proxies are kept per source"""
+        matrix = RssiMatrix(ttl=60)
+        macs = matrix.merge([
+            ["entity_id", "aa:bb:cc:dd:ee:ff", "-80", "{}", "proxy_kitchen"],
+            ["entity_id", "AA:BB:CC:DD:EE:FF", "-60", "{}", "proxy_hall"],
+            ["entity_id", "AA:BB:CC:DD:EE:FF", "-90", "{}", "proxy_hall"],
+            ["entity_id", "11:22:33:44:55:66", "-70", "{}"]
+        ], now=0)
+
+        self.assertEqual(macs, ["AA:BB:CC:DD:EE:FF", "11:22:33:44:55:66"])
+        self.assertEqual(matrix.nearest_proxy("AA:BB:CC:DD:EE:FF"), ("proxy_hall", -60))
+        self.assertEqual(matrix.proxy_rssi("AA:BB:CC:DD:EE:FF", now=0),
+                         {"proxy_kitchen": -80, "proxy_hall": -60})
+        self.assertEqual(matrix.best_rows(macs)[0][1:3], ["AA:BB:CC:DD:EE:FF", "-60"])
+
+        # Once the hall sighting expires the kitchen proxy is nearest again
+        matrix.merge([["entity_id", "AA:BB:CC:DD:EE:FF", "-75", "{}", "proxy_kitchen"]], now=90)
+        self.assertEqual(matrix.nearest_proxy("AA:BB:CC:DD:EE:FF"), ("proxy_kitchen", -75))
+
+    def test_rssi_matrix_incremental_nearest_proxy(self):
+        """Test the nearest proxy kept up per batch matches a full rescan of the row"""
+        generator = LoadGenerator(device_count=50, proxy_count=6, seed=3)
+        matrix = RssiMatrix(ttl=3)
+        for now in range(12):
+            generator.step()
+            macs = matrix.merge(generator.advertisements(duration=0.2), now=now)
+            incremental = {mac: matrix.best.get(mac) for mac in macs}
+            matrix.refresh(macs, now)
+            self.assertEqual(incremental, {mac: matrix.best.get(mac) for mac in macs})
+
+    def test_room_presence_with_hysteresis(self):
+        """Test devices are placed by fingerprint and only move on a confirmed change"""
+        rooms, offsets = parse_rooms([
+            {"name": "Kitchen", "proxy": "proxy_kitchen"},
+            {"name": "Hall", "proxy": "proxy_hall", "offset": 5,
+             "fingerprint": "proxy_hall=-50,proxy_kitchen=-80"},
+            {"name": "Nowhere"}
+        ])
+        self.assertEqual([name for name, fingerprint in rooms], ["Kitchen", "Hall"])
+        self.assertEqual(offsets, {"proxy_hall": 5.0})
+
+        matrix = RssiMatrix(ttl=60)
+        engine = RoomPresenceEngine(rooms, offsets)
+        mac = "AA:BB:CC:DD:EE:FF"
+
+        matrix.merge([["id", mac, "-50", "{}", "proxy_kitchen"], ["id", mac, "-85", "{}", "proxy_hall"]], now=0)
+        self.assertEqual(engine.update(matrix, now=0), {mac: "Kitchen"})
+
+        # One update in the hall is not enough to move the device
+        matrix.merge([["id", mac, "-80", "{}", "proxy_kitchen"], ["id", mac, "-55", "{}", "proxy_hall"]], now=10)
+        self.assertEqual(engine.update(matrix, now=10), {})
+        self.assertEqual(engine.update(matrix, now=20), {mac: "Hall"})
+
+        # With no fresh sightings the device is away, again after confirmation
+        self.assertEqual(engine.update(matrix, now=200), {})
+        self.assertEqual(engine.update(matrix, now=210), {mac: "not_home"})
+        device = {"name": "Pixel Watch", "mac_address": mac}
+        self.assertEqual(room_sensor_entity_id(device), "sensor.pixel_watch_room")
+        # A rename keeps the published entity
+        device["name"] = "Work Watch"
+        self.assertEqual(room_sensor_entity_id(device), "sensor.pixel_watch_room")
+
+    def test_reload_keeps_filter_and_room_state(self):
+        """Test changing rssi_filter or rooms keeps the smoothed values and current rooms"""
+        rssi_filter = reload_rssi_filter(None, "ewma")
+        for rssi in [-70, -60, -60]:
+            rssi_filter.update([("AA:BB:CC:DD:EE:FF", rssi)])
+        smoothed = rssi_filter.get("AA:BB:CC:DD:EE:FF")
+        self.assertIs(reload_rssi_filter(rssi_filter, "kalman"), rssi_filter)
+        self.assertEqual(rssi_filter.mode, "kalman")
+        self.assertEqual(rssi_filter.get("AA:BB:CC:DD:EE:FF"), smoothed)
+        self.assertIsNone(reload_rssi_filter(rssi_filter, "none"))
+
+        raw_rooms = [{"name": "Kitchen", "proxy": "proxy_kitchen"}, {"name": "Hall", "proxy": "proxy_hall"}]
+        engine = reload_room_engine(None, raw_rooms)
+        matrix = RssiMatrix(ttl=60)
+        mac = "AA:BB:CC:DD:EE:FF"
+        matrix.merge([["id", mac, "-50", "{}", "proxy_kitchen"], ["id", mac, "-85", "{}", "proxy_hall"]], now=0)
+        self.assertEqual(engine.update(matrix, now=0), {mac: "Kitchen"})
+
+        # Adding a room keeps the device where it is instead of re-placing it
+        raw_rooms.append({"name": "Office", "proxy": "proxy_office", "offset": 3})
+        self.assertIs(reload_room_engine(engine, raw_rooms), engine)
+        self.assertEqual(engine.names, ["Kitchen", "Hall", "Office"])
+        self.assertEqual(engine.offsets, {"proxy_office": 3.0})
+        self.assertEqual(engine.current, {mac: "Kitchen"})
+        self.assertEqual(engine.update(matrix, now=10), {})
+        self.assertIsNone(reload_room_engine(engine, []))
+
+    def test_room_offset_on_unseen_proxy(self):
+        """Test a calibration offset on a proxy the matrix has not seen yet"""
+        rooms, offsets = parse_rooms([{"name": "Office", "proxy": "p1", "offset": 5, "fingerprint": "p2=-50"}])
+        matrix = RssiMatrix(ttl=60)
+        engine = RoomPresenceEngine(rooms, offsets, confirm=1)
+        mac = "AA:BB:CC:DD:EE:FF"
+
+        matrix.merge([["id", mac, "-50", "{}", "p2"]], now=0)
+        self.assertEqual(engine.update(matrix, now=0), {mac: "Office"})
+        self.assertEqual(matrix.source_names, ["p2", "p1"])
+
+    def test_decode_mqtt_advertisement(self):
+        """Test OpenMQTTGateway and ble_gateway payloads decode into gateway rows"""
+        rows = decode_mqtt_advertisement(
+            "BTLE/omg_kitchen/BTtoMQTT/AABBCCDDEEFF",
+            b'{"id": "aa:bb:cc:dd:ee:ff", "rssi": -71, "name": "Thermo"}'
+        )
+        self.assertEqual(rows[0][1:3], ["AA:BB:CC:DD:EE:FF", "-71"])
+        self.assertEqual(rows[0][4], "omg_kitchen")
+
+        rows = decode_mqtt_advertisement(
+            "BTLE/esp_hall",
+            '{"devices": [["x", "11:22:33:44:55:66", "-80", ""], {"ignored": true}]}'
+        )
+        self.assertEqual(rows, [["x", "11:22:33:44:55:66", "-80", "", "esp_hall"]])
+
+    def test_mqtt_ingest_buffers_and_drops(self):
+        """Test MQTT ingest subscribes to the gateway topic and bounds its buffer"""
+        broker = FakeMqttBroker()
+        ingest = MqttIngest("BTLE", buffer_size=3, client=FakeMqttClient(broker))
+        self.assertTrue(ingest.start("localhost"))
+
+        for i in range(4):
+            broker.publish(f"BTLE/gw/BTtoMQTT/AABBCCDDEE0{i}", f'{{"id": "AABBCCDDEE0{i}", "rssi": -6{i}}}'.encode())
+        broker.publish("BTLE/gw/BTtoMQTT/broken", b"not json")
+        broker.publish("other/topic", b'{"id": "AABBCCDDEEFF", "rssi": -50}')
+
+        rows = ingest.drain()
+        self.assertEqual([row[1] for row in rows], ["AA:BB:CC:DD:EE:02", "AA:BB:CC:DD:EE:03"])
+        self.assertEqual(ingest.stats()["mqtt_received"], 5)
+        self.assertEqual(ingest.stats()["mqtt_dropped"], 2)
+        self.assertEqual(ingest.stats()["mqtt_decode_errors"], 1)
+        self.assertEqual(ingest.drain(), [])
+
+    def test_coalescer_collapses_advertisements_per_window(self):
+        """Test advertisements are collapsed per device and source, one batch per window"""
+        coalescer = AdvertisementCoalescer(window=5)
+        coalescer.add([
+            ["t", "AA:BB:CC:DD:EE:FF", "-70", "first", "gw1"],
+            ["t", "AA:BB:CC:DD:EE:FF", "-60", "second", "gw1"],
+            ["t", "AA:BB:CC:DD:EE:FF", "-80", "other", "gw2"]
+        ], now=0)
+        coalescer.add([["t", "AA:BB:CC:DD:EE:FF", "-65", "third", "gw1"]], now=3)
+        self.assertFalse(coalescer.ready(now=4))
+        self.assertTrue(coalescer.ready(now=5))
+
+        rows = coalescer.flush()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0][2:5], ["-60", "third", "gw1"])
+        self.assertEqual(rows[0][5], {"count": 3, "rssi_mean": -65.0, "rssi_max": -60})
+        self.assertEqual(coalescer.stats()["coalesce_ratio"], 2.0)
+
+        processed = process_ble_gateway_data(rows)
+        self.assertEqual(processed[0]["adv_count"], 3)
+        self.assertEqual(processed[0]["rssi"], -60)
+
+    def test_load_shedder_keeps_new_devices_and_strongest(self):
+        """Test row capping never sheds new devices and degrades publishing under pressure"""
+        shedder = LoadShedder(max_rows=3, publish_limit=1, max_lag=30)
+        rows = [
+            ["id", "00:00:00:00:00:01", "-90", ""],
+            ["id", "00:00:00:00:00:02", "-50", ""],
+            ["id", "00:00:00:00:00:03", "-70", ""],
+            ["id", "NEW:01", "-95", ""],
+            ["id", "NEW:02", "-99", ""]
+        ]
+        known = {"00:00:00:00:00:01": {}, "00:00:00:00:00:02": {}, "00:00:00:00:00:03": {}}
+
+        kept = shedder.limit_rows(rows, known)
+        self.assertEqual([row[1] for row in kept], ["NEW:01", "NEW:02", "00:00:00:00:00:02"])
+        self.assertEqual(shedder.stats()["rows_shed"], 2)
+
+        # Not under pressure: everything is published
+        shedder.start_cycle(next_due=100, now=110)
+        self.assertEqual(len(shedder.limit_publish(self.sample_discoveries)), 2)
+
+        # Due work 60 seconds overdue: only the strongest device is published
+        shedder.start_cycle(next_due=100, now=160)
+        published = shedder.limit_publish(self.sample_discoveries)
+        self.assertEqual([d["mac_address"] for d in published], ["AA:BB:CC:DD:EE:FF"])
+        self.assertEqual(shedder.stats()["publish_shed"], 1)
+        self.assertEqual(shedder.stats()["lag_seconds"], 60)
+
+    @patch('ble_discovery.create_home_assistant_notification', return_value=True)
+    @patch('ble_discovery.publish_registered_devices')
+    @patch('ble_discovery.update_ha_input_text')
+    @patch('ble_discovery.save_discoveries')
+    @patch('ble_discovery.get_local_scanner', return_value=None)
+    @patch('ble_discovery.get_ble_gateway_data')
+    def test_load_shedder_bounds_publish_work(self, mock_gateway, mock_scanner, mock_save, mock_input,
+                                              mock_registered, mock_notify):
+        """Test a cycle under pressure posts fewer registered devices and keeps fewer notifications"""
+        registered = [
+            {"mac_address": f"AA:AA:AA:AA:AA:{i:02X}", "rssi": -60 - i, "registered": True,
+             "last_seen": datetime.now().isoformat()}
+            for i in range(5)
+        ]
+        mock_gateway.return_value = [["id", f"BB:BB:BB:BB:BB:{i:02X}", str(-50 - i), "{}"] for i in range(10)]
+        discover_ble_devices.discoveries = list(registered)
+        discover_ble_devices.index = {d["mac_address"]: d for d in registered}
+        discover_ble_devices.current_rssi = {}
+        load_shedder = LoadShedder(publish_limit=2)
+        notifier = NewDeviceNotifier(window=0)
+        try:
+            # Due work 60 seconds overdue puts the loop under pressure
+            load_shedder.start_cycle(next_due=100, now=160)
+            discover_ble_devices(load_shedder=load_shedder, notifier=notifier)
+        finally:
+            del discover_ble_devices.discoveries, discover_ble_devices.index, discover_ble_devices.current_rssi
+
+        posted = mock_registered.call_args[0][0]
+        self.assertEqual([d["mac_address"] for d in posted], ["AA:AA:AA:AA:AA:00", "AA:AA:AA:AA:AA:01"])
+        self.assertEqual(list(notifier.pending), ["BB:BB:BB:BB:BB:00", "BB:BB:BB:BB:BB:01"])
+        self.assertEqual(load_shedder.stats()["publish_shed"], 3 + 8)
+
+        # The shed devices are still counted in the notification
+        self.assertTrue(notifier.flush(now=time.monotonic()))
+        message = mock_notify.call_args[0][1]
+        self.assertIn("Discovered 10 new BLE devices", message)
+        self.assertIn("+8 more", message)
+        self.assertEqual(notifier.unlisted, 0)
+
+    def test_build_new_device_message_caps_size(self):
+        """Test long new-device lists are cut short with a summary line"""
+        devices = [{"mac_address": f"AA:BB:CC:DD:EE:{i:02X}", "rssi": -70} for i in range(30)]
+        message = build_new_device_message(devices, max_devices=5)
+
+        self.assertIn("Discovered 30 new BLE devices", message)
+        self.assertEqual(message.count("- AA:BB:CC"), 5)
+        self.assertIn("+25 more", message)
+
+    @patch('ble_discovery.create_home_assistant_notification')
+    def test_new_device_notifier_debounces(self, mock_notify):
+        """Test new devices are announced once per window and never twice"""
+        notifier = NewDeviceNotifier(window=60, announced=["11:22:33:44:55:66"])
+
+        notifier.add(self.sample_discoveries, now=0)
+        self.assertFalse(notifier.flush(now=30))
+        notifier.add([{"mac_address": "22:33:44:55:66:77", "rssi": -60}], now=40)
+        self.assertTrue(notifier.flush(now=60))
+
+        self.assertEqual(mock_notify.call_count, 1)
+        message = mock_notify.call_args[0][1]
+        self.assertIn("Discovered 2 new BLE devices", message)
+        self.assertNotIn("11:22:33:44:55:66", message)
+
+        # Already announced devices are ignored
+        notifier.add(self.sample_discoveries, now=70)
+        self.assertFalse(notifier.flush(now=200))
+        self.assertEqual(mock_notify.call_count, 1)
+
+    @patch('ble_discovery.create_home_assistant_notification')
+    def test_new_device_notifier_retries_failed_notification(self, mock_notify):
+        """Test a batch whose notification failed is kept and sent on the next flush"""
+        notifier = NewDeviceNotifier(window=60)
+        notifier.add(self.sample_discoveries, now=0)
+
+        mock_notify.return_value = False
+        self.assertFalse(notifier.flush(now=60))
+        self.assertEqual(len(notifier.pending), 2)
+        self.assertEqual((notifier.announced, notifier.sent), (set(), 0))
+
+        mock_notify.return_value = True
+        self.assertTrue(notifier.flush(now=70))
+        self.assertEqual(mock_notify.call_count, 2)
+        self.assertIn("Discovered 2 new BLE devices", mock_notify.call_args[0][1])
+        self.assertEqual((notifier.pending, notifier.sent), ({}, 1))
+
+    def test_bluetoothctl_scanner_parses_transcript(self):
+        """Test replaying recorded bluetoothctl output yields real RSSI rows"""
+        scanner = BluetoothctlScanner()
+        for line in BLUETOOTHCTL_TRANSCRIPT:
+            scanner.handle_line(line, now=100)
+
+        rows = {row[1]: row for row in scanner.rows(now=110)}
+        self.assertEqual(set(rows), {"AA:BB:CC:DD:EE:FF", "11:22:33:44:55:66"})
+        self.assertEqual(rows["AA:BB:CC:DD:EE:FF"][2], "-64")
+        self.assertEqual(rows["11:22:33:44:55:66"][:3], ["Tracker Tag", "11:22:33:44:55:66", "-75"])
+        self.assertEqual(scanner.rows(now=1000), [])
+
+    def test_bluetoothctl_scanner_reads_subprocess(self):
+        """Test the persistent session reads a real process's stdout"""
+        transcript = "/tmp/test_bluetoothctl.log"
+        with open(transcript, "w") as f:
+            f.writelines(BLUETOOTHCTL_TRANSCRIPT)
+
+        try:
+            scanner = BluetoothctlScanner(command=["cat", transcript])
+            self.assertTrue(scanner.start())
+            scanner.reader.join(timeout=5)
+            self.assertEqual(len(scanner.rows()), 2)
+            scanner.stop()
+        finally:
+            os.remove(transcript)
+
+    def test_capture_replay_decodes_advertising_reports(self):
+        """Test btsnoop replay at maximum speed and at recorded pacing"""
+        capture = "/tmp/test_capture.btsnoop"
+        write_btsnoop(capture, [
+            (1700000000.0, le_advertising_report("AA:BB:CC:DD:EE:FF", -60, "Tag")),
+            (1700000000.0, bytes([0x0E, 0x04, 0x01, 0x03, 0x0C, 0x00])),  # command complete, ignored
+            (1700000005.0, le_advertising_report("11:22:33:44:55:66", -80, "Scale")),
+        ])
+
+        try:
+            rows = CaptureReplay(capture).drain()
+            self.assertEqual([row[1] for row in rows], ["AA:BB:CC:DD:EE:FF", "11:22:33:44:55:66"])
+            self.assertEqual(rows[0][:3], ["Tag", "AA:BB:CC:DD:EE:FF", "-60"])
+            self.assertEqual(json.loads(rows[0][3])["manufacturer_id"], 0x004C)
+            self.assertEqual(rows[0][5]["last_seen"], datetime.fromtimestamp(1700000000).isoformat())
+
+            processed = process_ble_gateway_data(rows)
+            self.assertEqual(processed[1]["last_seen"], datetime.fromtimestamp(1700000005).isoformat())
+
+            paced = CaptureReplay(capture, speed=2.0)
+            self.assertEqual(len(paced.drain(now=0)), 1)
+            self.assertEqual(paced.drain(now=2), [])
+            self.assertEqual(len(paced.drain(now=3)), 1)
+            self.assertEqual(paced.drain(now=4), [])
+            self.assertTrue(paced.exhausted)
+        finally:
+            os.remove(capture)
+
+    @patch('ble_discovery.create_home_assistant_notification')
+    @patch('ble_discovery.update_ha_input_text')
+    @patch('ble_discovery.save_discoveries')
+    @patch('ble_discovery.get_local_scanner', return_value=None)
+    @patch('ble_discovery.get_ble_gateway_data', return_value=[])
+    def test_capture_replay_merges_every_sighting(self, *mocks):
+        """Test a fast replay is not thinned by the wall-clock coalescer and scheduler"""
+        capture = "/tmp/test_capture_merge.btsnoop"
+        write_btsnoop(capture, [
+            (1700000000.0 + i, le_advertising_report("AA:BB:CC:DD:EE:FF", -60 - i % 5, "Tag"))
+            for i in range(40)
+        ])
+        discover_ble_devices.discoveries = []
+        discover_ble_devices.index = {}
+        discover_ble_devices.current_rssi = {}
+        try:
+            with patch('ble_discovery.process_ble_gateway_data', wraps=process_ble_gateway_data) as parse:
+                discover_ble_devices(
+                    scheduler=DeviceScheduler(60),
+                    coalescer=AdvertisementCoalescer(10),
+                    capture_replay=CaptureReplay(capture)
+                )
+            self.assertEqual(sum(len(call.args[0]) for call in parse.call_args_list), 40)
+            self.assertEqual(discover_ble_devices.index["AA:BB:CC:DD:EE:FF"]["last_seen"],
+                             datetime.fromtimestamp(1700000039).isoformat())
+        finally:
+            os.remove(capture)
+            del discover_ble_devices.discoveries, discover_ble_devices.index, discover_ble_devices.current_rssi
+
+    @patch('ble_discovery.requests.get')
+    def test_load_generator_shapes(self, mock_get):
+        """Test synthetic populations in the gateway row, states and MQTT shapes"""
+        generator = LoadGenerator(device_count=200, proxy_count=3, churn_rate=0.05, seed=7)
+        macs = {device.mac for device in generator.devices}
+        generator.step(10)
+        self.assertNotEqual(macs, {device.mac for device in generator.devices})
+
+        rows = generator.gateway_rows()
+        self.assertGreaterEqual(len(rows), 200)
+        self.assertEqual(len(process_ble_gateway_data(rows)), len(rows))
+
+        mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=generator.states()))
+        sightings = get_ble_gateway_data()
+        self.assertEqual({row[1] for row in sightings}, {device.mac for device in generator.devices})
+
+        messages = generator.mqtt_messages(duration=1)
+        self.assertEqual(len(messages), 200)
+        self.assertEqual(len(decode_mqtt_advertisement(*messages[0])), 1)
+
+    def test_fake_supervisor_end_to_end(self):
+        """Test the add-on's API calls against the local fake Supervisor"""
+        generator = LoadGenerator(device_count=50, proxy_count=2, seed=3)
+        with FakeSupervisor(generator=generator) as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            self.assertEqual({row[1] for row in get_ble_gateway_data()}, {d.mac for d in generator.devices})
+
+            self.assertTrue(update_ha_input_text("input_text.discovered_ble_devices", "{}"))
+            self.assertEqual(fake.states["input_text.discovered_ble_devices"]["state"], "{}")
+
+            # History requests see the state changes made through the API
+            fake.set_state("light.kitchen", "on")
+            tracker = ActivityTracker([("light.*", 1.0)], saturation=1)
+            tracker.last_fetch = datetime.now(timezone.utc) - timedelta(minutes=1)
+            fake.set_state("light.kitchen", "off")
+            self.assertEqual(tracker.update({}), 100)
+
+            # Injected errors are handled like Supervisor failures
+            fake.error_rate = 1.0
+            self.assertEqual(get_ble_gateway_data(), [])
+
+    def test_benchmark_regressions_against_baseline(self):
+        """Test benchmark results are reported per size and compared with a baseline"""
+        results = run_benchmarks([100], ["determine_adaptive_scan_interval"])
+        result = results["determine_adaptive_scan_interval[100]"]
+        self.assertGreater(result["time_s"], 0)
+
+        self.assertEqual(compare(results, results), [])
+        faster = {key: dict(value, time_s=value["time_s"] / 10) for key, value in results.items()}
+        self.assertEqual(len(compare(results, faster)), 1)
+
+    def test_phase_histogram_rolling_percentiles(self):
+        """Test p50/p95/max over a fixed window of samples"""
+        histogram = PhaseHistogram(window=100)
+        for i in range(1, 101):
+            histogram.add(i / 1000)
+        self.assertEqual(histogram.max(), 0.1)
+        self.assertLessEqual(histogram.percentile(0.5), 0.05 * 1.42)
+        self.assertGreaterEqual(histogram.percentile(0.5), 0.05)
+        self.assertGreaterEqual(histogram.percentile(0.95), 0.095)
+
+        # Old samples leave the window
+        for _ in range(100):
+            histogram.add(0.001)
+        self.assertEqual(histogram.max(), 0.001)
+        self.assertEqual(sum(histogram.counts), 100)
+
+    @patch('ble_discovery.time.monotonic')
+    def test_cycle_performance_charges_phases(self, mock_time):
+        """Test marks charge elapsed time to phases and publish as attributes"""
+        perf = CyclePerformance()
+        mock_time.return_value = 0.0
+        perf.begin_cycle()
+        for phase, at in (("activity", 0.2), ("gateway_fetch", 0.5), ("publish", 0.6), ("publish", 0.7)):
+            mock_time.return_value = at
+            perf.mark(phase)
+        mock_time.return_value = 1.0
+        perf.end_cycle()
+
+        stats = perf.stats()
+        self.assertEqual(stats["cycle_max_ms"], 1000.0)
+        self.assertEqual(stats["gateway_fetch_max_ms"], 300.0)
+        self.assertEqual(stats["publish_max_ms"], 200.0)
+        self.assertEqual(stats["merge_max_ms"], 0.0)
+
+    def test_metrics_exposition(self):
+        """Test counters, gauges and histograms in the Prometheus text format"""
+        metrics = Metrics()
+        metrics.new_devices.labels().inc(3)
+        metrics.queue_depth.labels("mqtt").set(7)
+        metrics.cycle_duration.labels().observe(0.2)
+        metrics.cycle_duration.labels().observe(90)
+
+        text = metrics.render()
+        self.assertIn("ble_new_devices_total 3\n", text)
+        self.assertIn('ble_queue_depth{queue="mqtt"} 7\n', text)
+        self.assertIn('ble_cycle_duration_seconds_bucket{le="0.25"} 1\n', text)
+        self.assertIn('ble_cycle_duration_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn("ble_cycle_duration_seconds_count 2\n", text)
+
+        self.assertEqual(supervisor_endpoint("post", "/services/input_text/set_value"), "POST /services/input_text/set_value")
+        self.assertEqual(supervisor_endpoint("get", "/states/sensor.x"), "GET /states/{entity_id}")
+        self.assertEqual(supervisor_endpoint("get", "/history/period/2024-01-01"), "GET /history")
+
+    def test_supervisor_calls_are_measured(self):
+        """Test API latency and errors by status code are recorded per endpoint"""
+        with FakeSupervisor() as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            errors = METRICS.http_errors.labels("GET /states/{entity_id}", "404").value
+            supervisor_get("/states/sensor.missing")
+            self.assertEqual(METRICS.http_errors.labels("GET /states/{entity_id}", "404").value, errors + 1)
+            self.assertGreater(METRICS.request_duration.labels("GET /states/{entity_id}").count, 0)
+
+    def test_websocket_answers_heartbeat_pings(self):
+        """Test the WebSocket client answers pings and outlives several heartbeat intervals"""
+        with FakeSupervisor(heartbeat=0.1) as fake:
+            with HomeAssistantWebSocket(fake.websocket_url, token="") as ws:
+                ws.command("subscribe_events", event_type="state_changed")
+
+                def publish():
+                    for i in range(10):
+                        time.sleep(0.05)
+                        fake.set_state("sensor.heartbeat", i)
+
+                threading.Thread(target=publish, daemon=True).start()
+                states = [ws.receive()["event"]["data"]["new_state"]["state"] for _ in range(10)]
+            self.assertEqual(states, [str(i) for i in range(10)])
+            self.assertGreaterEqual(fake.pongs, 3)
+
+    def test_profiler_runs_on_demand_and_switches_off(self):
+        """Test profiling is switched on from HA, writes reports and switches itself off"""
+        directory = "/tmp/test_ble_diagnostics"
+        with FakeSupervisor() as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            profiler = CycleProfiler(cycles=2, directory=directory)
+            profiler.begin_cycle({})
+            self.assertIsNone(profiler.profile)
+
+            # The switch is created on existing installs too, once
+            self.assertTrue(profiler.ensure_entity())
+            self.assertEqual(fake.states["input_boolean.ble_discovery_profiling"]["state"], "off")
+            self.assertFalse(profiler.ensure_entity())
+
+            fake.set_state("input_boolean.ble_discovery_profiling", "on")
+            for _ in range(2):
+                profiler.begin_cycle({})
+                process_ble_gateway_data([["Tag", "AA:BB:CC:DD:EE:FF", "-60"]])
+                profiler.end_cycle({})
+
+            try:
+                self.assertIsNone(profiler.profile)
+                self.assertEqual(fake.states["input_boolean.ble_discovery_profiling"]["state"], "off")
+                with open(profiler.reports[0]) as f:
+                    self.assertIn("process_ble_gateway_data", f.read())
+                self.assertTrue(os.path.exists(profiler.reports[1]))
+            finally:
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+
+    def test_memory_accountant_selects_stale_devices(self):
+        """Test memory accounting and eviction of the least recently seen devices"""
+        now = datetime.now()
+        discoveries = [
+            {"mac_address": f"AA:BB:CC:DD:EE:{i:02X}", "last_seen": (now - timedelta(hours=2, minutes=i)).isoformat()}
+            for i in range(30)
+        ]
+        discoveries[0]["last_seen"] = now.isoformat()
+
+        accountant = MemoryAccountant(soft_limit_mb=1)
+        report = accountant.account({"discoveries": discoveries}, rss=2 * 1024 * 1024)
+        self.assertEqual(report["memory_discoveries_entries"], 30)
+        self.assertGreater(report["memory_discoveries_kib"], 0)
+        # The limit applies to the measured structures, not the RSS
+        self.assertFalse(accountant.over_limit())
+        accountant.soft_limit = 1024
+        self.assertTrue(accountant.over_limit())
+        # Structures eviction cannot shrink are reported but not counted
+        report = accountant.account({"discoveries": discoveries, "scheduler": {}}, rss=0, evictable=("scheduler",))
+        self.assertGreater(report["memory_total_mib"], 0)
+        self.assertEqual(report["memory_tracked_mib"], 0)
+        self.assertFalse(accountant.over_limit())
+
+        evict = accountant.select_evictions(discoveries, {"AA:BB:CC:DD:EE:1D"}, now)
+        # A tenth of the store, oldest first, never the protected or recently seen devices
+        self.assertEqual(evict, ["AA:BB:CC:DD:EE:1C", "AA:BB:CC:DD:EE:1B", "AA:BB:CC:DD:EE:1A"])
+        # Devices whose tracking state is already gone are not selected again
+        evict = accountant.select_evictions(discoveries, {"AA:BB:CC:DD:EE:1D"}, now, tracked={"AA:BB:CC:DD:EE:1B"})
+        self.assertEqual(evict, ["AA:BB:CC:DD:EE:1B"])
+
+    def test_recent_devices_bounds_published_history(self):
+        """Test the published device list keeps only the most recently seen devices"""
+        devices = [{"mac_address": str(i), "last_seen": f"2024-01-01T00:00:{i:02d}"} for i in range(10)]
+        self.assertIs(recent_devices(devices, limit=10), devices)
+        self.assertEqual([d["mac_address"] for d in recent_devices(devices, limit=3)], ["9", "8", "7"])
+
+    @patch('ble_discovery.save_discoveries')
+    def test_forget_devices_clears_every_structure(self, mock_save):
+        """Test forgotten devices are dropped from the per-device trackers but kept in the store"""
+        mac = "AA:BB:CC:DD:EE:FF"
+        discover_ble_devices.discoveries = [{"mac_address": mac}, {"mac_address": "11:22:33:44:55:66"}]
+        discover_ble_devices.index = {d["mac_address"]: d for d in discover_ble_devices.discoveries}
+        discover_ble_devices.current_rssi = {mac: -60}
+        scheduler = DeviceScheduler(60)
+        scheduler.observe(mac, -60, 0)
+        rssi_matrix = RssiMatrix()
+        rssi_matrix.merge([["Tag", mac, "-60", "{}", "bluetooth"]])
+        try:
+            forget_devices([mac], scheduler, None, rssi_matrix, None)
+            self.assertEqual(list(discover_ble_devices.index), [mac, "11:22:33:44:55:66"])
+            self.assertEqual(len(discover_ble_devices.discoveries), 2)
+            self.assertEqual(discover_ble_devices.current_rssi, {})
+            self.assertNotIn(mac, scheduler.samples)
+            self.assertNotIn(mac, rssi_matrix.rows)
+            mock_save.assert_not_called()
+        finally:
+            del discover_ble_devices.discoveries, discover_ble_devices.index, discover_ble_devices.current_rssi
+
+    def test_rate_limit_filter_suppresses_repeats(self):
+        """Test repeated per-device messages are limited per call site and the suppressed count is noted"""
+        rate_filter = RateLimitFilter(limit=2, window=60)
+
+        def record(created, lineno=10):
+            rec = logging.LogRecord("ble_discovery.device", logging.ERROR, "ble_discovery.py", lineno,
+                                    "Error updating %s", ("sensor.x",), None)
+            rec.created = created
+            return rec
+
+        self.assertEqual([rate_filter.filter(record(t)) for t in range(4)], [True, True, False, False])
+        self.assertTrue(rate_filter.filter(record(1, lineno=20)))
+        later = record(61)
+        self.assertTrue(rate_filter.filter(later))
+        self.assertEqual(later.getMessage(), "Error updating sensor.x (2 similar messages suppressed)")
+
+    def test_setup_logging_writes_through_queue(self):
+        """Test records reach the rotating log file through the queue listener"""
+        log_dir = "/tmp/test_ble_logs"
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        try:
+            setup_logging("DEBUG", log_dir=log_dir)
+            self.assertIsInstance(root.handlers[0], logging.handlers.QueueHandler)
+            logging.debug("Processed %d devices", 42)
+            stop_logging()
+            with open(os.path.join(log_dir, "ble_discovery.log")) as f:
+                self.assertIn("Processed 42 devices", f.read())
+        finally:
+            stop_logging()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            for name in os.listdir(log_dir):
+                os.remove(os.path.join(log_dir, name))
+            os.rmdir(log_dir)
+
+    def test_log_queue_drops_are_counted(self):
+        """Test records beyond a full log queue are dropped, counted and exported"""
+        log_dir = "/tmp/test_ble_logs"
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        try:
+            with patch("ble_discovery.LOG_QUEUE_SIZE", 2):
+                setup_logging("DEBUG", log_dir=log_dir)
+            # Stop the listener so the queue fills up
+            stop_logging()
+            for i in range(5):
+                logging.debug("Record %d", i)
+            self.assertEqual(setup_logging.queue_handlers["main"].dropped, 3)
+
+            metrics = Metrics()
+            record_log_drops(metrics)
+            self.assertIn('ble_log_records_dropped_total{log="main"} 3\n', metrics.render())
+        finally:
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            for name in os.listdir(log_dir):
+                os.remove(os.path.join(log_dir, name))
+            os.rmdir(log_dir)
+
+    def test_cycle_trace_records(self):
+        """Test the JSON trace record of a cycle and the cycle id on regular log lines"""
+        log_dir = "/tmp/test_ble_trace"
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        perf = CyclePerformance()
+        try:
+            setup_logging("DEBUG", log_dir=log_dir, trace=True)
+            perf.begin_cycle()
+            CYCLE_TRACE.begin_cycle()
+            perf.mark("parse")
+            logging.debug("Parsing")
+            logging.error("Error updating %s", "sensor.x")
+            CYCLE_TRACE.count(devices=3, new=1)
+            perf.end_cycle()
+            CYCLE_TRACE.end_cycle(perf)
+            stop_logging()
+
+            with open(os.path.join(log_dir, "ble_discovery_trace.jsonl")) as f:
+                record = json.loads(f.readline())
+            self.assertEqual(record["cycle"], CYCLE_TRACE.cycle_id)
+            self.assertEqual(record["counts"], {"devices": 3, "new": 1})
+            self.assertEqual(record["errors"], 1)
+            self.assertEqual(record["error_messages"], ["Error updating sensor.x"])
+            self.assertIn("parse", record["phases_ms"])
+            with open(os.path.join(log_dir, "ble_discovery.log")) as f:
+                self.assertIn(f"[cycle {CYCLE_TRACE.cycle_id}] - Parsing", f.read())
+        finally:
+            stop_logging()
+            CYCLE_TRACE.enabled = False
+            trace_log.handlers.clear()
+            root.handlers[:] = handlers
+            root.setLevel(level)
+            for name in os.listdir(log_dir):
+                os.remove(os.path.join(log_dir, name))
+            os.rmdir(log_dir)
+
+    def test_system_diagnostics_without_shell(self):
+        """Test diagnostics find adapters and bluetoothctl without spawning shell commands"""
+        directory = "/tmp/test_ble_diag"
+        sysfs = os.path.join(directory, "sysfs")
+        os.makedirs(os.path.join(sysfs, "hci0"), exist_ok=True)
+        try:
+            with patch('ble_discovery.DIAGNOSTICS_DIR', directory), \
+                    patch('ble_discovery.BLUETOOTH_SYSFS', sysfs), \
+                    patch('shutil.which', return_value=None), \
+                    patch('ble_discovery.subprocess.run') as mock_run:
+                diagnostics = collect_system_diagnostics()
+            self.assertEqual(diagnostics["bluetooth_adapters"], ["hci0"])
+            self.assertFalse(diagnostics["bluetoothctl_available"])
+            mock_run.assert_not_called()
+        finally:
+            os.rmdir(os.path.join(sysfs, "hci0"))
+            os.rmdir(sysfs)
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_cold_paths_are_not_imported_at_startup(self):
+        """Test importing the add-on does not load the metrics server or profiling modules"""
+        loaded = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, ble_discovery; print(sorted({'http.server', 'cProfile', 'pstats', 'tracemalloc'} & set(sys.modules)))"],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertEqual(loaded.stdout.strip(), "[]")
+
+    def test_options_watcher_reports_changes(self):
+        """Test a rewritten options file is picked up and only the changed options are reported"""
+        path = "/tmp/test_ble_options.json"
+        options = {"scan_interval": 60, "log_level": "info", "priority_devices": []}
+        with open(path, 'w') as f:
+            json.dump(options, f)
+        try:
+            watcher = OptionsWatcher(options, path=path, poll_interval=0.01)
+            self.assertEqual(watcher.wait(0), set())
+
+            with open(path, 'w') as f:
+                json.dump(dict(options, scan_interval=120, priority_devices=["aa:bb:cc:dd:ee:ff"]), f)
+            os.utime(path, ns=(0, 1))
+            self.assertEqual(watcher.wait(1), {"scan_interval", "priority_devices"})
+            self.assertEqual(watcher.options["scan_interval"], 120)
+            self.assertEqual(watcher.check(), set())
+        finally:
+            os.remove(path)
+
+    def test_apply_option_changes_keeps_state(self):
+        """Test changed options are applied to the running components in place"""
+        scheduler = DeviceScheduler(60)
+        scheduler.observe("AA:BB:CC:DD:EE:FF", -60, 0)
+        coalescer = AdvertisementCoalescer()
+        load_shedder = LoadShedder()
+        notifier = NewDeviceNotifier()
+        accountant = MemoryAccountant()
+        options = {"priority_devices": ["aa:bb:cc:dd:ee:ff"], "coalesce_window": 30,
+                   "max_rows_per_cycle": 200, "memory_soft_limit": 64}
+
+        apply_option_changes(set(options), options, scheduler, coalescer, load_shedder, notifier, accountant)
+        self.assertEqual(scheduler.priority_devices, {"AA:BB:CC:DD:EE:FF"})
+        self.assertIn("AA:BB:CC:DD:EE:FF", scheduler.samples)
+        self.assertEqual(coalescer.window, 30)
+        self.assertEqual(load_shedder.max_rows, 200)
+        self.assertEqual(accountant.soft_limit, 64 * 1024 * 1024)
+        self.assertEqual(log_level_number("trace"), logging.DEBUG)
+        self.assertEqual(log_level_number("fatal"), logging.CRITICAL)
+
+    @patch('ble_discovery.save_discoveries')
+    def test_register_and_rename_device_live(self, mock_save):
+        """Test a device is registered with live entities and renamed without a restart"""
+        discover_ble_devices.discoveries = []
+        discover_ble_devices.index = {}
+        discover_ble_devices.current_rssi = {}
+        try:
+            with FakeSupervisor() as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+                device = register_device("Pixel Watch", "aa-bb-cc-dd-ee-ff", "presence", -75, "mdi:watch")
+                self.assertIs(discover_ble_devices.index["AA:BB:CC:DD:EE:FF"], device)
+                self.assertEqual(device["entities"], {
+                    "rssi": "sensor.pixel_watch_rssi",
+                    "presence": "binary_sensor.pixel_watch_presence",
+                    "threshold": "input_number.pixel_watch_rssi_threshold"
+                })
+                self.assertEqual(fake.states["input_number.pixel_watch_rssi_threshold"]["state"], "-75.0")
+                self.assertEqual(fake.states["binary_sensor.pixel_watch_presence"]["state"], "off")
+                mock_save.assert_called_once()
+
+                # The threshold helper is only read back on its refresh cadence or after a reload
+                fake.set_state("input_number.pixel_watch_rssi_threshold", "-95.0")
+                device["rssi"] = -90
+                publish_registered_devices([device])
+                self.assertEqual(fake.states["binary_sensor.pixel_watch_presence"]["state"], "off")
+                self.assertEqual(fake.states["sensor.pixel_watch_rssi"]["state"], "-90")
+                refresh_registered_thresholds()
+                publish_registered_devices([device])
+                self.assertEqual(fake.states["binary_sensor.pixel_watch_presence"]["state"], "on")
+
+                # Unchanged devices cost no Supervisor calls
+                requests = fake.requests
+                publish_registered_devices([device])
+                self.assertEqual(fake.requests, requests)
+
+                # A device that has left is no longer present
+                device["last_seen"] = (datetime.now() - timedelta(minutes=10)).isoformat()
+                publish_registered_devices([device], stale_after=300)
+                self.assertEqual(fake.states["binary_sensor.pixel_watch_presence"]["state"], "off")
+
+                rename_device("AA:BB:CC:DD:EE:FF", "Work Watch")
+                self.assertEqual(fake.states["binary_sensor.pixel_watch_presence"]["attributes"]["friendly_name"], "Work Watch")
+                self.assertFalse(any(s.startswith("homeassistant") for s, _ in [(c[0], c[1]) for c in fake.service_calls]))
+
+                with self.assertRaises(ValueError):
+                    register_device("Bad", "AA:BB", "presence", -75)
+        finally:
+            del discover_ble_devices.discoveries, discover_ble_devices.index, discover_ble_devices.current_rssi
+
+    def test_device_commands_from_stdin(self):
+        """Test JSON commands on stdin are queued and wake the loop; invalid lines are skipped"""
+        commands = DeviceCommands(io.StringIO(
+            '{"action": "add_device", "mac_address": "AABBCCDDEEFF"}\n'
+            'not json\n'
+            '\n'
+            '{"action": "rename_device", "mac_address": "AABBCCDDEEFF", "device_name": "Tag"}\n'
+        ))
+        commands.read()
+        self.assertTrue(commands.wake.is_set())
+        self.assertEqual([c["action"] for c in commands.drain()], ["add_device", "rename_device"])
+        self.assertFalse(commands.wake.is_set())
+        self.assertEqual(commands.drain(), [])
+
+    def test_device_views_stay_sorted(self):
+        """Test the views are re-filed incrementally as RSSI and room change, and stale devices drop out"""
+        devices = {
+            mac: {"mac_address": mac, "name": name, "rssi": rssi, "device_type": kind, "discovered_at": seen}
+            for mac, name, rssi, kind, seen in [
+                ("AA:00:00:00:00:01", "Watch", -70, "Wearable", "2026-01-01T10:00:00"),
+                ("AA:00:00:00:00:02", "Tag", -50, "Tracker", "2026-01-01T09:00:00"),
+                ("AA:00:00:00:00:03", "Bulb", -90, "Lighting", "2026-01-01T11:00:00"),
+            ]
+        }
+        views = DeviceViews(devices.values(), top_n=2, group_n=1, recent_n=2, stale_after=300)
+        # The store only seeds the recent discoveries; devices are listed once sighted
+        self.assertEqual(views.attributes(devices)["top"], [])
+        views.update(devices.values(), now=1000.0)
+        attributes = views.attributes(devices)
+        self.assertEqual([d["name"] for d in attributes["top"]], ["Tag", "Watch"])
+        self.assertEqual([d["name"] for d in attributes["new"]], ["Bulb", "Watch"])
+        self.assertEqual(attributes["type_counts"], {"Lighting": 1, "Tracker": 1, "Wearable": 1})
+
+        # A stronger reading moves the device up; an unchanged one is not re-filed
+        devices["AA:00:00:00:00:03"].update(rssi=-40, room="Kitchen")
+        views.changed = False
+        views.update([devices["AA:00:00:00:00:03"], devices["AA:00:00:00:00:02"]], now=1200.0)
+        self.assertTrue(views.changed)
+        attributes = views.attributes(devices)
+        self.assertEqual([d["name"] for d in attributes["top"]], ["Bulb", "Tag"])
+        self.assertEqual(list(attributes["by_room"]), ["Kitchen"])
+
+        # The Watch was not sighted since 1000
+        views.expire(now=1400.0)
+        attributes = views.attributes(devices)
+        self.assertEqual([d["name"] for d in attributes["top"]], ["Bulb", "Tag"])
+        self.assertNotIn("AA:00:00:00:00:01", views.entries)
+        # The scheduler saw the Tag (not due, so not re-filed) after the views did
+        views.expire({"AA:00:00:00:00:02": 1250.0}, now=1540.0)
+        self.assertEqual(list(views.entries), ["AA:00:00:00:00:02"])
+        views.update([devices["AA:00:00:00:00:03"]], now=1540.0)
+
+        views.forget({"AA:00:00:00:00:03"})
+        attributes = views.attributes(devices)
+        self.assertEqual([d["name"] for d in attributes["top"]], ["Tag"])
+        self.assertEqual(attributes["by_room"], {})
+        self.assertNotIn("Lighting", attributes["by_type"])
+        self.assertEqual([d["name"] for d in attributes["new"]], ["Bulb", "Watch"])
+
+        # Published once per change, through the states API
+        with FakeSupervisor() as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            self.assertTrue(views.publish(devices))
+            self.assertFalse(views.publish(devices))
+            self.assertEqual(fake.states["sensor.ble_device_views"]["state"], "1")
+
+    @patch.object(SignalTest, 'run')
+    @patch.object(SignalTest, 'stream_home_assistant')
+    def test_signal_test_samples_selected_device(self, mock_stream, mock_run):
+        """Test only the tested device is sampled and its statistics cover the window"""
+        test = SignalTest(window=10)
+        test.observe("AA:BB:CC:DD:EE:FF", -60)
+        self.assertEqual(test.stats(), {"samples": 0})
+
+        self.assertTrue(test.select("aabbccddeeff", 30, now=100.0))
+        mock_stream.assert_called_once()
+        mock_run.assert_called_once()
+        for offset, rssi in enumerate([-60, -64, -62, -70]):
+            test.observe("AA:BB:CC:DD:EE:FF", rssi, "proxy_1", now=100.0 + offset)
+        test.observe("11:22:33:44:55:66", -40, "proxy_1", now=101.0)
+        test.observe_message("BTLE/proxy_2/BTtoMQTT/AABBCCDDEEFF", '{"id": "AA:BB:CC:DD:EE:FF", "rssi": -66}')
+        test.observe_message("BTLE/proxy_2/BTtoMQTT/112233445566", '{"id": "11:22:33:44:55:66", "rssi": -30}')
+        test.samples[-1] = (104.0,) + test.samples[-1][1:]
+
+        stats = test.stats(now=105.0)
+        self.assertEqual(stats["samples"], 5)
+        self.assertEqual((stats["min"], stats["max"], stats["avg"]), (-70, -60, -64.4))
+        self.assertEqual(stats["jitter"], 4.5)
+        self.assertEqual(stats["source"], "proxy_2")
+        self.assertEqual(stats["rate"], 1.0)
+
+        # Older samples leave the window
+        self.assertEqual(test.stats(now=112.5)["samples"], 2)
+
+        # Polled rows are only used while no stream delivers advertisements
+        test.streaming_generation = test.generation
+        self.assertTrue(test.streaming)
+        test.observe_rows([["Tag", "AA:BB:CC:DD:EE:FF", "-50", "{}", "bluetooth"]])
+        self.assertEqual(test.received, 5)
+
+        with patch('ble_discovery.SIGNAL_TEST', test):
+            process_device_command({"action": "signal_test", "mac_address": "11-22-33-44-55-66", "duration": 5})
+        self.assertEqual(test.target, "11:22:33:44:55:66")
+        self.assertEqual(test.stats(), {"samples": 0})
+        # The previous test's stream does not count for this one
+        self.assertFalse(test.streaming)
+        self.assertEqual(mock_run.call_count, 2)
+
+    def test_signal_test_publishes_final_result(self):
+        """Test the final statistics are published when the test duration is over, and tracking stops"""
+        test = SignalTest()
+        test.select("AA:BB:CC:DD:EE:FF", 5, stream=False)
+        test.observe("AA:BB:CC:DD:EE:FF", -55, "proxy_1")
+        test.ends = test.started - 1
+        with FakeSupervisor() as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            test.run(test.generation)
+            state = fake.states["sensor.ble_signal_test"]
+        self.assertEqual(state["state"], "-55.0")
+        self.assertFalse(state["attributes"]["running"])
+        self.assertEqual(state["attributes"]["mac_address"], "AA:BB:CC:DD:EE:FF")
+        self.assertIsNone(test.target)
+
+    @patch.object(SignalTest, 'run')
+    def test_signal_test_stream_survives_heartbeats_and_quiet_periods(self, mock_run):
+        """Test streamed samples keep arriving across heartbeats and read timeouts without a reconnect"""
+        test = SignalTest(refresh=0.05)
+        with FakeSupervisor(heartbeat=0.1) as fake, patch('ble_discovery.SUPERVISOR_API', fake.url):
+            try:
+                test.select("AA:BB:CC:DD:EE:FF", 30)
+                for _ in range(100):
+                    if fake.advertisement_subscribers:
+                        break
+                    time.sleep(0.01)
+                # Spaced wider than both the read timeout and the heartbeat interval
+                for rssi in range(-60, -70, -1):
+                    fake.advertise([{"address": "AA:BB:CC:DD:EE:FF", "rssi": rssi, "source": "hci0"},
+                                    {"address": "11:22:33:44:55:66", "rssi": -40, "source": "hci0"}])
+                    time.sleep(0.15)
+                self.assertEqual([rssi for _, rssi, _ in test.samples], list(range(-60, -70, -1)))
+                self.assertTrue(test.streaming)
+                self.assertEqual(len(fake.advertisement_subscribers), 1)
+                self.assertGreaterEqual(fake.pongs, 5)
+            finally:
+                test.select(None)
+                test.stop()
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file